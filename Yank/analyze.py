@@ -15,6 +15,20 @@
 
 import os
 import os.path
+import csv
+import collections
+import json
+import hashlib
+import time
+import datetime
+import functools
+import multiprocessing
+import multiprocessing.pool
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
 
 import yaml
 import numpy as np
@@ -22,6 +36,7 @@ import numpy as np
 import netCDF4 as netcdf  # netcdf4-python
 
 from pymbar import MBAR  # multistate Bennett acceptance ratio
+from pymbar import BAR  # Bennett acceptance ratio
 from pymbar import timeseries  # for statistical inefficiency analysis
 
 import mdtraj
@@ -38,83 +53,239 @@ logger = logging.getLogger(__name__)
 
 kB = units.BOLTZMANN_CONSTANT_kB * units.AVOGADRO_CONSTANT_NA
 
+# Number of iterations read at once from the store file. This bounds the memory
+# used to deconvolute the energies of long simulations.
+DEFAULT_CHUNK_SIZE = 1000
+
+# Number of equilibration times evaluated at each refinement of the coarse-to-fine
+# search in detect_equilibration().
+EQUILIBRATION_GRID_SIZE = 50
+
 # =============================================================================================
 # SUBROUTINES
 # =============================================================================================
 
 
-def show_mixing_statistics(ncfile, cutoff=0.05, nequil=0):
+def count_state_transitions(replica_states):
     """
-    Print summary of mixing statistics.
+    Count the transitions between thermodynamic states of all replicas.
 
     Parameters
     ----------
+    replica_states : numpy.array of int
+       replica_states[n,i] is the state of replica i at iteration n.
 
-    ncfile : netCDF4.Dataset
-       NetCDF file
-    cutoff : float, optional, default=0.05
-       Only transition probabilities above 'cutoff' will be printed
-    nequil : int, optional, default=0
-       If specified, only samples nequil:end will be used in analysis
+    Returns
+    -------
+    Nij : numpy.array of numpy.float64
+       Nij[i,j] is the number of transitions from state i at one iteration to
+       state j at the next one.
 
     """
+    replica_states = np.asarray(replica_states)
+    nstates = replica_states.shape[1]
+    transitions = replica_states[:-1].ravel() * nstates + replica_states[1:].ravel()
+    Nij = np.bincount(transitions, minlength=nstates**2).reshape(nstates, nstates)
+    return Nij.astype(np.float64)
 
-    # Get dimensions.
-    niterations = ncfile.variables['states'].shape[0]
-    nstates = ncfile.variables['states'].shape[1]
 
-    # Compute empirical transition count matrix.
-    Nij = np.zeros([nstates,nstates], np.float64)
-    for iteration in range(nequil, niterations-1):
-        for ireplica in range(nstates):
-            istate = ncfile.variables['states'][iteration,ireplica]
-            jstate = ncfile.variables['states'][iteration+1,ireplica]
-            Nij[istate,jstate] += 1
+def estimate_transition_matrix(Nij):
+    """
+    Estimate the symmetrized state mixing transition matrix from transition counts.
+
+    Parameters
+    ----------
+    Nij : numpy.array
+       Nij[i,j] is the number of transitions from state i to state j.
+
+    Returns
+    -------
+    Tij : numpy.array of numpy.float64
+       Tij[i,j] is the estimated probability of a transition from state i to
+       state j. States that have never been visited transition only to themselves.
 
-    # Compute transition matrix estimate.
+    """
     # TODO: Replace with maximum likelihood reversible count estimator from msmbuilder or pyemma.
-    Tij = np.zeros([nstates,nstates], np.float64)
-    for istate in range(nstates):
-        denom = (Nij[istate,:].sum() + Nij[:,istate].sum())
-        if (denom > 0):
-            for jstate in range(nstates):
-                Tij[istate,jstate] = (Nij[istate,jstate] + Nij[jstate,istate]) / denom
-        else:
-            Tij[istate,istate] = 1.0
+    Cij = Nij + Nij.T
+    denom = Cij.sum(axis=1)
+    Tij = np.eye(len(Cij), dtype=np.float64)
+    visited = denom > 0
+    Tij[visited] = Cij[visited] / denom[visited, np.newaxis]
+    return Tij
 
-    # Print observed transition probabilities.
-    logger.info("Cumulative symmetrized state mixing transition matrix:")
-    str_row = "%6s" % ""
-    for jstate in range(nstates):
-        str_row += "%6d" % jstate
-    logger.info(str_row)
 
+def compute_relaxation_time(Tij):
+    """
+    Estimate the state equilibration timescale from the second eigenvalue of a transition matrix.
+
+    Parameters
+    ----------
+    Tij : numpy.array
+       The state mixing transition matrix.
+
+    Returns
+    -------
+    mu : float
+       The second largest (subdominant) eigenvalue of Tij.
+    relaxation_time : float
+       The state equilibration timescale in iterations, which is infinite if the
+       Markov chain is decomposable.
+
+    """
+    mu = np.sort(np.real(np.linalg.eigvals(Tij)))[::-1]  # sort in descending order
+    if len(mu) < 2:
+        return 0.0, 0.0
+    if mu[1] >= 1:
+        return mu[1], np.inf
+    return mu[1], 1.0 / (1.0 - mu[1])
+
+
+def log_mixing_statistics(Tij, cutoff=0.05, log=logger.info):
+    """
+    Log a state mixing transition matrix and the corresponding equilibration timescale.
+
+    Parameters
+    ----------
+    Tij : numpy.array
+       The state mixing transition matrix.
+    cutoff : float, optional, default=0.05
+       Only transition probabilities above 'cutoff' will be printed
+    log : function, optional, default=logger.info
+       The logging function to use.
+
+    """
+    nstates = len(Tij)
+
+    # Print observed transition probabilities.
+    log("Cumulative symmetrized state mixing transition matrix:")
+    log("%6s" % "" + "".join("%6d" % jstate for jstate in range(nstates)))
     for istate in range(nstates):
-        str_row = ""
-        str_row += "%-6d" % istate
-        for jstate in range(nstates):
-            P = Tij[istate,jstate]
+        str_row = "%-6d" % istate
+        for P in Tij[istate]:
             if (P >= cutoff):
                 str_row += "%6.3f" % P
             else:
                 str_row += "%6s" % ""
-        logger.info(str_row)
+        log(str_row)
 
     # Estimate second eigenvalue and equilibration time.
-    mu = np.linalg.eigvals(Tij)
-    mu = -np.sort(-mu) # sort in descending order
-    if (mu[1] >= 1):
-        logger.info("Perron eigenvalue is unity; Markov chain is decomposable.")
+    mu, relaxation_time = compute_relaxation_time(Tij)
+    if np.isinf(relaxation_time):
+        log("Perron eigenvalue is unity; Markov chain is decomposable.")
     else:
-        logger.info("Perron eigenvalue is %9.5f; state equilibration timescale is ~ %.1f iterations" % (mu[1], 1.0 / (1.0 - mu[1])))
+        log("Perron eigenvalue is %9.5f; state equilibration timescale is ~ %.1f iterations" % (mu, relaxation_time))
+
+
+def compute_mixing_statistics(ncfile, nequil=0):
+    """
+    Compute the state mixing transition matrix and the equilibration timescale.
+
+    Parameters
+    ----------
+    ncfile : netCDF4.Dataset
+       NetCDF file
+    nequil : int, optional, default=0
+       If specified, only samples nequil:end will be used in analysis
+
+    Returns
+    -------
+    Tij : numpy.array of numpy.float64
+       The cumulative symmetrized state mixing transition matrix.
+    relaxation_time : float
+       The estimated state equilibration timescale in iterations.
+
+    """
+    niterations = utils.get_committed_iterations(ncfile)
+    Nij = count_state_transitions(ncfile.variables['states'][nequil:niterations, :])
+    Tij = estimate_transition_matrix(Nij)
+    return Tij, compute_relaxation_time(Tij)[1]
+
+
+def show_mixing_statistics(ncfile, cutoff=0.05, nequil=0):
+    """
+    Print summary of mixing statistics.
 
-    return
+    Parameters
+    ----------
+
+    ncfile : netCDF4.Dataset
+       NetCDF file
+    cutoff : float, optional, default=0.05
+       Only transition probabilities above 'cutoff' will be printed
+    nequil : int, optional, default=0
+       If specified, only samples nequil:end will be used in analysis
+
+    Returns
+    -------
+    Tij : numpy.array of numpy.float64
+       The cumulative symmetrized state mixing transition matrix.
+    relaxation_time : float
+       The estimated state equilibration timescale in iterations.
+
+    """
+    Tij, relaxation_time = compute_mixing_statistics(ncfile, nequil=nequil)
+    log_mixing_statistics(Tij, cutoff=cutoff)
+    return Tij, relaxation_time
+
+
+def deconvolute_energies(ncfile, iterations=None, variable_name='energies', chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Read replica energies from the store file and sort them by thermodynamic state.
+
+    The states and energies are read in hyperslabs of chunk_size iterations,
+    and only the requested iterations are deconvoluted and kept in memory.
+
+    Parameters
+    ----------
+    ncfile : netCDF4.Dataset
+       The open store file.
+    iterations : array of int, optional, default=None
+       The indices of the iterations to deconvolute. If None, all iterations are used.
+    variable_name : str, optional, default='energies'
+       The name of the variable to deconvolute. Its first two dimensions must be
+       'iteration' and 'replica' (e.g. 'energies' or 'fully_interacting_expanded_cutoff_energies').
+    chunk_size : int, optional, default=DEFAULT_CHUNK_SIZE
+       The maximum number of iterations read at once.
 
+    Returns
+    -------
+    u_kln : numpy array of numpy.float64
+       u_kln[k,...,n] is the value of the variable at iterations[n] for the
+       replica in state k (e.g. u_kln[k,l,n] is the reduced potential of the
+       sample of state k evaluated at state l).
 
-def extract_ncfile_energies(ncfile, ndiscard=0, nuse=None, g=None):
+    """
+    states = ncfile.variables['states']
+    variable = ncfile.variables[variable_name]
+    niterations, nstates = utils.get_committed_iterations(ncfile), states.shape[1]
+    if iterations is None:
+        iterations = np.arange(niterations)
+    iterations = np.asarray(iterations, dtype=np.int64)
+
+    u_kln = np.zeros((nstates,) + variable.shape[2:] + (iterations.size,), np.float64)
+    if iterations.size == 0:
+        return u_kln
+
+    first, last = iterations.min(), iterations.max() + 1
+    for chunk_start in range(first, last, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, last)
+        selected = np.nonzero((iterations >= chunk_start) & (iterations < chunk_end))[0]
+        if selected.size == 0:
+            continue
+        rows = iterations[selected] - chunk_start
+        states_chunk = states[chunk_start:chunk_end, :][rows]
+        variable_chunk = variable[chunk_start:chunk_end][rows]
+        u_kln[states_chunk, ..., selected[:, np.newaxis]] = variable_chunk
+
+    return u_kln
+
+
+def extract_ncfile_energies(ncfile, ndiscard=0, nuse=None, g=None, u_n=None, chunk_size=DEFAULT_CHUNK_SIZE):
     """
     Extract and decorelate energies from the ncfile to gather common data for other functions
 
+    Only the effectively uncorrelated iterations are deconvoluted and kept in memory.
+
     Parameters
     ----------
     ncfile : NetCDF
@@ -125,6 +296,11 @@ def extract_ncfile_energies(ncfile, ndiscard=0, nuse=None, g=None):
        Maximum number of iterations to use (after discarding)
     g : int, optional, default=None
        Statistical inefficiency to use if desired; if None, will be computed.
+    u_n : numpy array of numpy.float64, optional, default=None
+       The trace of all iterations as returned by extract_u_n(); if None, it
+       will be extracted from the ncfile.
+    chunk_size : int, optional, default=DEFAULT_CHUNK_SIZE
+       The maximum number of iterations read at once.
 
     TODO
     ----
@@ -132,70 +308,42 @@ def extract_ncfile_energies(ncfile, ndiscard=0, nuse=None, g=None):
 
     """
     # Get current dimensions.
-    niterations = ncfile.variables['energies'].shape[0]
     nstates = ncfile.variables['energies'].shape[1]
-    natoms = ncfile.variables['energies'].shape[2]
-
-    # Extract energies.
-    logger.info("Reading energies...")
-    energies = ncfile.variables['energies']
-    u_kln_replica = np.zeros([nstates, nstates, niterations], np.float64)
-    for n in range(niterations):
-        u_kln_replica[:,:,n] = energies[n,:,:]
-    logger.info("Done.")
-
-    # Deconvolute replicas
-    logger.info("Deconvoluting replicas...")
-    u_kln = np.zeros([nstates, nstates, niterations], np.float64)
-    for iteration in range(niterations):
-        state_indices = ncfile.variables['states'][iteration,:]
-        u_kln[state_indices,:,iteration] = energies[iteration,:,:]
-    logger.info("Done.")
 
     # Compute total negative log probability over all iterations.
-    u_n = np.zeros([niterations], np.float64)
-    for iteration in range(niterations):
-        u_n[iteration] = np.sum(np.diagonal(u_kln[:,:,iteration]))
+    if u_n is None:
+        u_n = extract_u_n(ncfile, chunk_size=chunk_size)
 
     # Discard initial data to equilibration.
-    u_kln_replica = u_kln_replica[:,:,ndiscard:]
-    u_kln = u_kln[:,:,ndiscard:]
     u_n = u_n[ndiscard:]
 
     # Truncate to number of specified conforamtions to use
     if (nuse):
-        u_kln_replica = u_kln_replica[:,:,0:nuse]
-        u_kln = u_kln[:,:,0:nuse]
         u_n = u_n[0:nuse]
 
     # Subsample data to obtain uncorrelated samples
     N_k = np.zeros(nstates, np.int32)
     indices = timeseries.subsampleCorrelatedData(u_n, g=g) # indices of uncorrelated samples
-    #print(u_n) # DEBUG
-    #indices = range(0,u_n.size) # DEBUG - assume samples are uncorrelated
     N = len(indices) # number of uncorrelated samples
     N_k[:] = N
-    u_kln = u_kln[:,:,indices]
     logger.info("number of uncorrelated samples:")
     logger.info(N_k)
     logger.info("")
 
+    # Deconvolute replicas of the uncorrelated iterations only.
+    logger.info("Deconvoluting replicas...")
+    iterations = ndiscard + np.asarray(indices, dtype=np.int64)
+    u_kln = deconvolute_energies(ncfile, iterations, chunk_size=chunk_size)
+    logger.info("Done.")
+
     # Check for the expanded cutoff states, and subsamble as needed
-    try:
-        u_ln_full_raw = ncfile.variables['fully_interacting_expanded_cutoff_energies'][:].T #Its stored as nl, need in ln
-        u_ln_non_raw = ncfile.variables['noninteracting_expanded_cutoff_energies'][:].T 
-        fully_interacting_u_ln = np.zeros(u_ln_full_raw.shape)
-        noninteracting_u_ln = np.zeros(u_ln_non_raw.shape)
-        # Deconvolute the fully interacting state
-        for iteration in range(niterations):
-            state_indices = ncfile.variables['states'][iteration,:]
-            fully_interacting_u_ln[state_indices,iteration] = u_ln_full_raw[:,iteration]
-            noninteracting_u_ln[state_indices,iteration] = u_ln_non_raw[:,iteration]
-        # Discard non-equilibrated samples
-        fully_interacting_u_ln = fully_interacting_u_ln[:,ndiscard:]
-        fully_interacting_u_ln = fully_interacting_u_ln[:,indices]
-        noninteracting_u_ln = noninteracting_u_ln[:,ndiscard:]
-        noninteracting_u_ln = noninteracting_u_ln[:,indices]
+    if ('fully_interacting_expanded_cutoff_energies' in ncfile.variables and
+            'noninteracting_expanded_cutoff_energies' in ncfile.variables):
+        # Deconvolute the fully interacting and noninteracting states.
+        fully_interacting_u_ln = deconvolute_energies(ncfile, iterations, chunk_size=chunk_size,
+                                                      variable_name='fully_interacting_expanded_cutoff_energies')
+        noninteracting_u_ln = deconvolute_energies(ncfile, iterations, chunk_size=chunk_size,
+                                                   variable_name='noninteracting_expanded_cutoff_energies')
         # Augment u_kln to accept the new state
         u_kln_new = np.zeros([nstates + 2, nstates + 2, N], np.float64)
         N_k_new = np.zeros(nstates + 2, np.int32)
@@ -203,21 +351,18 @@ def extract_ncfile_energies(ncfile, ndiscard=0, nuse=None, g=None):
         u_kln_new[1:-1,0,:] = fully_interacting_u_ln
         u_kln_new[1:-1,-1,:] = noninteracting_u_ln
         # Fill in other energies
-        u_kln_new[1:-1,1:-1,:] = u_kln 
+        u_kln_new[1:-1,1:-1,:] = u_kln
         N_k_new[1:-1] = N_k
         # Notify users
         logger.info("Found expanded cutoff states in the energies!")
         logger.info("Free energies will be reported relative to them instead!")
-        # Reset values, last step in case something went wrong so we dont overwrite u_kln on accident
         u_kln = u_kln_new
         N_k = N_k_new
-    except:
-        pass
 
     return u_kln, N_k, u_n
 
 
-def initialize_MBAR(ncfile, u_kln=None, N_k=None):
+def initialize_MBAR(ncfile, u_kln=None, N_k=None, initial_f_k=None):
     """
     Initialize MBAR for Free Energy and Enthalpy estimates, this may take a while.
 
@@ -227,6 +372,8 @@ def initialize_MBAR(ncfile, u_kln=None, N_k=None):
        Reduced potential energies of the replicas; if None, will be extracted from the ncfile
     N_k : array of ints, optional, default=None
        Number of samples drawn from each kth replica; if None, will be extracted from the ncfile
+    initial_f_k : array of numpy.float64, optional, default=None
+       Initial guess of the dimensionless free energies (e.g. from a previous analysis)
 
     TODO
     ----
@@ -239,11 +386,18 @@ def initialize_MBAR(ncfile, u_kln=None, N_k=None):
 
     # Initialize MBAR (computing free energy estimates, which may take a while)
     logger.info("Computing free energy differences...")
-    mbar = MBAR(u_kln, N_k)
-    
+    mbar = MBAR(u_kln, N_k, initial_f_k=initial_f_k)
+
     return mbar
     
 
+def _log_matrix(title, matrix):
+    """Log a matrix of numbers row by row."""
+    logger.info(title)
+    for row in matrix:
+        logger.info("".join("%8.3f" % value for value in row))
+
+
 def estimate_free_energies(ncfile, mbar=None):
     """
     Estimate free energies of all alchemical states.
@@ -274,21 +428,11 @@ def estimate_free_energies(ncfile, mbar=None):
         (Deltaf_ij, dDeltaf_ij, theta_ij) = mbar.getFreeEnergyDifferences()
 
     # Matrix of free energy differences
-    logger.info("Deltaf_ij:")
-    for i in range(nstates):
-        str_row = ""
-        for j in range(nstates):
-            str_row += "%8.3f" % Deltaf_ij[i, j]
-        logger.info(str_row)
+    _log_matrix("Deltaf_ij:", Deltaf_ij)
 
     # Matrix of uncertainties in free energy difference (expectations standard
     # deviations of the estimator about the true free energy)
-    logger.info("dDeltaf_ij:")
-    for i in range(nstates):
-        str_row = ""
-        for j in range(nstates):
-            str_row += "%8.3f" % dDeltaf_ij[i, j]
-        logger.info(str_row)
+    _log_matrix("dDeltaf_ij:", dDeltaf_ij)
 
     # Return free energy differences and an estimate of the covariance.
     return Deltaf_ij, dDeltaf_ij
@@ -322,7 +466,7 @@ def estimate_enthalpies(ncfile, mbar=None):
     return H_k, dH_k
 
 
-def extract_u_n(ncfile):
+def extract_u_n(ncfile, first_iteration=0, chunk_size=DEFAULT_CHUNK_SIZE):
     """
     Extract timeseries of u_n = - log q(X_n) from store file
 
@@ -334,253 +478,2544 @@ def extract_u_n(ncfile):
 
     Parameters
     ----------
-    ncfile : str
-       The filename of the repex NetCDF file.
+    ncfile : netCDF4.Dataset
+       The open repex NetCDF file.
+    first_iteration : int, optional, default=0
+       The first iteration to extract.
+    chunk_size : int, optional, default=DEFAULT_CHUNK_SIZE
+       The maximum number of iterations read at once.
 
     Returns
     -------
     u_n : numpy array of numpy.float64
-       u_n[n] is -log q(X_n)
-
-    TODO
-    ----
-    Move this to repex.
+       u_n[n] is -log q(X_{first_iteration + n})
 
     """
 
     # Get current dimensions.
-    niterations = ncfile.variables['energies'].shape[0]
-    nstates = ncfile.variables['energies'].shape[1]
-    natoms = ncfile.variables['energies'].shape[2]
-
-    # Extract energies.
-    logger.info("Reading energies...")
-    energies = ncfile.variables['energies']
-    u_kln_replica = np.zeros([nstates, nstates, niterations], np.float64)
-    for n in range(niterations):
-        u_kln_replica[:,:,n] = energies[n,:,:]
-    logger.info("Done.")
-
-    # Deconvolute replicas
-    logger.info("Deconvoluting replicas...")
-    u_kln = np.zeros([nstates, nstates, niterations], np.float64)
-    for iteration in range(niterations):
-        state_indices = ncfile.variables['states'][iteration,:]
-        u_kln[state_indices,:,iteration] = energies[iteration,:,:]
-    logger.info("Done.")
-
-    # Compute total negative log probability over all iterations.
-    u_n = np.zeros([niterations], np.float64)
-    for iteration in range(niterations):
-        u_n[iteration] = np.sum(np.diagonal(u_kln[:,:,iteration]))
+    niterations, nstates = utils.get_committed_iterations(ncfile), ncfile.variables['states'].shape[1]
+    replicas = np.arange(nstates)
+
+    # Read states and energies in hyperslabs and pick the energy of each replica in its current state.
+    u_n = np.zeros([max(0, niterations - first_iteration)], np.float64)
+    for chunk_start in range(first_iteration, niterations, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, niterations)
+        states = ncfile.variables['states'][chunk_start:chunk_end, :]
+        energies = ncfile.variables['energies'][chunk_start:chunk_end, :, :]
+        chunk_iterations = np.arange(chunk_end - chunk_start)[:, np.newaxis]
+        u_n[chunk_start-first_iteration:chunk_end-first_iteration] = energies[chunk_iterations, replicas, states].sum(axis=1)
 
     return u_n
 
 # =============================================================================================
-# SHOW STATUS OF STORE FILES
+# EQUILIBRATION DETECTION
 # =============================================================================================
 
 
-def print_status(store_directory):
+def statistical_inefficiency(A_n, mintime=3):
     """
-    Print a quick summary of simulation progress.
+    Compute the statistical inefficiency of a timeseries from its FFT autocorrelation function.
+
+    This is the same estimator as pymbar.timeseries.statisticalInefficiency()
+    with fast=False, but the whole autocorrelation function is computed in
+    O(N log N) time.
 
     Parameters
     ----------
-    store_directory : string
-       The location of the NetCDF simulation output files.
+    A_n : numpy.array
+       A_n[n] is the n-th value of the timeseries.
+    mintime : int, optional, default=3
+       The correlation function is integrated at least up to mintime and then
+       until it first goes negative.
 
     Returns
     -------
-    success : bool
-       True is returned on success; False if some files could not be read.
+    g : float
+       The statistical inefficiency (g >= 1). If the timeseries is constant,
+       g is N + 1 as in pymbar.timeseries.detectEquilibration().
 
     """
-    # Get NetCDF files
-    phases = utils.find_phases_in_store_directory(store_directory)
+    dA_n = np.asarray(A_n, dtype=np.float64)
+    N = dA_n.size
+    dA_n = dA_n - dA_n.mean()
+    sigma2 = np.mean(dA_n**2)
+    if sigma2 == 0.0:
+        return float(N + 1)
+
+    # Unnormalized autocorrelation through a zero-padded FFT.
+    nfft = 2**int(np.ceil(np.log2(2 * N)))
+    fft_A = np.fft.rfft(dA_n, n=nfft)
+    t = np.arange(1, N - 1)
+    C_t = np.fft.irfft(fft_A * np.conjugate(fft_A), n=nfft)[t] / ((N - t) * sigma2)
+
+    # Integrate up to the first negative value after mintime.
+    negative = np.nonzero((C_t <= 0.0) & (t > mintime))[0]
+    if len(negative) > 0:
+        t, C_t = t[:negative[0]], C_t[:negative[0]]
+    g = 1.0 + 2.0 * np.sum(C_t * (1.0 - t / float(N)))
+    return max(1.0, g)
+
+
+def detect_equilibration(A_t, grid_size=EQUILIBRATION_GRID_SIZE, initial_guess=None):
+    """
+    Detect the equilibrated region of a timeseries maximizing the number of uncorrelated samples.
 
-    # Process each netcdf file.
-    for phase, fullpath in phases.items():
+    This uses the same heuristic as pymbar.timeseries.detectEquilibration(),
+    but the equilibration time t0 is searched on a coarse grid that is
+    refined around the best candidate, and the statistical inefficiency of
+    each candidate is computed with FFTs. This requires O(grid_size log(T))
+    evaluations of O(T log T) cost instead of O(T^2) for each of the T
+    candidates.
 
-        # Check that the file exists.
-        if not os.path.exists(fullpath):
-            # Report failure.
-            logger.info("File %s not found." % fullpath)
-            logger.info("Check to make sure the right directory was specified, and 'yank setup' has been run.")
-            return False
+    Parameters
+    ----------
+    A_t : numpy.array
+       The timeseries (e.g. the trace u_n of the reduced potential).
+    grid_size : int, optional, default=EQUILIBRATION_GRID_SIZE
+       The number of candidates evaluated at each refinement. If the series
+       has fewer samples, all the candidates are evaluated.
+    initial_guess : int, optional
+       An equilibration time evaluated together with the first grid (e.g.
+       the result of a previous detection on a shorter series).
 
-        # Open NetCDF file for reading.
-        logger.debug("Opening NetCDF trajectory file '%(fullpath)s' for reading..." % vars())
-        ncfile = netcdf.Dataset(fullpath, 'r')
+    Returns
+    -------
+    t0 : int
+       The start of the equilibrated data.
+    g : float
+       The statistical inefficiency of the equilibrated data.
+    Neff_max : float
+       The number of uncorrelated samples in the equilibrated data.
 
-        # Read dimensions.
-        niterations = ncfile.variables['positions'].shape[0]
-        nstates = ncfile.variables['positions'].shape[1]
-        natoms = ncfile.variables['positions'].shape[2]
+    """
+    A_t = np.asarray(A_t, dtype=np.float64)
+    T = A_t.size
+
+    # Special case if timeseries is constant.
+    if A_t.std() == 0.0:
+        return 0, 1.0, 1.0
+
+    evaluated = {}  # evaluated[t0] = (Neff, g)
+
+    def evaluate(candidates):
+        for t0 in candidates:
+            if t0 not in evaluated:
+                g = statistical_inefficiency(A_t[t0:])
+                evaluated[t0] = ((T - t0 + 1) / g, g)
+        # Break ties in favor of the shortest equilibration as pymbar does.
+        return max(candidates, key=lambda t0: (evaluated[t0][0], -t0))
+
+    lower, upper = 0, T - 2
+    extra_candidates = [initial_guess] if initial_guess is not None and 0 <= initial_guess <= upper else []
+    while True:
+        grid = np.unique(np.linspace(lower, upper, min(grid_size, upper - lower + 1)).round().astype(int))
+        grid = sorted(set(grid.tolist() + extra_candidates))
+        best = evaluate(grid)
+        if len(grid) >= upper - lower + 1:
+            break
+
+        # Refine between the grid neighbors of the best candidate.
+        best_index = grid.index(best)
+        lower = grid[max(0, best_index - 1)]
+        upper = grid[min(len(grid) - 1, best_index + 1)]
+        extra_candidates = []
+
+    t0 = evaluate(list(evaluated.keys()))
+    Neff_max, g = evaluated[t0]
+    return t0, g, Neff_max
+
+
+class EquilibrationDetector(object):
+    """
+    Detect the equilibrated region of a timeseries that grows over time.
 
-        # Print summary.
-        logger.info("%s" % phase)
-        logger.info("  %8d iterations completed" % niterations)
-        logger.info("  %8d alchemical states" % nstates)
-        logger.info("  %8d atoms" % natoms)
+    The samples are accumulated in a buffer that grows geometrically, and each
+    detection starts the coarse-to-fine search of detect_equilibration() from
+    the previous equilibration time, which rarely moves much when new samples
+    are appended.
+
+    Parameters
+    ----------
+    grid_size : int, optional, default=EQUILIBRATION_GRID_SIZE
+        The number of candidates evaluated at each refinement.
 
-        # TODO: Print average ns/day and estimated completion time.
+    Attributes
+    ----------
+    nsamples : int
+        The number of samples appended so far.
 
-        # Close file.
-        ncfile.close()
+    Examples
+    --------
+    >>> detector = EquilibrationDetector()
+    >>> detector.extend(np.arange(10.0))
+    >>> detector.nsamples
+    10
 
-    return True
+    """
+
+    def __init__(self, grid_size=EQUILIBRATION_GRID_SIZE):
+        self.grid_size = grid_size
+        self.nsamples = 0
+        self._A_t = np.zeros([0], np.float64)
+        self._result = None
+        self._result_nsamples = None
+
+    @property
+    def timeseries(self):
+        """The samples appended so far."""
+        return self._A_t[:self.nsamples]
+
+    def extend(self, A_t):
+        """
+        Append samples to the timeseries.
+
+        Parameters
+        ----------
+        A_t : numpy.array
+            The new samples.
+
+        """
+        A_t = np.atleast_1d(np.asarray(A_t, dtype=np.float64))
+        nsamples = self.nsamples + A_t.size
+        if nsamples > self._A_t.size:
+            buffer = np.zeros([max(nsamples, 2 * self._A_t.size)], np.float64)
+            buffer[:self.nsamples] = self.timeseries
+            self._A_t = buffer
+        self._A_t[self.nsamples:nsamples] = A_t
+        self.nsamples = nsamples
+
+    def detect(self):
+        """
+        Detect the equilibrated region of the samples appended so far.
+
+        Returns
+        -------
+        t0 : int
+            The start of the equilibrated data.
+        g : float
+            The statistical inefficiency of the equilibrated data.
+        Neff_max : float
+            The number of uncorrelated samples in the equilibrated data.
+
+        """
+        if self._result_nsamples != self.nsamples:
+            initial_guess = self._result[0] if self._result is not None else None
+            self._result = detect_equilibration(self.timeseries, grid_size=self.grid_size,
+                                                initial_guess=initial_guess)
+            self._result_nsamples = self.nsamples
+        return self._result
 
 # =============================================================================================
-# ANALYZE STORE FILES
+# INCREMENTAL ONLINE ANALYSIS
 # =============================================================================================
 
 
-def analyze(source_directory):
+class OnlineAnalysis(object):
     """
-    Analyze contents of store files to compute free energy differences.
+    Incremental free energy analysis of a replica-exchange simulation.
+
+    The energies of each iteration are deconvoluted on arrival and appended
+    to growable in-memory buffers, so that the trace u_n = - log q(X_n) and
+    the state-indexed reduced potentials u_kln are always available without
+    reading the store file again. MBAR solutions are warm-started from the
+    free energies of the previous estimate.
 
     Parameters
     ----------
-    source_directory : string
-       The location of the NetCDF simulation storage files.
+    nstates : int
+        The number of thermodynamic states.
+    min_iterations : int, optional, default=20
+        The minimum number of iterations needed to compute an estimate.
 
-    """
-    analysis_script_path = os.path.join(source_directory, 'analysis.yaml')
-    if not os.path.isfile(analysis_script_path):
-        err_msg = 'Cannot find analysis.yaml script in {}'.format(source_directory)
-        logger.error(err_msg)
-        raise RuntimeError(err_msg)
-    with open(analysis_script_path, 'r') as f:
-        analysis = yaml.load(f)
-    phases = [phase_name for phase_name, sign in analysis]
+    Attributes
+    ----------
+    niterations : int
+        The number of iterations appended so far.
+    f_k : numpy.array or None
+        The dimensionless free energies of the last MBAR solution.
+    analysis : dict or None
+        The last estimate computed by estimate().
+    last_estimate_iteration : int or None
+        The number of iterations used by the last estimate.
+
+    Examples
+    --------
+    >>> online_analysis = OnlineAnalysis(nstates=2, min_iterations=2)
+    >>> online_analysis.append(np.array([1, 0]), np.array([[1.0, 2.0], [1.5, 0.5]]))
+    >>> print(online_analysis.u_n[0])
+    3.5
 
-    # Storage for different phases.
-    data = dict()
+    """
 
-    # Process each netcdf file.
-    for phase in phases:
-        ncfile_path = os.path.join(source_directory, phase + '.nc')
+    def __init__(self, nstates, min_iterations=20):
+        self.nstates = nstates
+        self.min_iterations = min_iterations
+        self.niterations = 0
+        self.f_k = None
+        self.analysis = None
+        self.last_estimate_iteration = None
+        self._u_kln = np.zeros([nstates, nstates, 0], np.float64)
+        self._u_n = np.zeros([0], np.float64)
+        self._equilibration_detector = EquilibrationDetector()
+
+    @classmethod
+    def from_ncfile(cls, ncfile, min_iterations=20):
+        """
+        Create an OnlineAnalysis object containing all the iterations in the store file.
+
+        Parameters
+        ----------
+        ncfile : netCDF4.Dataset
+            The open store file.
+        min_iterations : int, optional, default=20
+            The minimum number of iterations needed to compute an estimate.
+
+        """
+        niterations, nstates = utils.get_committed_iterations(ncfile), ncfile.variables['states'].shape[1]
+        online_analysis = cls(nstates, min_iterations=min_iterations)
+        online_analysis._reserve(niterations)
+        for chunk_start in range(0, niterations, DEFAULT_CHUNK_SIZE):
+            chunk_end = min(chunk_start + DEFAULT_CHUNK_SIZE, niterations)
+            online_analysis.extend(ncfile.variables['states'][chunk_start:chunk_end, :],
+                                   ncfile.variables['energies'][chunk_start:chunk_end, :, :])
+        return online_analysis
+
+    @property
+    def u_n(self):
+        """The trace u_n[n] = - log q(X_n) of the appended iterations."""
+        return self._u_n[:self.niterations]
+
+    @property
+    def u_kln(self):
+        """u_kln[k,l,n] is the reduced potential of the sample of state k at iteration n evaluated at state l."""
+        return self._u_kln[:, :, :self.niterations]
+
+    def append(self, replica_states, u_kl):
+        """
+        Append the energies of one iteration.
+
+        Parameters
+        ----------
+        replica_states : numpy.array of int
+            replica_states[i] is the state of replica i.
+        u_kl : numpy.array
+            u_kl[i,l] is the reduced potential of replica i evaluated at state l.
+
+        """
+        self.extend(np.asarray(replica_states)[np.newaxis, :], np.asarray(u_kl)[np.newaxis, :, :])
+
+    def extend(self, replica_states, u_kl):
+        """
+        Append the energies of multiple iterations.
+
+        Parameters
+        ----------
+        replica_states : numpy.array of int
+            replica_states[n,i] is the state of replica i at iteration n.
+        u_kl : numpy.array
+            u_kl[n,i,l] is the reduced potential of replica i at iteration n evaluated at state l.
+
+        """
+        replica_states = np.asarray(replica_states)
+        u_kl = np.asarray(u_kl)
+        nnew = replica_states.shape[0]
+        self._reserve(self.niterations + nnew)
+
+        # Deconvolute replicas and compute the trace in a single vectorized pass.
+        iterations = np.arange(self.niterations, self.niterations + nnew)
+        replicas = np.arange(self.nstates)
+        self._u_kln[replica_states, :, iterations[:, np.newaxis]] = u_kl
+        self._u_n[iterations] = u_kl[np.arange(nnew)[:, np.newaxis], replicas, replica_states].sum(axis=1)
+        self._equilibration_detector.extend(self._u_n[iterations])
+        self.niterations += nnew
+
+    def _reserve(self, niterations):
+        """Make sure the buffers can hold the given number of iterations, doubling their size if needed."""
+        capacity = self._u_n.size
+        if niterations <= capacity:
+            return
+        capacity = max(niterations, 2 * capacity)
+        u_kln = np.zeros([self.nstates, self.nstates, capacity], np.float64)
+        u_kln[:, :, :self.niterations] = self.u_kln
+        u_n = np.zeros([capacity], np.float64)
+        u_n[:self.niterations] = self.u_n
+        self._u_kln, self._u_n = u_kln, u_n
+
+    def estimate(self):
+        """
+        Estimate free energies, enthalpies and entropies from the appended iterations.
+
+        Returns
+        -------
+        analysis : dict or None
+            The analysis dictionary (see ReplicaExchange.analyze() for the keys)
+            with the additional key 'Neff_max' for the effective number of
+            uncorrelated samples, or None if fewer than min_iterations
+            iterations have been appended.
+
+        """
+        if self.niterations < self.min_iterations:
+            logger.debug("Online analysis will be performed after %d iterations have elapsed." % self.min_iterations)
+            return None
+
+        # Determine optimal equilibration time, statistical inefficiency, and effectively uncorrelated sample indices.
+        u_n = self.u_n
+        [t0, g, Neff_max] = self._equilibration_detector.detect()
+        indices = t0 + np.array(timeseries.subsampleCorrelatedData(u_n[t0:], g=g))
+        N_k = indices.size * np.ones([self.nstates], np.int32)
+
+        # Next, analyze with pymbar, initializing with last estimate of free energies.
+        mbar = MBAR(self.u_kln[:, :, indices], N_k, initial_f_k=self.f_k)
+
+        # Cache current free energy estimate to save time in future MBAR solutions.
+        self.f_k = mbar.f_k
+
+        # Compute entropy and enthalpy.
+        [Delta_f_ij, dDelta_f_ij, Delta_u_ij, dDelta_u_ij, Delta_s_ij, dDelta_s_ij] = mbar.computeEntropyAndEnthalpy()
+
+        # Store analysis summary.
+        analysis = dict()
+        analysis['equilibration_end'] = t0
+        analysis['g'] = g
+        analysis['Neff_max'] = Neff_max
+        analysis['indices'] = indices
+        analysis['Delta_f_ij'] = Delta_f_ij
+        analysis['dDelta_f_ij'] = dDelta_f_ij
+        analysis['Delta_u_ij'] = Delta_u_ij
+        analysis['dDelta_u_ij'] = dDelta_u_ij
+        analysis['Delta_s_ij'] = Delta_s_ij
+        analysis['dDelta_s_ij'] = dDelta_s_ij
+        self.analysis = analysis
+        self.last_estimate_iteration = self.niterations
+
+        return analysis
 
-        # Open NetCDF file for reading.
-        logger.info("Opening NetCDF trajectory file %(ncfile_path)s for reading..." % vars())
-        try:
-            ncfile = netcdf.Dataset(ncfile_path, 'r')
+# =============================================================================================
+# NEIGHBOR BAR ESTIMATOR
+# =============================================================================================
 
-            logger.debug("dimensions:")
-            for dimension_name in ncfile.dimensions.keys():
-                logger.debug("%16s %8d" % (dimension_name, len(ncfile.dimensions[dimension_name])))
 
-            # Read dimensions.
-            niterations = ncfile.variables['positions'].shape[0]
-            nstates = ncfile.variables['positions'].shape[1]
-            logger.info("Read %(niterations)d iterations, %(nstates)d states" % vars())
+class NeighborBAR(object):
+    """
+    Fast free energy estimate from BAR between neighboring thermodynamic states.
 
-            DeltaF_restraints = 0.0
-            if 'metadata' in ncfile.groups:
-                # Read phase direction and standard state correction free energy.
-                # Yank sets correction to 0 if there are no restraints
-                DeltaF_restraints = ncfile.groups['metadata'].variables['standard_state_correction'][0]
+    The work values between each pair of adjacent states are accumulated
+    incrementally from the u_kl matrices stored at each iteration, and the
+    total free energy is the sum of the BAR estimates of each pair. This costs
+    O(K*N) for K states and N iterations, which makes it suitable for live
+    progress reports. The uncertainties of the pairs are summed in quadrature
+    and scaled by the square root of the statistical inefficiency of the
+    trace u_n to account for correlated samples. MBAR over all states remains
+    the estimator of the final analysis.
 
-            # Choose number of samples to discard to equilibration
-            MIN_ITERATIONS = 10 # minimum number of iterations to use automatic detection
-            if niterations > MIN_ITERATIONS:
-                from pymbar import timeseries
-                u_n = extract_u_n(ncfile)
-                u_n = u_n[1:] # discard initial frame of zero energies TODO: Get rid of initial frame of zero energies
-                [nequil, g_t, Neff_max] = timeseries.detectEquilibration(u_n)
-                nequil += 1 # account for initial frame of zero energies
-                logger.info([nequil, Neff_max])
-            else:
-                nequil = 1  # discard first frame
-                g_t = 1
-                Neff_max = niterations
+    Parameters
+    ----------
+    nstates : int
+        The number of thermodynamic states.
 
-            # Examine acceptance probabilities.
-            show_mixing_statistics(ncfile, cutoff=0.05, nequil=nequil)
+    Attributes
+    ----------
+    niterations : int
+        The number of iterations appended so far.
 
-            # Extract equilibrated, decorrelated energies, check for fully interacting state
-            (u_kln, N_k, u_n) = extract_ncfile_energies(ncfile, ndiscard=nequil, g=g_t)
+    Examples
+    --------
+    >>> neighbor_bar = NeighborBAR(nstates=2)
+    >>> neighbor_bar.append(np.array([1, 0]), np.array([[1.0, 2.0], [1.5, 0.5]]))
+    >>> print(neighbor_bar.w_F[0])
+    [-1.]
 
-            # Create MBAR object to use for free energy and entropy states
-            mbar = initialize_MBAR(ncfile, u_kln=u_kln, N_k=N_k)
+    """
 
-            # Estimate free energies, use fully interacting state if present
-            (Deltaf_ij, dDeltaf_ij) = estimate_free_energies(ncfile, mbar=mbar)
+    def __init__(self, nstates):
+        self.nstates = nstates
+        self.niterations = 0
+        self._w_F = np.zeros([0, nstates - 1], np.float64)
+        self._w_R = np.zeros([0, nstates - 1], np.float64)
+        self._u_n = np.zeros([0], np.float64)
+        self._DeltaF_k = np.zeros([nstates - 1], np.float64)
+
+    @classmethod
+    def from_ncfile(cls, ncfile, first_iteration=1):
+        """
+        Create a NeighborBAR object containing the iterations in the store file.
+
+        Parameters
+        ----------
+        ncfile : netCDF4.Dataset
+            The open store file.
+        first_iteration : int, optional, default=1
+            The first iteration to read. The default skips the initial
+            frame, whose energies are zero.
+
+        """
+        niterations, nstates = utils.get_committed_iterations(ncfile), ncfile.variables['states'].shape[1]
+        neighbor_bar = cls(nstates)
+        for chunk_start in range(first_iteration, niterations, DEFAULT_CHUNK_SIZE):
+            chunk_end = min(chunk_start + DEFAULT_CHUNK_SIZE, niterations)
+            neighbor_bar.extend(ncfile.variables['states'][chunk_start:chunk_end, :],
+                                ncfile.variables['energies'][chunk_start:chunk_end, :, :])
+        return neighbor_bar
+
+    @property
+    def w_F(self):
+        """w_F[n,k] is the forward work from state k to k+1 of the sample of state k at iteration n."""
+        return self._w_F[:self.niterations]
+
+    @property
+    def w_R(self):
+        """w_R[n,k] is the reverse work from state k+1 to k of the sample of state k+1 at iteration n."""
+        return self._w_R[:self.niterations]
+
+    def append(self, replica_states, u_kl):
+        """
+        Append the energies of one iteration.
+
+        Parameters
+        ----------
+        replica_states : numpy.array of int
+            replica_states[i] is the state of replica i.
+        u_kl : numpy.array
+            u_kl[i,l] is the reduced potential of replica i evaluated at state l.
+
+        """
+        self.extend(np.asarray(replica_states)[np.newaxis, :], np.asarray(u_kl)[np.newaxis, :, :])
+
+    def extend(self, replica_states, u_kl):
+        """
+        Append the energies of multiple iterations.
+
+        Parameters
+        ----------
+        replica_states : numpy.array of int
+            replica_states[n,i] is the state of replica i at iteration n.
+        u_kl : numpy.array
+            u_kl[n,i,l] is the reduced potential of replica i at iteration n evaluated at state l.
+
+        """
+        replica_states = np.asarray(replica_states)
+        u_kl = np.asarray(u_kl)
+        nnew = replica_states.shape[0]
+        niterations = self.niterations + nnew
+        if niterations > self._u_n.size:
+            capacity = max(niterations, 2 * self._u_n.size)
+            for name in ['_w_F', '_w_R', '_u_n']:
+                buffer = np.zeros((capacity,) + getattr(self, name).shape[1:], np.float64)
+                buffer[:self.niterations] = getattr(self, name)[:self.niterations]
+                setattr(self, name, buffer)
+
+        # u_state[n,k,l] is the reduced potential of the sample of state k evaluated at state l.
+        iterations = np.arange(nnew)[:, np.newaxis]
+        states = np.arange(self.nstates)
+        u_state = u_kl[iterations, np.argsort(replica_states, axis=1), :]
+        u_kk = u_state[:, states, states]
+        self._w_F[self.niterations:niterations] = u_state[:, states[:-1], states[1:]] - u_kk[:, :-1]
+        self._w_R[self.niterations:niterations] = u_state[:, states[1:], states[:-1]] - u_kk[:, 1:]
+        self._u_n[self.niterations:niterations] = u_kk.sum(axis=1)
+        self.niterations = niterations
+
+    def estimate(self):
+        """
+        Estimate the free energy differences between all the neighboring states.
+
+        Each BAR solution is started from the previous estimate of the pair.
+
+        Returns
+        -------
+        estimate : dict or None
+            A dictionary with the total free energy difference 'DeltaF' between
+            the first and the last state and its uncertainty 'dDeltaF', the
+            free energy differences of the pairs of neighboring states
+            'DeltaF_k' and 'dDeltaF_k', and the statistical inefficiency 'g'
+            used to scale the uncertainties (all in kT). None if fewer than two
+            iterations have been appended.
+
+        """
+        if self.niterations < 2:
+            return None
+
+        g = statistical_inefficiency(self._u_n[:self.niterations])
+        DeltaF_k = np.zeros([self.nstates - 1], np.float64)
+        dDeltaF_k = np.zeros([self.nstates - 1], np.float64)
+        for k in range(self.nstates - 1):
+            DeltaF_k[k], dDeltaF_k[k] = BAR(self.w_F[:, k], self.w_R[:, k], DeltaF=self._DeltaF_k[k])
+        self._DeltaF_k = DeltaF_k
+        dDeltaF_k *= np.sqrt(g)
+
+        return dict(DeltaF=DeltaF_k.sum(), dDeltaF=np.sqrt(np.sum(dDeltaF_k**2)),
+                    DeltaF_k=DeltaF_k, dDeltaF_k=dDeltaF_k, g=g)
 
-            # Estimate average enthalpies
-            (DeltaH_i, dDeltaH_i) = estimate_enthalpies(ncfile, mbar=mbar)
+# =============================================================================================
+# ASYNCHRONOUS ONLINE ANALYSIS
+# =============================================================================================
 
-            # Accumulate free energy differences
-            entry = dict()
-            entry['DeltaF'] = Deltaf_ij[0, -1]
-            entry['dDeltaF'] = dDeltaf_ij[0, -1]
-            entry['DeltaH'] = DeltaH_i[0, -1]
-            entry['dDeltaH'] = dDeltaH_i[0, -1]
-            entry['DeltaF_restraints'] = DeltaF_restraints
-            data[phase] = entry
 
-            # Get temperatures.
-            ncvar = ncfile.groups['thermodynamic_states'].variables['temperatures']
-            temperature = ncvar[0] * units.kelvin
-            kT = kB * temperature
+def get_online_analysis_path(store_filename):
+    """
+    Return the path of the file where the asynchronous online analysis publishes its estimates.
 
-        finally:
-            ncfile.close()
+    Parameters
+    ----------
+    store_filename : str
+        The path to the NetCDF store file of the phase.
 
-    # Compute free energy and enthalpy
-    DeltaF = 0.0
-    dDeltaF = 0.0
-    DeltaH = 0.0
-    dDeltaH = 0.0
-    for phase, sign in analysis:
-        DeltaF -= sign * (data[phase]['DeltaF'] + data[phase]['DeltaF_restraints'])
-        dDeltaF += data[phase]['dDeltaF']**2
-        DeltaH -= sign * (data[phase]['DeltaH'] + data[phase]['DeltaF_restraints'])
-        dDeltaH += data[phase]['dDeltaH']**2
-    dDeltaF = np.sqrt(dDeltaF)
-    dDeltaH = np.sqrt(dDeltaH)
+    Returns
+    -------
+    online_analysis_path : str
+        The path to the JSON results file. This never has a .nc extension so
+        that it is not mistaken for a phase store file.
 
-    # Attempt to guess type of calculation
-    calculation_type = ''
-    for phase in phases:
-        if 'complex' in phase:
-            calculation_type = ' of binding'
-        elif 'solvent1' in phase:
-            calculation_type = ' of solvation'
+    """
+    return os.path.splitext(store_filename)[0] + '.online.json'
 
-    # Print energies
-    logger.info("")
-    logger.info("Free energy{}: {:16.3f} +- {:.3f} kT ({:16.3f} +- {:.3f} kcal/mol)".format(
-        calculation_type, DeltaF, dDeltaF, DeltaF * kT / units.kilocalories_per_mole,
-        dDeltaF * kT / units.kilocalories_per_mole))
-    logger.info("")
 
-    for phase in phases:
-        logger.info("DeltaG {:<25} : {:16.3f} +- {:.3f} kT".format(phase, data[phase]['DeltaF'],
-                                                                   data[phase]['dDeltaF']))
-        if data[phase]['DeltaF_restraints'] != 0.0:
-            logger.info("DeltaG {:<25} : {:25.3f} kT".format('restraint',
-                                                             data[phase]['DeltaF_restraints']))
-    logger.info("")
-    logger.info("Enthalpy{}: {:16.3f} +- {:.3f} kT ({:16.3f} +- {:.3f} kcal/mol)".format(
-        calculation_type, DeltaH, dDeltaH, DeltaH * kT / units.kilocalories_per_mole,
-        dDeltaH * kT / units.kilocalories_per_mole))
+def write_online_analysis(online_analysis_path, analysis, niterations, neighbor_bar_estimate=None):
+    """
+    Atomically publish an online analysis estimate to a JSON file.
 
+    The estimate is written to a temporary file first and then renamed, so
+    readers never see a partially written file.
 
-# ==============================================================================
-# Extract trajectory from NetCDF4 file
-# ==============================================================================
+    Parameters
+    ----------
+    online_analysis_path : str
+        The path to the JSON results file.
+    analysis : dict
+        The analysis dictionary returned by OnlineAnalysis.estimate().
+    niterations : int
+        The number of iterations used for the estimate.
+    neighbor_bar_estimate : dict, optional
+        The estimate returned by NeighborBAR.estimate() on the same iterations.
 
-def extract_trajectory(output_path, nc_path, state_index=None, replica_index=None,
-                       start_frame=0, end_frame=-1, skip_frame=1, keep_solvent=True,
-                       discard_equilibration=False, image_molecules=False):
-    """Extract phase trajectory from the NetCDF4 file.
+    """
+    Delta_f_ij = analysis['Delta_f_ij']
+    dDelta_f_ij = analysis['dDelta_f_ij']
+    results = {'iteration': int(niterations),
+               'timestamp': time.time(),
+               'equilibration_end': int(analysis['equilibration_end']),
+               'g': float(analysis['g']),
+               'Neff_max': float(analysis['Neff_max']),
+               'DeltaF': float(Delta_f_ij[0, -1]),
+               'dDeltaF': float(dDelta_f_ij[0, -1]),
+               'Delta_f_ij': np.asarray(Delta_f_ij).tolist(),
+               'dDelta_f_ij': np.asarray(dDelta_f_ij).tolist(),
+               'neighbor_bar': None}
+    if neighbor_bar_estimate is not None:
+        results['neighbor_bar'] = {'DeltaF': float(neighbor_bar_estimate['DeltaF']),
+                                   'dDeltaF': float(neighbor_bar_estimate['dDeltaF'])}
+
+    tmp_path = online_analysis_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(results, f)
+    os.rename(tmp_path, online_analysis_path)
+
+
+def read_online_analysis(store_filename):
+    """
+    Read the latest estimate published by the asynchronous online analysis.
 
     Parameters
     ----------
-    output_path : str
-        Path to the trajectory file to be created. The extension of the file
+    store_filename : str
+        The path to the NetCDF store file of the phase.
+
+    Returns
+    -------
+    results : dict or None
+        The latest published estimate with keys 'iteration', 'timestamp',
+        'equilibration_end', 'g', 'Neff_max', 'DeltaF', 'dDeltaF', 'Delta_f_ij',
+        'dDelta_f_ij' and 'neighbor_bar' (a dict with keys 'DeltaF' and
+        'dDeltaF' computed by NeighborBAR, or None) (free energies in kT), or
+        None if no estimate has been published yet.
+
+    """
+    online_analysis_path = get_online_analysis_path(store_filename)
+    if not os.path.isfile(online_analysis_path):
+        return None
+    with open(online_analysis_path, 'r') as f:
+        return json.load(f)
+
+
+def _run_online_analysis_worker(energies_queue, store_filename, nstates, min_iterations, interval):
+    """
+    Main loop of the asynchronous online analysis process.
+
+    Energies are received from the queue as (replica_states, u_kl) batches
+    until None is received. All the batches available in the queue are
+    consumed before estimating, so the worker never falls behind the
+    simulation by more than one MBAR solution. The neighbor BAR estimate is
+    published with each MBAR estimate.
+
+    """
+    online_analysis = OnlineAnalysis(nstates, min_iterations=min_iterations)
+    neighbor_bar = NeighborBAR(nstates)
+    online_analysis_path = get_online_analysis_path(store_filename)
+    last_estimate_iteration = None
+    stop = False
+
+    while not stop:
+        # Block for the next batch, then drain everything else that is already available.
+        batches = [energies_queue.get()]
+        while True:
+            try:
+                batches.append(energies_queue.get_nowait())
+            except queue.Empty:
+                break
+        for batch in batches:
+            if batch is None:
+                stop = True
+                break
+            # As in NeighborBAR.from_ncfile(), skip the initial frame, whose energies are zero.
+            replica_states, u_kl = batch
+            first_iteration = 1 if online_analysis.niterations == 0 else 0
+            online_analysis.extend(replica_states, u_kl)
+            neighbor_bar.extend(replica_states[first_iteration:], u_kl[first_iteration:])
+
+        niterations = online_analysis.niterations
+        if niterations < min_iterations:
+            continue
+        if (not stop and last_estimate_iteration is not None and
+                niterations - last_estimate_iteration < interval):
+            continue
+        if niterations == last_estimate_iteration:
+            continue
+
+        try:
+            analysis = online_analysis.estimate()
+            write_online_analysis(online_analysis_path, analysis, niterations, neighbor_bar.estimate())
+            last_estimate_iteration = niterations
+        except Exception as e:
+            logger.warning('Asynchronous online analysis failed at iteration {}: {}'.format(niterations, e))
+
+
+class OnlineAnalysisWorker(object):
+    """
+    Run the online analysis of a simulation in a separate process.
+
+    The simulation submits the energies of each iteration through a queue and
+    never waits for MBAR. The worker publishes its latest estimate to the file
+    returned by get_online_analysis_path(), which can be read at any time with
+    read_online_analysis().
+
+    The process is spawned rather than forked, since the simulation process
+    may hold MPI resources, an open store file and a GPU context that must not
+    be duplicated.
+
+    Parameters
+    ----------
+    store_filename : str
+        The path to the NetCDF store file of the phase.
+    nstates : int
+        The number of thermodynamic states.
+    min_iterations : int, optional, default=20
+        The minimum number of iterations needed to compute an estimate.
+    interval : int, optional, default=1
+        The minimum number of new iterations between two estimates.
+
+    Attributes
+    ----------
+    niterations : int
+        The number of iterations submitted so far.
+
+    """
+
+    def __init__(self, store_filename, nstates, min_iterations=20, interval=1):
+        try:
+            context = multiprocessing.get_context('spawn')
+        except AttributeError:  # Python 2 can only fork
+            context = multiprocessing
+        self.niterations = 0
+        self._queue = context.Queue()
+        self._process = context.Process(target=_run_online_analysis_worker,
+                                        args=(self._queue, store_filename, nstates,
+                                              min_iterations, max(1, interval)))
+        self._process.daemon = True
+        self._process.start()
+
+    @property
+    def is_alive(self):
+        """True if the worker process is running."""
+        return self._process is not None and self._process.is_alive()
+
+    @property
+    def exitcode(self):
+        """The exit code of the worker process, or None if it is running or has been stopped."""
+        return None if self._process is None else self._process.exitcode
+
+    def submit(self, replica_states, u_kl):
+        """
+        Submit the energies of one or more iterations without waiting for the analysis.
+
+        Parameters
+        ----------
+        replica_states : numpy.array of int
+            replica_states[n,i] is the state of replica i at iteration n.
+        u_kl : numpy.array
+            u_kl[n,i,l] is the reduced potential of replica i at iteration n evaluated at state l.
+
+        """
+        replica_states = np.array(replica_states)
+        self._queue.put((replica_states, np.array(u_kl)))
+        self.niterations += replica_states.shape[0]
+
+    def stop(self, timeout=None):
+        """
+        Publish a last estimate and terminate the worker process.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Maximum number of seconds to wait for the last estimate. If None,
+            wait until the worker is done.
+
+        """
+        if self._process is None:
+            return
+        self._queue.put(None)
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._process = None
+
+# =============================================================================================
+# READ-ONLY ACCESS TO STORE FILES
+# =============================================================================================
+
+
+class CommittedVariable(object):
+    """
+    Lazy read-only view of the committed iterations of a per-iteration NetCDF variable.
+
+    Indexing reads only the requested hyperslab from the store file, and the
+    iteration axis is restricted to the committed iterations.
+
+    Parameters
+    ----------
+    variable : netCDF4.Variable
+        The variable whose first dimension is 'iteration'.
+    niterations : int
+        The number of committed iterations.
+
+    """
+
+    def __init__(self, variable, niterations):
+        self._variable = variable
+        self.niterations = niterations
+
+    @property
+    def shape(self):
+        return (self.niterations,) + self._variable.shape[1:]
+
+    def __len__(self):
+        return self.niterations
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        iterations = key[0]
+        if isinstance(iterations, slice):
+            start, stop, step = iterations.indices(self.niterations)
+            iterations = slice(start, stop, step) if step > 0 else np.arange(start, stop, step)
+        else:
+            iterations = np.asarray(iterations)
+            iterations = np.where(iterations < 0, iterations + self.niterations, iterations)
+            if np.any((iterations < 0) | (iterations >= self.niterations)):
+                raise IndexError('iteration index out of range for {} committed iterations'.format(self.niterations))
+        return np.asarray(self._variable[(iterations,) + key[1:]])
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
+class PhaseReader(object):
+    """
+    Lightweight read-only handle to the store file of a phase.
+
+    The NetCDF file is opened only on first access, and only the committed
+    iterations are exposed (see utils.get_committed_iterations()), so the
+    reader is safe to use while the simulation is running. Unlike resuming a
+    ReplicaExchange object, no OpenMM object is ever created: the Systems stay
+    serialized, and options and metadata are restored as plain values.
+
+    Parameters
+    ----------
+    store_filename : str
+        The path to the NetCDF store file of the phase.
+
+    Examples
+    --------
+    >>> with PhaseReader(store_filename) as reader:  # doctest: +SKIP
+    ...     for chunk_start, states, energies in reader.iterate_chunks(['states', 'energies']):
+    ...         pass
+
+    """
+
+    def __init__(self, store_filename):
+        self.store_filename = store_filename
+        self._ncfile = None
+        self._options = None
+        self._metadata = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def ncfile(self):
+        """The store file, opened in read-only mode on first access."""
+        if self._ncfile is None:
+            self._ncfile = netcdf.Dataset(self.store_filename, 'r')
+        return self._ncfile
+
+    def close(self):
+        """Close the store file, if open."""
+        if self._ncfile is not None:
+            self._ncfile.close()
+            self._ncfile = None
+
+    @property
+    def niterations(self):
+        """The number of committed iterations, including the initial frame."""
+        return utils.get_committed_iterations(self.ncfile)
+
+    @property
+    def nstates(self):
+        return self.ncfile.variables['states'].shape[1]
+
+    @property
+    def natoms(self):
+        return self.ncfile.variables['positions'].shape[2]
+
+    def get_variable(self, variable_name):
+        """Return a lazy view of the committed iterations of a per-iteration variable."""
+        return CommittedVariable(self.ncfile.variables[variable_name], self.niterations)
+
+    @property
+    def states(self):
+        """states[n,i] is the state of replica i at iteration n."""
+        return self.get_variable('states')
+
+    @property
+    def energies(self):
+        """energies[n,i,l] is the reduced potential of replica i at iteration n evaluated at state l."""
+        return self.get_variable('energies')
+
+    def iterate_chunks(self, variable_names, first_iteration=0, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Read per-iteration variables in hyperslabs of committed iterations.
+
+        Parameters
+        ----------
+        variable_names : list of str
+            The names of the variables to read (e.g. ['states', 'energies']).
+        first_iteration : int, optional, default=0
+            The first iteration to read.
+        chunk_size : int, optional, default=DEFAULT_CHUNK_SIZE
+            The maximum number of iterations read at once.
+
+        Yields
+        ------
+        chunk : tuple
+            The first iteration of the chunk followed by the chunk of each variable.
+
+        """
+        niterations = self.niterations
+        variables = [self.ncfile.variables[variable_name] for variable_name in variable_names]
+        for chunk_start in range(first_iteration, niterations, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, niterations)
+            yield (chunk_start,) + tuple(variable[chunk_start:chunk_end] for variable in variables)
+
+    @property
+    def options(self):
+        """The run parameters stored in the file as a dict (empty if there are none)."""
+        if self._options is None:
+            from .repex import ReplicaExchange
+            self._options = dict()
+            if 'options' in self.ncfile.groups:
+                self._options = ReplicaExchange._restore_dict_from_netcdf(self.ncfile.groups['options'])
+        return self._options
+
+    @property
+    def metadata(self):
+        """The metadata stored in the file as a dict, or None if there is no metadata."""
+        if self._metadata is None and 'metadata' in self.ncfile.groups:
+            from .repex import ReplicaExchange
+            self._metadata = ReplicaExchange._restore_dict_from_netcdf(self.ncfile.groups['metadata'])
+        return self._metadata
+
+    def status(self):
+        """
+        Return a dict of useful information about the simulation progress.
+
+        Returns
+        -------
+        status : dict
+            The 'number_of_iterations' committed, 'nstates' and 'natoms'.
+
+        """
+        return dict(number_of_iterations=self.niterations, nstates=self.nstates, natoms=self.natoms)
+
+    def analyze(self):
+        """
+        Estimate the free energies of the phase without resuming the simulation.
+
+        Returns
+        -------
+        analysis : dict or None
+            The analysis dictionary returned by ReplicaExchange.analyze(), or
+            None if there are fewer iterations than the online analysis needs.
+
+        """
+        from .repex import ReplicaExchange
+        min_iterations = self.options.get('online_analysis_min_iterations',
+                                          ReplicaExchange.default_parameters['online_analysis_min_iterations'])
+        return OnlineAnalysis.from_ncfile(self.ncfile, min_iterations=min_iterations).estimate()
+
+# =============================================================================================
+# PROGRESS REPORTS
+# =============================================================================================
+
+
+def get_progress_path(store_filename):
+    """
+    Return the path of the file where the simulation publishes its progress.
+
+    Parameters
+    ----------
+    store_filename : str
+        The path to the NetCDF store file of the phase.
+
+    Returns
+    -------
+    progress_path : str
+        The path to the JSON progress file. This never has a .nc extension so
+        that it is not mistaken for a phase store file.
+
+    """
+    return os.path.splitext(store_filename)[0] + '.progress.json'
+
+
+def write_progress(store_filename, progress):
+    """
+    Atomically publish the progress of a simulation to its JSON progress file.
+
+    Parameters
+    ----------
+    store_filename : str
+        The path to the NetCDF store file of the phase.
+    progress : dict
+        The progress report (see read_progress() for the keys).
+
+    """
+    progress_path = get_progress_path(store_filename)
+    tmp_path = progress_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(progress, f)
+    os.rename(tmp_path, progress_path)
+
+
+def read_progress(store_filename):
+    """
+    Read the latest progress report published by a simulation.
+
+    Parameters
+    ----------
+    store_filename : str
+        The path to the NetCDF store file of the phase.
+
+    Returns
+    -------
+    progress : dict or None
+        The latest report with keys 'iteration' (the number of completed
+        iterations), 'number_of_iterations' (the total number of iterations
+        to run), 'nstates', 'natoms', 'timestamp', 'iteration_time' (the
+        average wall clock time of the last iterations in seconds),
+        'ns_per_day', 'acceptance' (the fraction of accepted replica swaps),
+        'converged_iteration', 'online_estimate' (a dict with keys
+        'iteration', 'DeltaF', 'dDeltaF' and 'Neff_max' in kT, or None) and
+        'neighbor_bar_estimate' (a dict with keys 'iteration', 'DeltaF' and
+        'dDeltaF' in kT published by the asynchronous online analysis, or
+        None), or None if no report has been published yet.
+
+    """
+    progress_path = get_progress_path(store_filename)
+    if not os.path.isfile(progress_path):
+        return None
+    with open(progress_path, 'r') as f:
+        return json.load(f)
+
+# =============================================================================================
+# SHOW STATUS OF STORE FILES
+# =============================================================================================
+
+
+def _print_progress(phase, progress):
+    """Print the progress report of a phase, with its throughput and estimated completion time."""
+    logger.info("%s" % phase)
+    logger.info("  %8d / %d iterations completed" % (progress['iteration'], progress['number_of_iterations']))
+    logger.info("  %8d alchemical states" % progress['nstates'])
+    logger.info("  %8d atoms" % progress['natoms'])
+    logger.info("  %8.3f s/iteration, %.2f ns/day, %.1f%% of replica swaps accepted" %
+                (progress['iteration_time'], progress['ns_per_day'], 100 * progress['acceptance']))
+
+    remaining_iterations = progress['number_of_iterations'] - progress['iteration']
+    if progress['converged_iteration'] is not None:
+        logger.info("  converged at iteration %d" % progress['converged_iteration'])
+    elif remaining_iterations > 0:
+        remaining_time = remaining_iterations * progress['iteration_time']
+        logger.info("  estimated completion in %s, at %s (last update at %s)" %
+                    (str(datetime.timedelta(seconds=round(remaining_time))),
+                     time.ctime(progress['timestamp'] + remaining_time), time.ctime(progress['timestamp'])))
+
+    online_estimate = progress['online_estimate']
+    if online_estimate is not None:
+        logger.info("  online estimate at iteration %d: DeltaF = %.3f +- %.3f kT (Neff = %.1f)" %
+                    (online_estimate['iteration'], online_estimate['DeltaF'], online_estimate['dDeltaF'],
+                     online_estimate['Neff_max']))
+
+    # Progress files written by previous versions have no neighbor BAR estimate.
+    neighbor_bar_estimate = progress.get('neighbor_bar_estimate', None)
+    if neighbor_bar_estimate is not None:
+        logger.info("  neighbor BAR estimate at iteration %d: DeltaF = %.3f +- %.3f kT" %
+                    (neighbor_bar_estimate['iteration'], neighbor_bar_estimate['DeltaF'],
+                     neighbor_bar_estimate['dDeltaF']))
+
+
+def print_status(store_directory):
+    """
+    Print a quick summary of simulation progress.
+
+    Only the progress files published by the simulations are read. The
+    NetCDF files are opened only for the phases without a progress file
+    (e.g. created by older versions or not run yet).
+
+    Parameters
+    ----------
+    store_directory : string
+       The location of the NetCDF simulation output files.
+
+    Returns
+    -------
+    success : bool
+       True is returned on success; False if some files could not be read.
+
+    """
+    # Get NetCDF files
+    phases = utils.find_phases_in_store_directory(store_directory)
+
+    # Process each netcdf file.
+    for phase, fullpath in phases.items():
+
+        # Print the progress report published by the simulation, if any.
+        progress = read_progress(fullpath)
+        if progress is not None:
+            _print_progress(phase, progress)
+            continue
+
+        # Check that the file exists.
+        if not os.path.exists(fullpath):
+            # Report failure.
+            logger.info("File %s not found." % fullpath)
+            logger.info("Check to make sure the right directory was specified, and 'yank setup' has been run.")
+            return False
+
+        # Open NetCDF file for reading.
+        logger.debug("Opening NetCDF trajectory file '%(fullpath)s' for reading..." % vars())
+        reader = PhaseReader(fullpath)
+
+        # Read dimensions.
+        niterations = reader.niterations
+        nstates = reader.nstates
+        natoms = reader.natoms
+
+        # Print summary.
+        logger.info("%s" % phase)
+        logger.info("  %8d iterations completed" % niterations)
+        logger.info("  %8d alchemical states" % nstates)
+        logger.info("  %8d atoms" % natoms)
+
+        # Print the latest estimate of the asynchronous online analysis, if any.
+        online_analysis = read_online_analysis(fullpath)
+        if online_analysis is not None:
+            logger.info("  online estimate at iteration %d: DeltaF = %.3f +- %.3f kT (g = %.1f, Neff = %.1f)" %
+                        (online_analysis['iteration'], online_analysis['DeltaF'], online_analysis['dDeltaF'],
+                         online_analysis['g'], online_analysis['Neff_max']))
+
+        # Print a quick estimate from BAR between neighboring states.
+        if niterations > 2:
+            neighbor_bar_estimate = NeighborBAR.from_ncfile(reader.ncfile).estimate()
+            logger.info("  neighbor BAR estimate at iteration %d: DeltaF = %.3f +- %.3f kT" %
+                        (niterations - 1, neighbor_bar_estimate['DeltaF'], neighbor_bar_estimate['dDeltaF']))
+
+        # Close file.
+        reader.close()
+
+    return True
+
+# =============================================================================================
+# PERFORMANCE TIMINGS
+# =============================================================================================
+
+# Steps of an iteration whose wall clock times add up to the iteration time
+# (minus small overheads), and timings measuring parts of these steps.
+TIMINGS_STEPS = ['mixing', 'propagation', 'energies', 'io']
+TIMINGS_DETAILS = ['propagate', 'mc_moves', 'synchronization', 'barrier_wait', 'sync']
+
+
+def compute_timings_summary(store_filename, first_iteration=0):
+    """
+    Summarize where the wall clock time of a simulation goes.
+
+    The timings recorded by the simulation in the 'timings' group of the
+    store file are read for all the committed iterations. Iterations without
+    timings (e.g. the initial frame, or iterations run with older versions)
+    are ignored.
+
+    Parameters
+    ----------
+    store_filename : str
+        The path to the NetCDF store file of the phase.
+    first_iteration : int, optional, default=0
+        The timings of the iterations before this one are ignored (e.g. to
+        discard the creation of the Contexts in the first iteration).
+
+    Returns
+    -------
+    summary : dict or None
+        None if no iteration was timed. Otherwise, 'niterations' is the number
+        of timed iterations and 'total_time' their total wall clock time.
+        'steps' and 'details' map the name of each timing in TIMINGS_STEPS
+        (plus 'other' for the rest of the iteration time) and TIMINGS_DETAILS
+        to a dict with its 'total' and 'mean' time per iteration in seconds
+        and its 'fraction' of the total time. Per-replica timings are summed
+        over replicas, which run concurrently with MPI. 'replica_propagate'
+        is the mean time per iteration spent integrating each replica, and
+        'rank_propagation' and 'rank_barrier_wait' are the mean times per
+        iteration spent propagating and waiting by each MPI node (None if
+        the simulation did not run with MPI).
+
+    """
+    with PhaseReader(store_filename) as reader:
+        niterations = reader.niterations
+        if 'timings' not in reader.ncfile.groups:
+            return None
+        ncvars_timings = reader.ncfile.groups['timings'].variables
+
+        iteration_times = ncvars_timings['iteration'][:niterations]
+        timed_iterations = ~np.ma.getmaskarray(iteration_times)
+        timed_iterations[:first_iteration] = False
+        if not timed_iterations.any():
+            return None
+
+        # Read the timed iterations of all timings, missing values count as 0.
+        timings = dict()
+        for name, ncvar_timing in ncvars_timings.items():
+            timing = ncvar_timing[:niterations][timed_iterations]
+            timings[name] = np.ma.filled(timing.astype(np.float64), 0.0)
+
+    def summarize(timing):
+        total = float(timing.sum())
+        return dict(total=total, mean=total / len(timing), fraction=total / total_time)
+
+    total_time = float(timings['iteration'].sum())
+    summary = dict(niterations=int(timed_iterations.sum()), total_time=total_time)
+
+    # Break down the iteration time into its steps.
+    summary['steps'] = collections.OrderedDict()
+    other = timings['iteration'].copy()
+    for name in TIMINGS_STEPS:
+        if name in timings:
+            summary['steps'][name] = summarize(timings[name])
+            other -= timings[name]
+    summary['steps']['other'] = summarize(other)
+
+    summary['details'] = collections.OrderedDict()
+    for name in TIMINGS_DETAILS:
+        if name in timings:
+            timing = timings[name]
+            summary['details'][name] = summarize(timing.sum(axis=1) if timing.ndim > 1 else timing)
+
+    summary['replica_propagate'] = timings['propagate'].mean(axis=0) if 'propagate' in timings else None
+    for name in ['rank_propagation', 'rank_barrier_wait']:
+        summary[name] = timings[name].mean(axis=0) if name in timings else None
+
+    return summary
+
+
+def print_timings(store_filename):
+    """
+    Print a report of where the wall clock time of a simulation goes.
+
+    Parameters
+    ----------
+    store_filename : str
+        The path to the NetCDF store file of the phase.
+
+    Returns
+    -------
+    summary : dict or None
+        The summary returned by compute_timings_summary().
+
+    """
+    summary = compute_timings_summary(store_filename)
+    if summary is None:
+        logger.info("No timings recorded in %s." % store_filename)
+        return None
+
+    logger.info("Timings of %d iterations (%.3f s/iteration, total %s)" %
+                (summary['niterations'], summary['total_time'] / summary['niterations'],
+                 str(datetime.timedelta(seconds=round(summary['total_time'])))))
+    for name, timing in list(summary['steps'].items()) + list(summary['details'].items()):
+        if name == TIMINGS_DETAILS[0]:
+            logger.info("  of which:")
+        logger.info("  %-16s %10.3f s/iteration %6.1f%%" % (name, timing['mean'], 100 * timing['fraction']))
+
+    replica_propagate = summary['replica_propagate']
+    if replica_propagate is not None:
+        logger.info("  replica propagation: mean %.3f s, fastest %.3f s (replica %d), slowest %.3f s (replica %d)" %
+                    (replica_propagate.mean(), replica_propagate.min(), replica_propagate.argmin(),
+                     replica_propagate.max(), replica_propagate.argmax()))
+
+    rank_propagation = summary['rank_propagation']
+    if rank_propagation is not None:
+        rank_barrier_wait = summary['rank_barrier_wait']
+        for rank in range(len(rank_propagation)):
+            logger.info("  rank %4d: propagation %.3f s/iteration, barrier wait %.3f s/iteration" %
+                        (rank, rank_propagation[rank], rank_barrier_wait[rank]))
+        logger.info("  load imbalance (slowest / mean rank propagation): %.2f" %
+                    (rank_propagation.max() / rank_propagation.mean()))
+
+    return summary
+
+# =============================================================================================
+# ANALYZE STORE FILES
+# =============================================================================================
+
+
+# Energies shared by the MBAR worker processes, set by _initialize_mbar_worker().
+_mbar_worker_data = None
+
+
+def _initialize_mbar_worker(u_kln, N_k, f_k):
+    """Store the decorrelated energies and the full-data free energies in the worker process."""
+    global _mbar_worker_data
+    _mbar_worker_data = (u_kln, N_k, f_k)
+
+
+def _map_mbar_tasks(function, tasks, u_kln, N_k, f_k, n_processes):
+    """Map tasks reading the energies shared with _initialize_mbar_worker() over a process pool."""
+    if n_processes == 1:
+        _initialize_mbar_worker(u_kln, N_k, f_k)
+        return [function(task) for task in tasks]
+    pool = multiprocessing.Pool(n_processes, initializer=_initialize_mbar_worker, initargs=(u_kln, N_k, f_k))
+    try:
+        return pool.map(function, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _compute_bootstrap_replicates(indices_batch):
+    """Solve MBAR for a batch of resampled iterations and return the DeltaF between the end states."""
+    u_kln, N_k, f_k = _mbar_worker_data
+    DeltaF = np.zeros([len(indices_batch)], np.float64)
+    for replicate, indices in enumerate(indices_batch):
+        mbar = MBAR(u_kln[:, :, indices], N_k, initial_f_k=f_k, verbose=False)
+        DeltaF[replicate] = mbar.f_k[-1] - mbar.f_k[0]
+    return DeltaF
+
+
+def bootstrap_free_energy(u_kln, N_k=None, f_k=None, nbootstraps=200, block_size=1, seed=0,
+                          confidence_level=0.95, n_processes=None):
+    """
+    Estimate the distribution of the free energy difference between the end states by bootstrap.
+
+    The iterations are resampled with replacement in blocks of block_size
+    consecutive iterations, keeping together the samples of all the states
+    from the same iteration, and MBAR is solved for each replicate starting
+    from the free energies of the full data. All the resampled indices are
+    drawn upfront from a generator with the given seed, so the result does
+    not depend on the number of processes.
+
+    Parameters
+    ----------
+    u_kln : numpy.array
+       u_kln[k,l,n] is the reduced potential of the decorrelated sample n of
+       state k evaluated at state l, as returned by extract_ncfile_energies().
+    N_k : numpy.array of int, optional
+       The number of samples of each state as returned by extract_ncfile_energies().
+       States without samples (e.g. the expanded cutoff states) have N_k = 0.
+       Default is that all states are sampled at all iterations.
+    f_k : numpy.array, optional
+       The MBAR free energies of the full data used to initialize each solution.
+    nbootstraps : int, optional, default=200
+       The number of bootstrap replicates.
+    block_size : int, optional, default=1
+       The number of consecutive iterations resampled together.
+    seed : int, optional, default=0
+       The seed of the random number generator.
+    confidence_level : float, optional, default=0.95
+       The probability mass in the confidence interval.
+    n_processes : int, optional
+       The number of processes solving the replicates. If 1, the replicates
+       are solved in this process. Default is the number of CPUs.
+
+    Returns
+    -------
+    bootstrap : dict
+       A dictionary with the bootstrap replicates 'DeltaF_samples', their
+       standard deviation 'dDeltaF' and the 'confidence_interval' (lower and
+       upper bound) of the free energy difference in kT.
+
+    """
+    niterations = u_kln.shape[2]
+    if N_k is None:
+        N_k = niterations * np.ones([u_kln.shape[0]], np.int32)
+
+    # Resample blocks of iterations with replacement.
+    random_state = np.random.RandomState(seed)
+    block_size = max(1, min(block_size, niterations))
+    nblocks = int(np.ceil(niterations / float(block_size)))
+    block_starts = random_state.randint(niterations - block_size + 1, size=(nbootstraps, nblocks))
+    indices = (block_starts[:, :, np.newaxis] + np.arange(block_size)).reshape(nbootstraps, -1)[:, :niterations]
+
+    nbatches = min(nbootstraps, 4 * (n_processes or multiprocessing.cpu_count()))
+    DeltaF_samples = np.concatenate(_map_mbar_tasks(_compute_bootstrap_replicates, np.array_split(indices, nbatches),
+                                                    u_kln, N_k, f_k, n_processes))
+
+    tail = 50.0 * (1.0 - confidence_level)
+    confidence_interval = np.percentile(DeltaF_samples, [tail, 100.0 - tail])
+    return dict(DeltaF_samples=DeltaF_samples, dDeltaF=DeltaF_samples.std(ddof=1),
+                confidence_interval=confidence_interval)
+
+
+def _compute_convergence_segment(sample_ranges):
+    """Solve MBAR for a sequence of ranges of samples, initializing each solution with the previous one."""
+    u_kln, N_k, f_k = _mbar_worker_data
+    estimates = []
+    for start, end in sample_ranges:
+        mbar = MBAR(u_kln[:, :, start:end], np.where(N_k > 0, end - start, 0), initial_f_k=f_k, verbose=False)
+        f_k = mbar.f_k
+        Deltaf_ij, dDeltaf_ij = mbar.getFreeEnergyDifferences()[:2]
+        estimates.append((Deltaf_ij[0, -1], dDeltaf_ij[0, -1]))
+    return estimates
+
+
+def compute_convergence(u_kln, N_k=None, f_k=None, npoints=10, nsigma=2.0, n_processes=None):
+    """
+    Compute the free energy difference as a function of the simulation length, forward and reverse.
+
+    MBAR is solved on a grid of prefixes (forward) and suffixes (reverse) of
+    the same decorrelated energies. The grid is split into segments that are
+    solved in parallel; within a segment, the points are solved from the
+    longest to the shortest and each solution is initialized with the free
+    energies of the previous point (the first from the full-data f_k).
+
+    Parameters
+    ----------
+    u_kln : numpy.array
+       u_kln[k,l,n] is the reduced potential of the decorrelated sample n of
+       state k evaluated at state l, as returned by extract_ncfile_energies().
+    N_k : numpy.array of int, optional
+       The number of samples of each state as returned by extract_ncfile_energies().
+       Default is that all states are sampled at all iterations.
+    f_k : numpy.array, optional
+       The MBAR free energies of the full data.
+    npoints : int, optional, default=10
+       The number of fractions of the data in the grid.
+    nsigma : float, optional, default=2.0
+       The number of standard deviations within which forward and reverse
+       estimates must agree to be considered stable.
+    n_processes : int, optional
+       The number of processes solving the grid. If 1, the grid is solved in
+       this process. Default is the number of CPUs.
+
+    Returns
+    -------
+    convergence : dict
+       A dictionary with the grid of data 'fractions', the number of samples
+       'nsamples', the 'DeltaF_forward', 'dDeltaF_forward', 'DeltaF_reverse'
+       and 'dDeltaF_reverse' estimates in kT, and 'stable_fraction', the
+       smallest fraction from which forward and reverse estimates agree at
+       all longer lengths (None if they agree only on the full data).
+
+    """
+    nsamples_total = u_kln.shape[2]
+    if N_k is None:
+        N_k = nsamples_total * np.ones([u_kln.shape[0]], np.int32)
+    nsamples = np.unique(np.ceil(np.arange(1, npoints + 1) * nsamples_total / float(npoints)).astype(int))
+    nsamples = nsamples[nsamples > 1]
+
+    # Split the longest-to-shortest grid of each direction in contiguous segments.
+    descending = nsamples[::-1]
+    nsegments = max(1, min(len(descending), int(np.ceil((n_processes or multiprocessing.cpu_count()) / 2.0))))
+    tasks = []
+    for segment in np.array_split(descending, nsegments):
+        tasks.append([(0, n) for n in segment])
+    for segment in np.array_split(descending, nsegments):
+        tasks.append([(nsamples_total - n, nsamples_total) for n in segment])
+
+    estimates = _map_mbar_tasks(_compute_convergence_segment, tasks, u_kln, np.asarray(N_k), f_k, n_processes)
+    forward = np.array(sum(estimates[:nsegments], []))[::-1]
+    reverse = np.array(sum(estimates[nsegments:], []))[::-1]
+
+    # Find the length from which forward and reverse estimates agree.
+    agree = np.abs(forward[:, 0] - reverse[:, 0]) <= nsigma * np.sqrt(forward[:, 1]**2 + reverse[:, 1]**2)
+    disagree = np.nonzero(~agree)[0]
+    stable_index = disagree[-1] + 1 if len(disagree) > 0 else 0
+    stable_fraction = nsamples[stable_index] / float(nsamples_total) if stable_index < len(nsamples) - 1 else None
+
+    return dict(fractions=nsamples / float(nsamples_total), nsamples=nsamples,
+                DeltaF_forward=forward[:, 0], dDeltaF_forward=forward[:, 1],
+                DeltaF_reverse=reverse[:, 0], dDeltaF_reverse=reverse[:, 1],
+                stable_fraction=stable_fraction)
+
+
+def analyze_convergence(ncfile_path, table_path=None, npoints=10, nsigma=2.0, n_processes=None):
+    """
+    Compute the forward and reverse convergence of the free energy of a phase.
+
+    The phase is first analyzed with analyze_phase(), whose cache provides the
+    equilibration time, the statistical inefficiency and the free energies
+    used to extract the decorrelated energies and initialize MBAR.
+
+    Parameters
+    ----------
+    ncfile_path : str
+       The path to the NetCDF store file of the phase.
+    table_path : str, optional
+       If given, the path to the CSV table of the forward and reverse estimates
+       to create.
+    npoints : int, optional, default=10
+       The number of fractions of the data in the grid.
+    nsigma : float, optional, default=2.0
+       The number of standard deviations within which forward and reverse
+       estimates must agree to be considered stable.
+    n_processes : int, optional
+       The number of processes solving the grid.
+
+    Returns
+    -------
+    convergence : dict
+       The dictionary returned by compute_convergence().
+
+    """
+    analyze_phase(ncfile_path)
+    ncfile = netcdf.Dataset(ncfile_path, 'r')
+    try:
+        cache = _read_analysis_cache(get_analysis_cache_path(ncfile_path), _get_store_identity(ncfile))
+        (u_kln, N_k, u_n) = extract_ncfile_energies(ncfile, ndiscard=int(cache['nequil']),
+                                                    g=float(cache['g_t']), u_n=cache['u_n'])
+    finally:
+        ncfile.close()
+
+    logger.info("Computing forward and reverse estimates at %d fractions of the data..." % npoints)
+    convergence = compute_convergence(u_kln, N_k=N_k, f_k=cache['f_k'], npoints=npoints, nsigma=nsigma,
+                                      n_processes=n_processes)
+
+    fields = ['fraction', 'nsamples', 'DeltaF_forward', 'dDeltaF_forward', 'DeltaF_reverse', 'dDeltaF_reverse']
+    rows = zip(convergence['fractions'], convergence['nsamples'], convergence['DeltaF_forward'],
+               convergence['dDeltaF_forward'], convergence['DeltaF_reverse'], convergence['dDeltaF_reverse'])
+    logger.info("%8s %8s %22s %22s" % ('fraction', 'nsamples', 'forward (kT)', 'reverse (kT)'))
+    rows = list(rows)
+    for row in rows:
+        logger.info("%8.2f %8d %12.3f +- %6.3f %12.3f +- %6.3f" % row)
+    if convergence['stable_fraction'] is None:
+        logger.info("Forward and reverse estimates do not agree yet.")
+    else:
+        logger.info("Forward and reverse estimates agree from %.0f%% of the equilibrated data." %
+                    (100 * convergence['stable_fraction']))
+
+    if table_path is not None:
+        with open(table_path, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(fields)
+            writer.writerows(rows)
+    return convergence
+
+
+def get_analysis_cache_path(store_filename):
+    """
+    Return the path of the file caching the analysis of a phase.
+
+    Parameters
+    ----------
+    store_filename : str
+        The path to the NetCDF store file of the phase.
+
+    Returns
+    -------
+    analysis_cache_path : str
+        The path to the cache file. This never has a .nc extension so that it
+        is not mistaken for a phase store file.
+
+    """
+    return os.path.splitext(store_filename)[0] + '.analysis.npz'
+
+
+def _get_store_identity(ncfile):
+    """Return a hash identifying the simulation of a store file from its first stored energies."""
+    energies = ncfile.variables['energies']
+    first_energies = np.array(energies[:min(2, utils.get_committed_iterations(ncfile))], dtype=np.float64)
+    return hashlib.sha1(first_energies.tobytes()).hexdigest()
+
+
+def _read_analysis_cache(analysis_cache_path, identity):
+    """Return the content of an analysis npz file, or None if there is no valid file for the simulation."""
+    if not os.path.isfile(analysis_cache_path):
+        return None
+    try:
+        with np.load(analysis_cache_path) as npz_file:
+            cache = {key: npz_file[key] for key in npz_file.files}
+    except Exception as e:
+        logger.warning('Cannot read {}: {}'.format(analysis_cache_path, e))
+        return None
+    if 'identity' not in cache or str(cache['identity']) != identity:
+        logger.info('{} belongs to a different simulation.'.format(analysis_cache_path))
+        return None
+    return cache
+
+
+def _write_analysis_cache(analysis_cache_path, cache):
+    """Atomically write the analysis cache."""
+    tmp_path = analysis_cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **cache)
+    os.rename(tmp_path, analysis_cache_path)
+
+
+def get_decorrelated_iterations(store_filename):
+    """
+    Return the equilibrated, decorrelated iterations used by the cached analysis of a phase.
+
+    Parameters
+    ----------
+    store_filename : str
+        The path to the NetCDF store file of the phase. The phase must have
+        been analyzed with analyze_phase() with the cache enabled.
+
+    Returns
+    -------
+    iterations : numpy.array of int
+        The iterations of the decorrelated samples.
+
+    """
+    ncfile = netcdf.Dataset(store_filename, 'r')
+    try:
+        cache = _read_analysis_cache(get_analysis_cache_path(store_filename), _get_store_identity(ncfile))
+    finally:
+        ncfile.close()
+    if cache is None:
+        raise RuntimeError('Cannot find the analysis cache of {}'.format(store_filename))
+    nequil = int(cache['nequil'])
+    indices = timeseries.subsampleCorrelatedData(cache['u_n'][nequil:], g=float(cache['g_t']))
+    return nequil + np.asarray(indices, dtype=np.int64)
+
+
+def get_reevaluated_energies_path(store_filename):
+    """
+    Return the path of the file storing the energies re-evaluated in new states.
+
+    Parameters
+    ----------
+    store_filename : str
+        The path to the NetCDF store file of the phase.
+
+    Returns
+    -------
+    reevaluated_energies_path : str
+        The path to the npz file written by reevaluation.reevaluate_energies().
+
+    """
+    return os.path.splitext(store_filename)[0] + '.reevaluated.npz'
+
+
+def write_reevaluated_energies(store_filename, reevaluated_energies):
+    """
+    Atomically save the energies of the stored configurations re-evaluated in new states.
+
+    Parameters
+    ----------
+    store_filename : str
+        The path to the NetCDF store file of the phase.
+    reevaluated_energies : dict
+        The 'iterations', the 'states' of the replicas at those iterations and
+        the 'energies' u_kl[n,i,l] of replica i at iteration n in the new
+        state l, plus any other array to save.
+
+    """
+    ncfile = netcdf.Dataset(store_filename, 'r')
+    try:
+        identity = _get_store_identity(ncfile)
+    finally:
+        ncfile.close()
+    reevaluated_energies = dict(reevaluated_energies, identity=identity)
+    _write_analysis_cache(get_reevaluated_energies_path(store_filename), reevaluated_energies)
+
+
+def _analyze_reevaluated_energies(ncfile, reevaluated_energies):
+    """
+    Estimate the free energies of the re-evaluated states relative to the first state of the phase.
+
+    The samples of the re-evaluated iterations are deconvoluted and the new
+    states are added to MBAR as unsampled states.
+
+    """
+    iterations = reevaluated_energies['iterations']
+    states = reevaluated_energies['states']
+    new_u_kl = reevaluated_energies['energies']
+    niterations, nreplicas, nnew = new_u_kl.shape
+
+    u_kln = np.zeros([nreplicas + nnew, nreplicas + nnew, niterations], np.float64)
+    u_kln[:nreplicas, :nreplicas, :] = deconvolute_energies(ncfile, iterations)
+    u_kln[states, nreplicas:, np.arange(niterations)[:, np.newaxis]] = new_u_kl
+    N_k = np.array([niterations] * nreplicas + [0] * nnew, np.int32)
+
+    mbar = MBAR(u_kln, N_k, verbose=False)
+    Deltaf_ij, dDeltaf_ij = mbar.getFreeEnergyDifferences()[:2]
+    return Deltaf_ij[0, nreplicas:], dDeltaf_ij[0, nreplicas:]
+
+
+def analyze_phase(ncfile_path, use_cache=True, nbootstraps=0, block_size=1, seed=0, n_processes=None):
+    """
+    Analyze the store file of a phase to compute free energy and enthalpy differences.
+
+    The products of the analysis are cached next to the store file (see
+    get_analysis_cache_path()). If the store file has not changed, the cached
+    results are returned. If new iterations were added, only the trace of the
+    new iterations is extracted and MBAR is warm-started from the cached free
+    energies.
+
+    Parameters
+    ----------
+    ncfile_path : str
+       The path to the NetCDF store file of the phase.
+    use_cache : bool, optional, default=True
+       If False, the cache is neither read nor written.
+    nbootstraps : int, optional, default=0
+       If greater than 0, the number of bootstrap replicates used to estimate
+       the distribution of DeltaF (see bootstrap_free_energy()).
+    block_size : int, optional, default=1
+       The number of consecutive decorrelated iterations resampled together.
+    seed : int, optional, default=0
+       The seed of the bootstrap resampling.
+    n_processes : int, optional
+       The number of processes solving the bootstrap replicates.
+
+    Returns
+    -------
+    entry : dict
+       The analysis of the phase with keys 'DeltaF', 'dDeltaF', 'DeltaH',
+       'dDeltaH' (in kT), 'DeltaF_restraints' (in kT), 'kT' (simtk.unit.Quantity),
+       'mixing_transition_matrix' and 'mixing_relaxation_time'. With bootstrap,
+       also 'DeltaF_bootstrap' (the replicates), 'dDeltaF_bootstrap' and
+       'DeltaF_confidence_interval' (in kT). If energies were re-evaluated in
+       new states (see get_reevaluated_energies_path()), also the free
+       energies 'DeltaF_reevaluated' and 'dDeltaF_reevaluated' (in kT) of the
+       new states relative to the first state of the phase.
+
+    """
+    analysis_cache_path = get_analysis_cache_path(ncfile_path)
+
+    # Open NetCDF file for reading.
+    logger.info("Opening NetCDF trajectory file %(ncfile_path)s for reading..." % vars())
+    ncfile = netcdf.Dataset(ncfile_path, 'r')
+    try:
+        logger.debug("dimensions:")
+        for dimension_name in ncfile.dimensions.keys():
+            logger.debug("%16s %8d" % (dimension_name, len(ncfile.dimensions[dimension_name])))
+
+        # Read dimensions.
+        niterations = utils.get_committed_iterations(ncfile)
+        nstates = ncfile.variables['positions'].shape[1]
+        logger.info("Read %(niterations)d iterations, %(nstates)d states" % vars())
+
+        DeltaF_restraints = 0.0
+        if 'metadata' in ncfile.groups:
+            # Read phase direction and standard state correction free energy.
+            # Yank sets correction to 0 if there are no restraints
+            DeltaF_restraints = ncfile.groups['metadata'].variables['standard_state_correction'][0]
+
+        # Get temperatures.
+        ncvar = ncfile.groups['thermodynamic_states'].variables['temperatures']
+        temperature = ncvar[0] * units.kelvin
+        kT = kB * temperature
+
+        # Check for a valid cache of this simulation.
+        identity = _get_store_identity(ncfile)
+        cache = _read_analysis_cache(analysis_cache_path, identity) if use_cache else None
+        if cache is not None and int(cache['niterations']) > niterations:
+            cache = None
+
+        if cache is not None and int(cache['niterations']) == niterations:
+            logger.info("Using cached analysis of %d iterations from %s" % (niterations, analysis_cache_path))
+            results = cache
+            Tij, relaxation_time = show_mixing_statistics(ncfile, cutoff=0.05, nequil=int(results['nequil']))
+            if nbootstraps > 0:
+                (u_kln, N_k, u_n) = extract_ncfile_energies(ncfile, ndiscard=int(results['nequil']),
+                                                            g=float(results['g_t']), u_n=results['u_n'])
+        else:
+            # Extract the trace of the new iterations only.
+            if cache is not None:
+                logger.info("Updating cached analysis of %d iterations from %s" % (int(cache['niterations']),
+                                                                                  analysis_cache_path))
+                all_u_n = np.concatenate([cache['u_n'], extract_u_n(ncfile, first_iteration=int(cache['niterations']))])
+                initial_f_k = cache['f_k']
+            else:
+                all_u_n = extract_u_n(ncfile)
+                initial_f_k = None
+
+            # Choose number of samples to discard to equilibration
+            MIN_ITERATIONS = 10 # minimum number of iterations to use automatic detection
+            if niterations > MIN_ITERATIONS:
+                u_n = all_u_n[1:] # discard initial frame of zero energies TODO: Get rid of initial frame of zero energies
+                initial_guess = int(cache['nequil']) - 1 if cache is not None else None
+                [nequil, g_t, Neff_max] = detect_equilibration(u_n, initial_guess=initial_guess)
+                nequil += 1 # account for initial frame of zero energies
+                logger.info([nequil, Neff_max])
+            else:
+                nequil = 1  # discard first frame
+                g_t = 1
+                Neff_max = niterations
+
+            # Examine acceptance probabilities.
+            Tij, relaxation_time = show_mixing_statistics(ncfile, cutoff=0.05, nequil=nequil)
+
+            # Extract equilibrated, decorrelated energies, check for fully interacting state
+            (u_kln, N_k, u_n) = extract_ncfile_energies(ncfile, ndiscard=nequil, g=g_t, u_n=all_u_n)
+
+            # Create MBAR object to use for free energy and entropy states, warm-started from the cache
+            if initial_f_k is not None and len(initial_f_k) != len(N_k):
+                initial_f_k = None
+            mbar = initialize_MBAR(ncfile, u_kln=u_kln, N_k=N_k, initial_f_k=initial_f_k)
+
+            # Estimate free energies and average enthalpies with a single
+            # computation of the MBAR covariance, use fully interacting state if present
+            logger.info("Computing covariance matrix...")
+            (Deltaf_ij, dDeltaf_ij, DeltaH_i, dDeltaH_i, _, _) = mbar.computeEntropyAndEnthalpy()
+            _log_matrix("Deltaf_ij:", Deltaf_ij)
+            _log_matrix("dDeltaf_ij:", dDeltaf_ij)
+
+            results = dict(identity=identity, niterations=niterations, u_n=all_u_n, nequil=nequil,
+                           g_t=g_t, Neff_max=Neff_max, f_k=mbar.f_k, Deltaf_ij=Deltaf_ij,
+                           dDeltaf_ij=dDeltaf_ij, DeltaH_i=DeltaH_i, dDeltaH_i=dDeltaH_i)
+            if use_cache:
+                _write_analysis_cache(analysis_cache_path, results)
+
+        # Estimate the distribution of the free energy difference.
+        if nbootstraps > 0:
+            logger.info("Computing %d bootstrap replicates..." % nbootstraps)
+            bootstrap = bootstrap_free_energy(u_kln, N_k=N_k, f_k=results['f_k'], nbootstraps=nbootstraps,
+                                              block_size=block_size, seed=seed, n_processes=n_processes)
+
+        # Estimate the free energies of the states re-evaluated after the simulation.
+        reevaluated_energies = _read_analysis_cache(get_reevaluated_energies_path(ncfile_path), identity)
+        if reevaluated_energies is not None:
+            logger.info("Computing free energies of %d re-evaluated states..." %
+                        reevaluated_energies['energies'].shape[2])
+            DeltaF_reevaluated, dDeltaF_reevaluated = _analyze_reevaluated_energies(ncfile, reevaluated_energies)
+    finally:
+        ncfile.close()
+
+    # Accumulate free energy differences
+    entry = dict()
+    entry['DeltaF'] = float(results['Deltaf_ij'][0, -1])
+    entry['dDeltaF'] = float(results['dDeltaf_ij'][0, -1])
+    entry['DeltaH'] = float(results['DeltaH_i'][0, -1])
+    entry['dDeltaH'] = float(results['dDeltaH_i'][0, -1])
+    entry['DeltaF_restraints'] = float(DeltaF_restraints)
+    entry['kT'] = kT
+    entry['mixing_transition_matrix'] = Tij
+    entry['mixing_relaxation_time'] = relaxation_time
+    if nbootstraps > 0:
+        entry['DeltaF_bootstrap'] = bootstrap['DeltaF_samples']
+        entry['dDeltaF_bootstrap'] = bootstrap['dDeltaF']
+        entry['DeltaF_confidence_interval'] = bootstrap['confidence_interval']
+    if reevaluated_energies is not None:
+        entry['DeltaF_reevaluated'] = DeltaF_reevaluated
+        entry['dDeltaF_reevaluated'] = dDeltaF_reevaluated
+    return entry
+
+
+def _read_analysis_script(source_directory):
+    """Read the list of (phase_name, sign) pairs in the analysis.yaml script of an experiment."""
+    analysis_script_path = os.path.join(source_directory, 'analysis.yaml')
+    if not os.path.isfile(analysis_script_path):
+        err_msg = 'Cannot find analysis.yaml script in {}'.format(source_directory)
+        logger.error(err_msg)
+        raise RuntimeError(err_msg)
+    with open(analysis_script_path, 'r') as f:
+        analysis = yaml.load(f)
+    return analysis
+
+
+def _combine_phases(analysis, data):
+    """
+    Combine the free energies and enthalpies of the phases of an experiment.
+
+    Parameters
+    ----------
+    analysis : list of (str, int)
+       The (phase_name, sign) pairs read from the analysis.yaml script.
+    data : dict
+       data[phase_name] is the entry returned by analyze_phase().
+
+    Returns
+    -------
+    results : dict
+       The 'DeltaF', 'dDeltaF', 'DeltaH' and 'dDeltaH' of the experiment in kT.
+
+    """
+    DeltaF = 0.0
+    dDeltaF = 0.0
+    DeltaH = 0.0
+    dDeltaH = 0.0
+    for phase, sign in analysis:
+        DeltaF -= sign * (data[phase]['DeltaF'] + data[phase]['DeltaF_restraints'])
+        dDeltaF += data[phase]['dDeltaF']**2
+        DeltaH -= sign * (data[phase]['DeltaH'] + data[phase]['DeltaF_restraints'])
+        dDeltaH += data[phase]['dDeltaH']**2
+    return dict(DeltaF=DeltaF, dDeltaF=np.sqrt(dDeltaF), DeltaH=DeltaH, dDeltaH=np.sqrt(dDeltaH))
+
+
+def analyze(source_directory, use_cache=True, nbootstraps=0, block_size=1, seed=0):
+    """
+    Analyze contents of store files to compute free energy differences.
+
+    Parameters
+    ----------
+    source_directory : string
+       The location of the NetCDF simulation storage files.
+    use_cache : bool, optional, default=True
+       If True, the analysis of each phase is cached and updated incrementally
+       (see analyze_phase()).
+    nbootstraps : int, optional, default=0
+       If greater than 0, the number of bootstrap replicates used to estimate
+       the confidence interval of each phase (see bootstrap_free_energy()).
+    block_size : int, optional, default=1
+       The number of consecutive decorrelated iterations resampled together.
+    seed : int, optional, default=0
+       The seed of the bootstrap resampling.
+
+    Returns
+    -------
+    results : dict
+       The 'DeltaF', 'dDeltaF', 'DeltaH' and 'dDeltaH' of the experiment in kT,
+       the 'kT' and the 'phases' dictionary mapping each phase name to the entry
+       returned by analyze_phase().
+
+    """
+    analysis = _read_analysis_script(source_directory)
+    phases = [phase_name for phase_name, sign in analysis]
+    store_paths = utils.find_phases_in_store_directory(source_directory)
+
+    # Storage for different phases.
+    data = dict()
+
+    # Process each netcdf file.
+    for phase in phases:
+        data[phase] = analyze_phase(store_paths[phase], use_cache=use_cache, nbootstraps=nbootstraps,
+                                    block_size=block_size, seed=seed)
+        kT = data[phase]['kT']
+
+    # Compute free energy and enthalpy
+    results = _combine_phases(analysis, data)
+    DeltaF, dDeltaF = results['DeltaF'], results['dDeltaF']
+    DeltaH, dDeltaH = results['DeltaH'], results['dDeltaH']
+
+    # Attempt to guess type of calculation
+    calculation_type = ''
+    for phase in phases:
+        if 'complex' in phase:
+            calculation_type = ' of binding'
+        elif 'solvent1' in phase:
+            calculation_type = ' of solvation'
+
+    # Print energies
+    logger.info("")
+    logger.info("Free energy{}: {:16.3f} +- {:.3f} kT ({:16.3f} +- {:.3f} kcal/mol)".format(
+        calculation_type, DeltaF, dDeltaF, DeltaF * kT / units.kilocalories_per_mole,
+        dDeltaF * kT / units.kilocalories_per_mole))
+    logger.info("")
+
+    for phase in phases:
+        logger.info("DeltaG {:<25} : {:16.3f} +- {:.3f} kT".format(phase, data[phase]['DeltaF'],
+                                                                   data[phase]['dDeltaF']))
+        if nbootstraps > 0:
+            logger.info("DeltaG {:<25} : {:16.3f} +- {:.3f} kT (95% CI [{:.3f}, {:.3f}])".format(
+                'bootstrap', np.mean(data[phase]['DeltaF_bootstrap']), data[phase]['dDeltaF_bootstrap'],
+                *data[phase]['DeltaF_confidence_interval']))
+        if data[phase]['DeltaF_restraints'] != 0.0:
+            logger.info("DeltaG {:<25} : {:25.3f} kT".format('restraint',
+                                                             data[phase]['DeltaF_restraints']))
+        for state_index, DeltaF_state in enumerate(data[phase].get('DeltaF_reevaluated', [])):
+            logger.info("DeltaG {:<25} : {:16.3f} +- {:.3f} kT".format(
+                're-evaluated state {}'.format(state_index), DeltaF_state,
+                data[phase]['dDeltaF_reevaluated'][state_index]))
+    logger.info("")
+    logger.info("Enthalpy{}: {:16.3f} +- {:.3f} kT ({:16.3f} +- {:.3f} kcal/mol)".format(
+        calculation_type, DeltaH, dDeltaH, DeltaH * kT / units.kilocalories_per_mole,
+        dDeltaH * kT / units.kilocalories_per_mole))
+
+    results['kT'] = kT
+    results['phases'] = data
+    return results
+
+
+# ==============================================================================
+# Export energies to memory-mappable arrays
+# ==============================================================================
+
+# Per-iteration variables exported by export_energies(), and the name of their
+# deconvoluted (state-indexed) arrays, if any.
+EXPORTED_VARIABLES = collections.OrderedDict([
+    ('states', None),
+    ('energies', 'u_kln'),
+    ('fully_interacting_expanded_cutoff_energies', 'fully_interacting_expanded_cutoff_u_kn'),
+    ('noninteracting_expanded_cutoff_energies', 'noninteracting_expanded_cutoff_u_kn')
+])
+
+# Names of the axes of the exported arrays. The store file names both the replica
+# and the evaluated state axes of the energies 'replica', so these are explicit.
+EXPORTED_DIMENSIONS = {
+    'states': ['iteration', 'replica'],
+    'energies': ['iteration', 'replica', 'evaluated_state'],
+    'u_kln': ['sampled_state', 'evaluated_state', 'iteration'],
+    'fully_interacting_expanded_cutoff_energies': ['iteration', 'replica'],
+    'fully_interacting_expanded_cutoff_u_kn': ['sampled_state', 'iteration'],
+    'noninteracting_expanded_cutoff_energies': ['iteration', 'replica'],
+    'noninteracting_expanded_cutoff_u_kn': ['sampled_state', 'iteration'],
+}
+
+
+def get_energies_export_directory(store_filename):
+    """
+    Return the default directory where export_energies() writes the arrays of a phase.
+
+    Parameters
+    ----------
+    store_filename : str
+        The path to the NetCDF store file of the phase.
+
+    Returns
+    -------
+    export_directory : str
+        The path to the directory of .npy files.
+
+    """
+    return os.path.splitext(store_filename)[0] + '.energies'
+
+
+def _read_export_manifest(export_directory):
+    """Return the manifest of an export directory, or None if there is no complete export."""
+    manifest_path = os.path.join(export_directory, 'manifest.json')
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def export_energies(store_filename, export_directory=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Export the states and energies of a phase to uncompressed .npy files.
+
+    The raw per-iteration variables (states, energies and, if present, the
+    expanded cutoff energies) and their deconvoluted state-indexed versions
+    are written to a directory together with a JSON manifest describing
+    their shapes and dimensions, so that downstream tools can load slices
+    with numpy.load(mmap_mode='r') without netCDF4. The store file is read
+    once in hyperslabs of chunk_size iterations, and only the committed
+    iterations are exported. Each array is written to a temporary file and
+    renamed, and the manifest is written last, so readers of the manifest
+    always find complete arrays. Nothing is rewritten if the directory
+    already holds an export of the same iterations.
+
+    Parameters
+    ----------
+    store_filename : str
+        The path to the NetCDF store file of the phase.
+    export_directory : str, optional
+        The directory where the arrays are written. Default is given by
+        get_energies_export_directory().
+    chunk_size : int, optional, default=DEFAULT_CHUNK_SIZE
+        The maximum number of iterations read at once.
+
+    Returns
+    -------
+    manifest : dict
+        The content of the manifest.json file. manifest['arrays'][name] gives
+        the 'filename', 'shape', 'dtype' and 'dimensions' of each array.
+
+    """
+    if export_directory is None:
+        export_directory = get_energies_export_directory(store_filename)
+    if not os.path.isdir(export_directory):
+        os.makedirs(export_directory)
+
+    with PhaseReader(store_filename) as reader:
+        niterations, nstates = reader.niterations, reader.nstates
+        identity = _get_store_identity(reader.ncfile)
+
+        # Skip the export if the directory is up to date.
+        manifest = _read_export_manifest(export_directory)
+        if (manifest is not None and manifest['identity'] == identity and
+                manifest['niterations'] == niterations):
+            logger.debug('Exported energies in {} are up to date.'.format(export_directory))
+            return manifest
+
+        logger.info('Exporting {} iterations of {} to {}...'.format(niterations, store_filename, export_directory))
+        initial_time = time.time()
+
+        # Create the raw and deconvoluted arrays as memory-mapped temporary files.
+        variable_names = [name for name in EXPORTED_VARIABLES if name in reader.ncfile.variables]
+        arrays = collections.OrderedDict()
+        for variable_name in variable_names:
+            variable = reader.ncfile.variables[variable_name]
+            arrays[variable_name] = (variable_name, (niterations,) + variable.shape[1:], variable.dtype,
+                                     EXPORTED_DIMENSIONS[variable_name])
+        for variable_name in variable_names:
+            deconvoluted_name = EXPORTED_VARIABLES[variable_name]
+            if deconvoluted_name is not None:
+                variable = reader.ncfile.variables[variable_name]
+                arrays[deconvoluted_name] = (variable_name, (nstates,) + variable.shape[2:] + (niterations,),
+                                             np.float64, EXPORTED_DIMENSIONS[deconvoluted_name])
+        npy_files = {name: np.lib.format.open_memmap(os.path.join(export_directory, name + '.npy.tmp'), mode='w+',
+                                                     dtype=dtype, shape=shape)
+                     for name, (_, shape, dtype, _) in arrays.items()}
+
+        # Fill all the arrays with a single pass over the store file.
+        for chunk in reader.iterate_chunks(variable_names, chunk_size=chunk_size):
+            chunk_start, chunk_data = chunk[0], dict(zip(variable_names, chunk[1:]))
+            chunk_iterations = np.arange(chunk_start, chunk_start + len(chunk_data['states']))
+            states_chunk = chunk_data['states']
+            for variable_name in variable_names:
+                npy_files[variable_name][chunk_iterations] = chunk_data[variable_name]
+                deconvoluted_name = EXPORTED_VARIABLES[variable_name]
+                if deconvoluted_name is not None:
+                    npy_files[deconvoluted_name][states_chunk, ..., chunk_iterations[:, np.newaxis]] = \
+                        chunk_data[variable_name]
+
+    # Publish the arrays and then the manifest.
+    manifest = dict(store_filename=os.path.abspath(store_filename), identity=identity,
+                    niterations=niterations, nstates=nstates, timestamp=time.time(),
+                    arrays=collections.OrderedDict())
+    for name, (variable_name, shape, dtype, dimensions) in arrays.items():
+        npy_files[name].flush()
+        del npy_files[name]
+        npy_path = os.path.join(export_directory, name + '.npy')
+        os.rename(npy_path + '.tmp', npy_path)
+        manifest['arrays'][name] = dict(filename=name + '.npy', variable=variable_name, shape=list(shape),
+                                        dtype=np.dtype(dtype).name, dimensions=dimensions)
+    manifest_path = os.path.join(export_directory, 'manifest.json')
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.rename(manifest_path + '.tmp', manifest_path)
+
+    logger.info('Exporting energies took {:.3f} s.'.format(time.time() - initial_time))
+    return manifest
+
+
+def load_exported_energies(export_directory, mmap_mode='r'):
+    """
+    Load the arrays written by export_energies().
+
+    Parameters
+    ----------
+    export_directory : str
+        The directory of the exported arrays.
+    mmap_mode : str or None, optional, default='r'
+        The memory-map mode passed to numpy.load(). With the default, the
+        arrays are memory-mapped read-only and slices are read on access.
+
+    Returns
+    -------
+    arrays : dict of numpy.ndarray
+        arrays[name] is the exported array (e.g. 'states', 'energies', 'u_kln').
+
+    """
+    manifest = _read_export_manifest(export_directory)
+    if manifest is None:
+        raise RuntimeError('Cannot find exported energies in {}'.format(export_directory))
+    return {name: np.load(os.path.join(export_directory, array['filename']), mmap_mode=mmap_mode)
+            for name, array in manifest['arrays'].items()}
+
+# ==============================================================================
+# Batch analysis of many experiments
+# ==============================================================================
+
+# Columns of the table written by analyze_batch().
+BATCH_TABLE_FIELDS = ['experiment', 'DeltaF', 'dDeltaF', 'DeltaH', 'dDeltaH',
+                      'DeltaF_kcalmol', 'dDeltaF_kcalmol', 'DeltaH_kcalmol', 'dDeltaH_kcalmol']
+
+
+def find_experiment_directories(output_directory):
+    """
+    Find the experiments under an output directory.
+
+    Parameters
+    ----------
+    output_directory : str
+       The root of the tree to search (e.g. the output_dir of a YAML script).
+
+    Returns
+    -------
+    experiment_directories : list of str
+       The sorted directories containing an analysis.yaml script.
+
+    """
+    experiment_directories = []
+    for directory, _, file_names in os.walk(output_directory):
+        if 'analysis.yaml' in file_names:
+            experiment_directories.append(directory)
+    return sorted(experiment_directories)
+
+
+def _analyze_phase_in_batch(ncfile_path, use_cache):
+    """Analyze a phase for analyze_batch(), returning None on failure so that the rest of the batch completes."""
+    try:
+        return analyze_phase(ncfile_path, use_cache=use_cache)
+    except Exception as e:
+        logger.error('Analysis of {} failed: {}'.format(ncfile_path, e))
+        return None
+
+
+def analyze_batch(output_directory, table_path, n_processes=None, use_cache=True):
+    """
+    Analyze all the experiments under a directory and write a consolidated table.
+
+    The phases of all the experiments found by find_experiment_directories()
+    are analyzed concurrently in a process pool. The results are written as a
+    CSV table with the fields in BATCH_TABLE_FIELDS, one row per experiment.
+    Experiments for which a phase could not be analyzed are reported with
+    NaN free energies.
+
+    Parameters
+    ----------
+    output_directory : str
+       The root of the tree containing the experiments.
+    table_path : str
+       The path to the CSV table to create.
+    n_processes : int, optional
+       The number of worker processes. Default is the number of CPUs.
+    use_cache : bool, optional, default=True
+       If True, the analysis of each phase is cached and updated incrementally
+       (see analyze_phase()).
+
+    Returns
+    -------
+    rows : list of dict
+       The rows of the table.
+
+    """
+    experiment_directories = find_experiment_directories(output_directory)
+    if len(experiment_directories) == 0:
+        raise RuntimeError('Cannot find any analysis.yaml script in {}'.format(output_directory))
+
+    # Collect the phases of all experiments so that they share the pool.
+    analyses = []
+    ncfile_paths = []
+    for experiment_directory in experiment_directories:
+        analysis = _read_analysis_script(experiment_directory)
+        store_paths = utils.find_phases_in_store_directory(experiment_directory)
+        analyses.append(analysis)
+        ncfile_paths.extend(store_paths[phase] for phase, _ in analysis)
+    logger.info('Analyzing {} phases of {} experiments'.format(len(ncfile_paths), len(experiment_directories)))
+
+    pool = multiprocessing.Pool(n_processes)
+    try:
+        entries = pool.map(functools.partial(_analyze_phase_in_batch, use_cache=use_cache),
+                           ncfile_paths, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Combine the phases of each experiment.
+    rows = []
+    entries = iter(entries)
+    for experiment_directory, analysis in zip(experiment_directories, analyses):
+        data = {phase: next(entries) for phase, _ in analysis}
+        row = dict.fromkeys(BATCH_TABLE_FIELDS, float('nan'))
+        row['experiment'] = os.path.relpath(experiment_directory, output_directory)
+        if all(entry is not None for entry in data.values()):
+            results = _combine_phases(analysis, data)
+            kT = list(data.values())[0]['kT'] / units.kilocalories_per_mole
+            for field in ['DeltaF', 'dDeltaF', 'DeltaH', 'dDeltaH']:
+                row[field] = results[field]
+                row[field + '_kcalmol'] = results[field] * kT
+        rows.append(row)
+
+    # Write the table.
+    tmp_path = table_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=BATCH_TABLE_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    os.rename(tmp_path, table_path)
+    logger.info('Wrote analysis of {} experiments to {}'.format(len(rows), table_path))
+    return rows
+
+
+# ==============================================================================
+# Extract trajectory from NetCDF4 file
+# ==============================================================================
+
+# Maximum size in bytes of the positions read at once from the NetCDF4 file
+# when extracting trajectories.
+TRAJECTORY_CHUNK_BYTES = 256 * 1024**2
+
+# Trajectory formats that can be written to disk one chunk of frames at a time.
+_STREAMING_TRAJECTORY_FORMATS = {'dcd': mdtraj.formats.DCDTrajectoryFile,
+                                 'nc': mdtraj.formats.NetCDFTrajectoryFile,
+                                 'xtc': mdtraj.formats.XTCTrajectoryFile}
+
+
+class TrajectoryWriter(object):
+    """Write a trajectory one chunk of frames at a time.
+
+    DCD, AMBER NetCDF and XTC files are streamed to disk so that memory usage
+    does not depend on the length of the trajectory. Other formats supported
+    by mdtraj are accumulated in memory and saved when the writer is closed.
+
+    Parameters
+    ----------
+    output_path : str
+        Path to the trajectory file to be created. The extension of the file
+        determines the format.
+
+    """
+
+    def __init__(self, output_path):
+        extension = os.path.splitext(output_path)[1][1:]  # remove dot
+        if (extension not in _STREAMING_TRAJECTORY_FORMATS and
+                not hasattr(mdtraj.Trajectory, 'save_' + extension)):
+            raise ValueError('Cannot detect format from extension of file {}'.format(output_path))
+
+        # Create output directory
+        output_dir = os.path.dirname(output_path)
+        if output_dir != '' and not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        self.output_path = output_path
+        self._extension = extension
+        self._chunks = []
+        if extension in _STREAMING_TRAJECTORY_FORMATS:
+            self._file = _STREAMING_TRAJECTORY_FORMATS[extension](output_path, 'w')
+        else:
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, trajectory):
+        """Append the frames of an mdtraj.Trajectory to the file."""
+        if self._file is None:
+            self._chunks.append(trajectory)
+            return
+
+        distance_unit = self._file.distance_unit
+        kwargs = {}
+        if trajectory.unitcell_vectors is not None:
+            if self._extension == 'xtc':
+                kwargs['box'] = mdtraj.utils.in_units_of(trajectory.unitcell_vectors,
+                                                         'nanometers', distance_unit)
+            else:
+                kwargs['cell_lengths'] = mdtraj.utils.in_units_of(trajectory.unitcell_lengths,
+                                                                  'nanometers', distance_unit)
+                kwargs['cell_angles'] = trajectory.unitcell_angles
+        self._file.write(mdtraj.utils.in_units_of(trajectory.xyz, 'nanometers', distance_unit), **kwargs)
+
+    def close(self):
+        """Flush the trajectory to disk and close the file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        elif len(self._chunks) > 0:
+            trajectory = self._chunks[0].join(self._chunks[1:]) if len(self._chunks) > 1 else self._chunks[0]
+            getattr(trajectory, 'save_' + self._extension)(self.output_path)
+            self._chunks = []
+
+
+def _prepare_trajectory_extraction(nc_file, start_frame, end_frame, skip_frame,
+                                   keep_solvent, discard_equilibration, image_molecules):
+    """Read the topology and resolve the atoms, frames and molecules to extract.
+
+    Returns
+    -------
+    topology : mdtraj.Topology
+        The topology of the extracted atoms.
+    atom_indices : slice or numpy.array of int
+        The indices of the atoms to read from the positions variable.
+    is_periodic : bool
+        True if the system uses periodic boundary conditions.
+    frame_indices : numpy.array of int
+        The iterations to extract, in increasing order.
+    molecules : tuple or None
+        The anchor and other molecules of the extracted atoms to pass to
+        mdtraj.Trajectory.image_molecules(), or None if image_molecules is False.
+
+    """
+    # Extract topology and system serialization
+    serialized_system = nc_file.groups['metadata'].variables['reference_system'][0]
+    serialized_topology = nc_file.groups['metadata'].variables['topology'][0]
+    topology = utils.deserialize_topology(serialized_topology)
+
+    # Determine if system is periodic
+    from simtk import openmm
+    reference_system = openmm.XmlSerializer.deserialize(str(serialized_system))
+    is_periodic = reference_system.usesPeriodicBoundaryConditions()
+    logger.info('Detected periodic boundary conditions: {}'.format(is_periodic))
+
+    # Get dimensions
+    n_iterations = utils.get_committed_iterations(nc_file)
+    n_atoms = nc_file.variables['positions'].shape[2]
+    logger.info('Number of iterations: {}, atoms: {}'.format(n_iterations, n_atoms))
+
+    # Determine anchor molecules on the full topology, since solvent affects their choice
+    if image_molecules:
+        anchor_molecules = topology.guess_anchor_molecules()
+        other_molecules = [molecule for molecule in topology.find_molecules()
+                           if molecule not in anchor_molecules]
+        anchor_molecules = [[atom.index for atom in molecule] for molecule in anchor_molecules]
+        other_molecules = [[atom.index for atom in molecule] for molecule in other_molecules]
+
+    # Resolve atom selection so that solvent is never read
+    if keep_solvent:
+        atom_indices = slice(None)
+        subset_indices = np.arange(n_atoms)
+    else:
+        logger.info('Removing solvent molecules...')
+        from mdtraj.core.residue_names import _SOLVENT_TYPES
+        solute_indices = np.array([atom.index for atom in topology.atoms
+                                   if atom.residue.name not in _SOLVENT_TYPES], dtype=np.int64)
+        topology = topology.subset(solute_indices)
+        subset_indices = np.full(n_atoms, -1, dtype=np.int64)
+        subset_indices[solute_indices] = np.arange(len(solute_indices))
+        atom_indices = _as_slice(solute_indices)
+
+    # Determine frames to extract
+    if start_frame <= 0:
+        # TODO yank saves first frame with 0 energy!
+        start_frame = 1
+    if end_frame < 0:
+        end_frame = n_iterations + end_frame + 1
+    frame_indices = np.arange(start_frame, end_frame, skip_frame)
+    if len(frame_indices) == 0:
+        raise ValueError('No frames selected')
+    logger.info('Extracting frames from {} to {} every {}'.format(
+        start_frame, end_frame, skip_frame))
+
+    # Discard equilibration samples
+    if discard_equilibration:
+        u_n = extract_u_n(nc_file)[frame_indices]
+        n_equil, g, n_eff = detect_equilibration(u_n)
+        logger.info(("Discarding initial {} equilibration samples (leaving {} "
+                     "effectively uncorrelated samples)...").format(n_equil, n_eff))
+        frame_indices = frame_indices[n_equil:-1]
+
+    # Map the extracted molecules to the atoms of the extracted topology
+    molecules = None
+    if image_molecules:
+        def map_molecules(molecules_indices):
+            mapped_molecules = []
+            for molecule_indices in molecules_indices:
+                molecule_indices = subset_indices[molecule_indices]
+                if np.all(molecule_indices >= 0):
+                    mapped_molecules.append(set(topology.atom(index) for index in molecule_indices))
+            return mapped_molecules
+        molecules = (map_molecules(anchor_molecules), map_molecules(other_molecules))
+
+    return topology, atom_indices, is_periodic, frame_indices, molecules
+
+
+def _as_slice(indices):
+    """Return a slice equivalent to the increasing indices if they are evenly spaced.
+
+    NetCDF4 reads slices much faster than sequences of indices.
+
+    """
+    indices = np.asarray(indices)
+    if len(indices) == 0:
+        return indices
+    if len(indices) == 1:
+        return slice(indices[0], indices[0] + 1)
+    steps = np.diff(indices)
+    if steps[0] > 0 and np.all(steps == steps[0]):
+        return slice(indices[0], indices[-1] + 1, steps[0])
+    return indices
+
+
+def _get_frames_per_chunk(n_replicas, n_atoms):
+    """Number of frames of n_replicas replicas that fit in TRAJECTORY_CHUNK_BYTES."""
+    frame_bytes = n_replicas * (n_atoms + 3) * 3 * np.dtype(np.float32).itemsize
+    return max(1, TRAJECTORY_CHUNK_BYTES // frame_bytes)
+
+
+def _read_replica_frames(nc_file, frame_indices, replica_indices, atom_indices, is_periodic):
+    """Read the positions and box vectors of one replica per frame.
+
+    Frames are grouped by replica so that each replica is read with a single
+    access to the NetCDF4 file.
+
+    Returns
+    -------
+    positions : numpy.array of numpy.float32
+        positions[i] are the positions of replica replica_indices[i] at
+        iteration frame_indices[i].
+    box_vectors : numpy.array of numpy.float32 or None
+        The corresponding box vectors, or None if the system is not periodic.
+
+    """
+    positions = None
+    box_vectors = np.zeros((len(frame_indices), 3, 3), np.float32) if is_periodic else None
+    for replica_index in np.unique(replica_indices):
+        rows = np.nonzero(replica_indices == replica_index)[0]
+        iterations = _as_slice(frame_indices[rows])
+        replica_positions = nc_file.variables['positions'][iterations, replica_index, atom_indices, :]
+        if positions is None:
+            positions = np.zeros((len(frame_indices),) + replica_positions.shape[1:], np.float32)
+        positions[rows] = replica_positions
+        if is_periodic:
+            box_vectors[rows] = nc_file.variables['box_vectors'][iterations, replica_index, :, :]
+    return positions, box_vectors
+
+
+def _create_trajectory(positions, box_vectors, topology, molecules=None):
+    """Create an mdtraj.Trajectory from positions in nanometers.
+
+    If molecules is not None, periodic boundary conditions are applied to the
+    positions of the molecules (see _prepare_trajectory_extraction()).
+
+    """
+    trajectory = mdtraj.Trajectory(positions, topology)
+    if box_vectors is not None:
+        trajectory.unitcell_vectors = box_vectors
+
+    # Force periodic boundary conditions to molecules positions
+    if molecules is not None:
+        anchor_molecules, other_molecules = molecules
+        trajectory.image_molecules(inplace=True, anchor_molecules=anchor_molecules,
+                                   other_molecules=other_molecules)
+    return trajectory
+
+
+def extract_trajectory(output_path, nc_path, state_index=None, replica_index=None,
+                       start_frame=0, end_frame=-1, skip_frame=1, keep_solvent=True,
+                       discard_equilibration=False, image_molecules=False):
+    """Extract phase trajectory from the NetCDF4 file.
+
+    Only the selected atoms are read from the NetCDF4 file, and frames are
+    processed in chunks of bounded memory. DCD, AMBER NetCDF and XTC output
+    files are written incrementally.
+
+    Parameters
+    ----------
+    output_path : str
+        Path to the trajectory file to be created. The extension of the file
         determines the format.
     nc_path : str
         Path to the NetCDF4 file containing the trajectory.
@@ -602,8 +3037,11 @@ def extract_trajectory(output_path, nc_path, state_index=None, replica_index=Non
     keep_solvent : bool, optional
         If False, solvent molecules are ignored (default is True).
     discard_equilibration : bool, optional
-        If True, initial equilibration frames are discarded (see the method
-        pymbar.timeseries.detectEquilibration() for details, default is False).
+        If True, initial equilibration frames are discarded (see the function
+        detect_equilibration() for details, default is False).
+    image_molecules : bool, optional
+        If True, periodic boundary conditions are applied to molecules positions
+        (default is False).
 
     """
     # Check correct input
@@ -614,101 +3052,130 @@ def extract_trajectory(output_path, nc_path, state_index=None, replica_index=Non
         raise ValueError('Cannot find file {}'.format(nc_path))
 
     # Import simulation data
+    nc_file = netcdf.Dataset(nc_path, 'r')
     try:
-        nc_file = netcdf.Dataset(nc_path, 'r')
-
-        # Extract topology and system serialization
-        serialized_system = nc_file.groups['metadata'].variables['reference_system'][0]
-        serialized_topology = nc_file.groups['metadata'].variables['topology'][0]
-
-        # Determine if system is periodic
-        from simtk import openmm
-        reference_system = openmm.XmlSerializer.deserialize(str(serialized_system))
-        is_periodic = reference_system.usesPeriodicBoundaryConditions()
-        logger.info('Detected periodic boundary conditions: {}'.format(is_periodic))
-
-        # Get dimensions
-        n_iterations = nc_file.variables['positions'].shape[0]
-        n_atoms = nc_file.variables['positions'].shape[2]
-        logger.info('Number of iterations: {}, atoms: {}'.format(n_iterations, n_atoms))
-
-        # Determine frames to extract
-        if start_frame <= 0:
-            # TODO yank saves first frame with 0 energy!
-            start_frame = 1
-        if end_frame < 0:
-            end_frame = n_iterations + end_frame + 1
-        frame_indices = range(start_frame, end_frame, skip_frame)
-        if len(frame_indices) == 0:
-            raise ValueError('No frames selected')
-        logger.info('Extracting frames from {} to {} every {}'.format(
-            start_frame, end_frame, skip_frame))
-
-        # Discard equilibration samples
-        if discard_equilibration:
-            u_n = extract_u_n(nc_file)[frame_indices]
-            n_equil, g, n_eff = timeseries.detectEquilibration(u_n)
-            logger.info(("Discarding initial {} equilibration samples (leaving {} "
-                         "effectively uncorrelated samples)...").format(n_equil, n_eff))
-            frame_indices = frame_indices[n_equil:-1]
-
-        # Extract state positions and box vectors
-        positions = np.zeros((len(frame_indices), n_atoms, 3))
-        if is_periodic:
-            box_vectors = np.zeros((len(frame_indices), 3, 3))
+        topology, atom_indices, is_periodic, frame_indices, molecules = _prepare_trajectory_extraction(
+            nc_file, start_frame, end_frame, skip_frame, keep_solvent, discard_equilibration, image_molecules)
+
+        # Determine the replica to read at each frame with a single read of the states
         if state_index is not None:
             logger.info('Extracting positions of state {}...'.format(state_index))
-
-            # Deconvolute state indices
-            state_indices = np.zeros(len(frame_indices))
-            for i, iteration in enumerate(frame_indices):
-                replica_indices = nc_file.variables['states'][iteration, :]
-                state_indices[i] = np.where(replica_indices == state_index)[0][0]
-
-            # Extract state positions and box vectors
-            for i, iteration in enumerate(frame_indices):
-                replica_index = state_indices[i]
-                positions[i, :, :] = nc_file.variables['positions'][iteration, replica_index, :, :].astype(np.float32)
-                if is_periodic:
-                    box_vectors[i, :, :] = nc_file.variables['box_vectors'][iteration, replica_index, :, :].astype(np.float32)
-
-        else:  # Extract replica positions and box vectors
+            replica_indices = np.argsort(nc_file.variables['states'][:, :], axis=1)[frame_indices, state_index]
+        else:
             logger.info('Extracting positions of replica {}...'.format(replica_index))
-
-            for i, iteration in enumerate(frame_indices):
-                positions[i, :, :] = nc_file.variables['positions'][iteration, replica_index, :, :].astype(np.float32)
-                if is_periodic:
-                    box_vectors[i, :, :] = nc_file.variables['box_vectors'][iteration, replica_index, :, :].astype(np.float32)
+            replica_indices = np.full(len(frame_indices), replica_index, dtype=np.int64)
+
+        # Stream chunks of frames to the trajectory file
+        logger.info('Creating trajectory file: {}'.format(output_path))
+        if image_molecules:
+            logger.info('Applying periodic boundary conditions to molecules positions...')
+        frames_per_chunk = _get_frames_per_chunk(1, topology.n_atoms)
+        with TrajectoryWriter(output_path) as writer:
+            for chunk_start in range(0, len(frame_indices), frames_per_chunk):
+                chunk = slice(chunk_start, chunk_start + frames_per_chunk)
+                positions, box_vectors = _read_replica_frames(nc_file, frame_indices[chunk], replica_indices[chunk],
+                                                              atom_indices, is_periodic)
+                writer.write(_create_trajectory(positions, box_vectors, topology, molecules))
     finally:
         nc_file.close()
 
-    # Create trajectory object
-    logger.info('Creating trajectory object...')
-    topology = utils.deserialize_topology(serialized_topology)
-    trajectory = mdtraj.Trajectory(positions, topology)
-    if is_periodic:
-        trajectory.unitcell_vectors = box_vectors
 
-    # Force periodic boundary conditions to molecules positions
-    if image_molecules:
-        logger.info('Applying periodic boundary conditions to molecules positions...')
-        trajectory.image_molecules(inplace=True)
+def extract_state_trajectories(output_path, nc_path, start_frame=0, end_frame=-1, skip_frame=1,
+                               keep_solvent=True, discard_equilibration=False, image_molecules=False,
+                               n_threads=None):
+    """Extract the trajectories of all thermodynamic states with a single pass on the NetCDF4 file.
 
-    # Remove solvent
-    if not keep_solvent:
-        logger.info('Removing solvent molecules...')
-        trajectory = trajectory.remove_solvent()
+    The positions of all replicas are read once, in chunks of bounded memory,
+    and each frame is routed to the trajectory of the state of its replica.
+    The trajectories are written in parallel by a pool of threads.
+
+    Parameters
+    ----------
+    output_path : str
+        Path used to build the trajectory file names. The trajectory of the
+        state k is written to "root-statek.ext" if output_path is "root.ext".
+        The extension of the file determines the format.
+    nc_path : str
+        Path to the NetCDF4 file containing the trajectory.
+    start_frame : int, optional
+        Index of the first frame to include in the trajectory (default is 0).
+    end_frame : int, optional
+        Index of the last frame to include in the trajectory. If negative, will
+        count from the end (default is -1).
+    skip_frame : int, optional
+        Extract one frame every skip_frame (default is 1).
+    keep_solvent : bool, optional
+        If False, solvent molecules are ignored (default is True).
+    discard_equilibration : bool, optional
+        If True, initial equilibration frames are discarded (see the function
+        detect_equilibration() for details, default is False).
+    image_molecules : bool, optional
+        If True, periodic boundary conditions are applied to molecules positions
+        (default is False).
+    n_threads : int, optional
+        Number of threads writing the trajectories. If None, one thread per
+        state is used up to the number of CPUs (default is None).
+
+    Returns
+    -------
+    output_paths : list of str
+        output_paths[k] is the path to the trajectory of state k.
+
+    """
+    if not os.path.isfile(nc_path):
+        raise ValueError('Cannot find file {}'.format(nc_path))
 
-    # Detect format
-    extension = os.path.splitext(output_path)[1][1:]  # remove dot
+    nc_file = netcdf.Dataset(nc_path, 'r')
     try:
-        save_function = getattr(trajectory, 'save_' + extension)
-    except AttributeError:
-        raise ValueError('Cannot detect format from extension of file {}'.format(output_path))
-
-    # Create output directory and save trajectory
-    logger.info('Creating trajectory file: {}'.format(output_path))
-    output_dir = os.path.dirname(output_path)
-    if output_dir != '' and not os.path.isdir(output_dir):
-        os.makedirs(output_dir)
-    save_function(output_path)
+        topology, atom_indices, is_periodic, frame_indices, molecules = _prepare_trajectory_extraction(
+            nc_file, start_frame, end_frame, skip_frame, keep_solvent, discard_equilibration, image_molecules)
+
+        # Precompute the replica in each state at each frame with a single read of the states
+        replica_indices = np.argsort(nc_file.variables['states'][:, :], axis=1)[frame_indices]
+        n_frames, n_states = replica_indices.shape
+
+        output_root, output_extension = os.path.splitext(output_path)
+        output_paths = ['{}-state{}{}'.format(output_root, state_index, output_extension)
+                        for state_index in range(n_states)]
+        logger.info('Extracting positions of {} states to {}...'.format(n_states, ', '.join(output_paths)))
+        if image_molecules:
+            logger.info('Applying periodic boundary conditions to molecules positions...')
+
+        if n_threads is None:
+            n_threads = min(n_states, multiprocessing.cpu_count())
+        pool = multiprocessing.pool.ThreadPool(max(1, n_threads))
+        writers = []
+        try:
+            writers.extend(TrajectoryWriter(path) for path in output_paths)
+
+            frames_per_chunk = _get_frames_per_chunk(n_states, topology.n_atoms)
+            for chunk_start in range(0, n_frames, frames_per_chunk):
+                chunk = slice(chunk_start, chunk_start + frames_per_chunk)
+                iterations = _as_slice(frame_indices[chunk])
+                chunk_replica_indices = replica_indices[chunk]
+                chunk_frames = np.arange(len(chunk_replica_indices))
+
+                # Read all replicas at once and demultiplex them by state
+                positions = nc_file.variables['positions'][iterations, :, atom_indices, :]
+                if is_periodic:
+                    box_vectors = nc_file.variables['box_vectors'][iterations, :, :, :]
+
+                def write_state(state_index):
+                    state_replica_indices = chunk_replica_indices[:, state_index]
+                    state_positions = positions[chunk_frames, state_replica_indices]
+                    state_box_vectors = None
+                    if is_periodic:
+                        state_box_vectors = box_vectors[chunk_frames, state_replica_indices]
+                    writers[state_index].write(_create_trajectory(state_positions, state_box_vectors,
+                                                                  topology, molecules))
+
+                pool.map(write_state, range(n_states))
+        finally:
+            pool.close()
+            pool.join()
+            for writer in writers:
+                writer.close()
+    finally:
+        nc_file.close()
+
+    return output_paths
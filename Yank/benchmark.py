@@ -0,0 +1,303 @@
+#!/usr/local/bin/env python
+
+# ==============================================================================
+# MODULE DOCSTRING
+# ==============================================================================
+
+"""
+Benchmark YANK simulations on the available OpenMM platforms.
+
+Small, medium and large alchemical systems are built from the openmmtools test
+systems, and a few iterations of ModifiedHamiltonianExchange are run with each
+platform and precision model. The throughput and the breakdown of the iteration
+time are computed from the timings recorded in the NetCDF file, and can be
+compared to a previous report to detect performance regressions across hardware,
+OpenMM and YANK versions.
+
+"""
+
+# ==============================================================================
+# GLOBAL IMPORTS
+# ==============================================================================
+
+import os
+import time
+import shutil
+import logging
+import platform
+import tempfile
+import collections
+
+from simtk import openmm, unit
+from openmmtools import testsystems
+
+from alchemy import AbsoluteAlchemicalFactory
+
+from . import analyze
+from .repex import ThermodynamicState
+from .sampling import ModifiedHamiltonianExchange
+
+logger = logging.getLogger(__name__)
+
+
+# ==============================================================================
+# BENCHMARK SYSTEMS
+# ==============================================================================
+
+def _build_toluene_implicit():
+    """Toluene in implicit solvent, fully alchemical."""
+    testsystem = testsystems.TolueneImplicit()
+    protocol = AbsoluteAlchemicalFactory.defaultSolventProtocolImplicit()
+    return testsystem.system, testsystem.positions, range(15), protocol
+
+
+def _build_lysozyme_implicit():
+    """T4 lysozyme L99A with alchemical p-xylene in implicit solvent."""
+    testsystem = testsystems.LysozymeImplicit()
+    protocol = AbsoluteAlchemicalFactory.defaultComplexProtocolImplicit()
+    return testsystem.system, testsystem.positions, range(2603, 2621), protocol
+
+
+def _build_water_box():
+    """Box of TIP3P water with an alchemical water molecule in explicit solvent."""
+    testsystem = testsystems.WaterBox(box_edge=4.0*unit.nanometers)
+    protocol = AbsoluteAlchemicalFactory.defaultSolventProtocolExplicit()
+    return testsystem.system, testsystem.positions, range(3), protocol
+
+
+# Functions building the System, positions, alchemical atoms and alchemical
+# states of each benchmark system.
+BENCHMARK_SYSTEMS = collections.OrderedDict([
+    ('small', _build_toluene_implicit),
+    ('medium', _build_lysozyme_implicit),
+    ('large', _build_water_box),
+])
+
+# Precision models supported by each platform, the first is used by default.
+PLATFORM_PRECISIONS = {
+    'Reference': ['double'],
+    'CPU': ['mixed'],
+    'CUDA': ['mixed', 'single', 'double'],
+    'OpenCL': ['mixed', 'single', 'double'],
+}
+
+# Metrics compared to the baseline, and whether higher values are better.
+BENCHMARK_METRICS = collections.OrderedDict([
+    ('propagation_ns_per_day', True),
+    ('ns_per_day', True),
+    ('iteration_time', False),
+    ('energies_time', False),
+    ('mixing_time', False),
+    ('io_time', False),
+    ('overhead_fraction', False),
+])
+
+
+# ==============================================================================
+# RUN BENCHMARKS
+# ==============================================================================
+
+def _configure_platform(platform_name, precision):
+    """Return the OpenMM platform set to use the given precision model."""
+    openmm_platform = openmm.Platform.getPlatformByName(platform_name)
+    if platform_name in ['CUDA', 'OpenCL']:
+        from .yamlbuild import YamlBuilder
+        YamlBuilder._set_gpu_precision(openmm_platform, precision)
+    return openmm_platform
+
+
+def run_benchmark(system_name, platform_name, precision, niterations=5, nsteps_per_iteration=500):
+    """
+    Run and time a short simulation of a benchmark system.
+
+    An additional iteration is run first and discarded from the timings, since
+    it includes the creation of the Contexts.
+
+    Parameters
+    ----------
+    system_name : str
+        The name of the benchmark system in BENCHMARK_SYSTEMS.
+    platform_name : str
+        The name of the OpenMM platform.
+    precision : str
+        The precision model ('single', 'mixed' or 'double') supported by the platform.
+    niterations : int, optional, default=5
+        The number of timed iterations.
+    nsteps_per_iteration : int, optional, default=500
+        The number of timesteps of each iteration.
+
+    Returns
+    -------
+    result : collections.OrderedDict
+        The configuration of the benchmark, the throughput of the dynamics alone
+        ('propagation_ns_per_day') and of the whole iteration ('ns_per_day') summed
+        over replicas, the mean wall clock time per iteration ('iteration_time'),
+        spent computing energies ('energies_time'), mixing replicas ('mixing_time')
+        and writing the NetCDF file ('io_time') in seconds, and the fraction of the
+        iteration time not spent integrating the dynamics ('overhead_fraction').
+
+    """
+    reference_system, positions, alchemical_atoms, alchemical_states = BENCHMARK_SYSTEMS[system_name]()
+    factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=alchemical_atoms)
+    base_state = ThermodynamicState(temperature=300.0*unit.kelvin)
+    base_state.system = factory.alchemically_modified_system
+    openmm_platform = _configure_platform(platform_name, precision)
+
+    # The initial frame counts as an iteration in the store file.
+    options = {'number_of_iterations': niterations + 2, 'nsteps_per_iteration': nsteps_per_iteration,
+               'minimize': False, 'number_of_equilibration_iterations': 0,
+               'show_energies': False, 'show_mixing_statistics': False}
+
+    logger.info("Running benchmark of %s system on %s platform with %s precision..." %
+                (system_name, platform_name, precision))
+    store_directory = tempfile.mkdtemp()
+    try:
+        store_filename = os.path.join(store_directory, 'benchmark.nc')
+        simulation = ModifiedHamiltonianExchange(store_filename, platform=openmm_platform)
+        simulation.create(base_state, alchemical_states, positions, options=options)
+        simulation.run()
+        ns_per_iteration = simulation.nstates * simulation.nsteps_per_iteration * simulation.timestep / unit.nanoseconds
+        nstates, natoms = simulation.nstates, simulation.natoms
+        del simulation
+        summary = analyze.compute_timings_summary(store_filename, first_iteration=2)
+    finally:
+        shutil.rmtree(store_directory)
+
+    iteration_time = summary['total_time'] / summary['niterations']
+    dynamics_time = summary['details']['propagate']['mean']
+    return collections.OrderedDict([
+        ('system', system_name),
+        ('natoms', int(natoms)),
+        ('nstates', int(nstates)),
+        ('platform', platform_name),
+        ('precision', precision),
+        ('niterations', summary['niterations']),
+        ('nsteps_per_iteration', nsteps_per_iteration),
+        ('propagation_ns_per_day', ns_per_iteration / dynamics_time * 86400.0),
+        ('ns_per_day', ns_per_iteration / iteration_time * 86400.0),
+        ('iteration_time', iteration_time),
+        ('energies_time', summary['steps']['energies']['mean']),
+        ('mixing_time', summary['steps']['mixing']['mean']),
+        ('io_time', summary['steps']['io']['mean']),
+        ('overhead_fraction', 1.0 - summary['details']['propagate']['fraction']),
+    ])
+
+
+def run_benchmarks(system_names=None, platform_names=None, precisions=None, niterations=5,
+                   nsteps_per_iteration=500):
+    """
+    Run the benchmarks of the given systems on each platform and precision model.
+
+    Parameters
+    ----------
+    system_names : list of str, optional
+        The names of the benchmark systems (default is all the BENCHMARK_SYSTEMS).
+    platform_names : list of str, optional
+        The names of the OpenMM platforms (default is all the available platforms).
+    precisions : list of str, optional
+        The precision models to benchmark. The precision models that a platform
+        does not support are skipped. By default, only the default precision
+        model of each platform is benchmarked.
+    niterations : int, optional, default=5
+        The number of timed iterations of each benchmark.
+    nsteps_per_iteration : int, optional, default=500
+        The number of timesteps of each iteration.
+
+    Returns
+    -------
+    report : collections.OrderedDict
+        The versions of YANK and OpenMM, the host name, the timestamp, and the
+        list of the results of run_benchmark() under 'benchmarks'.
+
+    """
+    from . import version
+
+    if system_names is None:
+        system_names = list(BENCHMARK_SYSTEMS)
+    if platform_names is None:
+        platform_names = [openmm.Platform.getPlatform(index).getName()
+                          for index in range(openmm.Platform.getNumPlatforms())]
+
+    benchmarks = []
+    for platform_name in platform_names:
+        supported_precisions = PLATFORM_PRECISIONS.get(platform_name, [])
+        if precisions is None:
+            platform_precisions = supported_precisions[:1]
+        else:
+            platform_precisions = [precision for precision in precisions if precision in supported_precisions]
+        if len(platform_precisions) == 0:
+            logger.warning("Skipping %s platform: no supported precision model to benchmark." % platform_name)
+        for precision in platform_precisions:
+            for system_name in system_names:
+                try:
+                    result = run_benchmark(system_name, platform_name, precision, niterations=niterations,
+                                           nsteps_per_iteration=nsteps_per_iteration)
+                except Exception as e:
+                    logger.warning("Benchmark of %s system on %s platform with %s precision failed: %s" %
+                                   (system_name, platform_name, precision, str(e)))
+                    continue
+                logger.info("  %.2f ns/day propagation, %.3f s/iteration (energies %.3f s, mixing %.3f s, "
+                            "I/O %.3f s), %.1f%% overhead" %
+                            (result['propagation_ns_per_day'], result['iteration_time'], result['energies_time'],
+                             result['mixing_time'], result['io_time'], 100 * result['overhead_fraction']))
+                benchmarks.append(result)
+
+    return collections.OrderedDict([
+        ('yank_version', version.version),
+        ('openmm_version', openmm.version.version),
+        ('hostname', platform.node()),
+        ('timestamp', time.ctime()),
+        ('benchmarks', benchmarks),
+    ])
+
+
+def compare_to_baseline(report, baseline, tolerance=0.1):
+    """
+    Find the performance regressions of a benchmark report with respect to a baseline.
+
+    The benchmarks are matched by system, platform and precision model, and
+    those without a match in the baseline are ignored.
+
+    Parameters
+    ----------
+    report : dict
+        The benchmark report returned by run_benchmarks().
+    baseline : dict
+        A benchmark report of a previous run (e.g. read from its JSON file).
+    tolerance : float, optional, default=0.1
+        The relative change of a metric in the wrong direction above which it is
+        reported as a regression.
+
+    Returns
+    -------
+    regressions : list of collections.OrderedDict
+        The system, platform, precision, metric, baseline and new value, and
+        relative change of each regression.
+
+    """
+    def benchmark_key(benchmark):
+        return benchmark['system'], benchmark['platform'], benchmark['precision']
+
+    baseline_benchmarks = {benchmark_key(benchmark): benchmark for benchmark in baseline['benchmarks']}
+
+    regressions = []
+    for benchmark in report['benchmarks']:
+        baseline_benchmark = baseline_benchmarks.get(benchmark_key(benchmark), None)
+        if baseline_benchmark is None:
+            continue
+        for metric, higher_is_better in BENCHMARK_METRICS.items():
+            baseline_value, value = baseline_benchmark.get(metric, None), benchmark[metric]
+            if not baseline_value:
+                continue
+            relative_change = (value - baseline_value) / baseline_value
+            if (-relative_change if higher_is_better else relative_change) > tolerance:
+                regressions.append(collections.OrderedDict([
+                    ('system', benchmark['system']),
+                    ('platform', benchmark['platform']),
+                    ('precision', benchmark['precision']),
+                    ('metric', metric),
+                    ('baseline', baseline_value),
+                    ('value', value),
+                    ('relative_change', relative_change),
+                ]))
+    return regressions
@@ -37,6 +37,7 @@ Commands:
   status                        Get the current status
   analyze                       Analyze data OR extract trajectory from a NetCDF file in a common format.
   cleanup                       Clean up (delete) run files.
+  benchmark                     Benchmark YANK on the available OpenMM platforms.
 
 Options:
   -h --help                     Display this message and quit
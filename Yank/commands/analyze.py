@@ -13,7 +13,9 @@ Analyze YANK output file.
 # MODULE IMPORTS
 # =============================================================================================
 
-from .. import utils, analyze
+import yaml
+
+from .. import utils, analyze, reevaluation
 
 # =============================================================================================
 # COMMAND-LINE INTERFACE
@@ -23,19 +25,56 @@ usage = """
 YANK analyze
 
 Usage:
-  yank analyze (-s STORE | --store=STORE) [-v | --verbose]
-  yank analyze extract-trajectory --netcdf=FILEPATH (--state=STATE | --replica=REPLICA) --trajectory=FILEPATH [--start=START_FRAME] [--skip=SKIP_FRAME] [--end=END_FRAME] [--nosolvent] [--discardequil] [--imagemol] [-v | --verbose]
+  yank analyze (-s STORE | --store=STORE) [--nocache] [--bootstrap=NBOOTSTRAPS] [--blocksize=BLOCK_SIZE] [--seed=SEED] [-v | --verbose]
+  yank analyze batch --output=DIRECTORY --table=FILEPATH [--nprocesses=N] [--nocache] [-v | --verbose]
+  yank analyze convergence --netcdf=FILEPATH [--table=FILEPATH] [--npoints=NPOINTS] [--nprocesses=N] [-v | --verbose]
+  yank analyze reevaluate --netcdf=FILEPATH --protocol=FILEPATH [--nprocesses=N] [--platform=PLATFORM] [-v | --verbose]
+  yank analyze export-energies --netcdf=FILEPATH [--directory=DIRECTORY] [-v | --verbose]
+  yank analyze timings --netcdf=FILEPATH [-v | --verbose]
+  yank analyze extract-trajectory --netcdf=FILEPATH (--state=STATE | --replica=REPLICA | --all-states) --trajectory=FILEPATH [--start=START_FRAME] [--skip=SKIP_FRAME] [--end=END_FRAME] [--nosolvent] [--discardequil] [--imagemol] [-v | --verbose]
 
 Description:
   Analyze the data to compute Free Energies OR extract the trajectory from the NetCDF file into a common fortmat.
+  The batch command analyzes all the experiments found under DIRECTORY in parallel.
+  The convergence command computes the free energy of a phase as a function of the simulation length.
+  The reevaluate command computes the energies of the stored configurations in new alchemical states, whose
+  free energies are then reported by the analysis.
+  The export-energies command writes the states and energies to .npy files that can be memory-mapped.
+  The timings command reports where the wall clock time of the simulation goes (mixing, propagation, energies,
+  I/O, MPI synchronization and load imbalance).
 
 Free Energy Required Arguments:
   -s=STORE, --store=STORE       Storage directory for NetCDF data files.
 
+Free Energy Options:
+  --nocache                     Do not read or write the analysis cache files next to the NetCDF files
+  --bootstrap=NBOOTSTRAPS       Estimate the confidence interval of each phase from NBOOTSTRAPS bootstrap replicates
+  --blocksize=BLOCK_SIZE        Number of consecutive decorrelated iterations resampled together [default: 1]
+  --seed=SEED                   Seed of the bootstrap resampling [default: 0]
+
+Batch Analysis Arguments:
+  --output=DIRECTORY            Directory searched for experiments (directories with an analysis.yaml script)
+  --table=FILEPATH              Path to the CSV table of the free energies to create
+  --nprocesses=N                Number of processes analyzing the phases (default is the number of CPUs)
+
+Convergence Analysis Arguments:
+  --npoints=NPOINTS             Number of fractions of the data at which forward and reverse estimates are computed [default: 10]
+
+Re-evaluation Arguments:
+  --protocol=FILEPATH           YAML file mapping each alchemical parameter to the list of its values in the new states
+                                (e.g. {lambda_electrostatics: [0.0, 0.0], lambda_sterics: [0.5, 0.25]})
+  --platform=PLATFORM           OpenMM platform used to compute the energies
+
+Export Energies Arguments:
+  --directory=DIRECTORY         Directory of the .npy files and their manifest.json (default is the path of the
+                                NetCDF file with the .energies extension)
+
 Extract Trajectory Required Arguments:
   --netcdf=FILEPATH             Path to the NetCDF file.
   --state=STATE_IDX             Index of the alchemical state for which to extract the trajectory
   --replica=REPLICA_IDX         Index of the replica for which to extract the trajectory
+  --all-states                  Extract the trajectories of all the alchemical states in a single pass
+                                (the trajectory of state N is written to TRAJECTORY-stateN.EXT)
   --trajectory=FILEPATH         Path to the trajectory file to create (extension determines the format)
 
 Extract Trajectory Options:
@@ -62,7 +101,44 @@ def dispatch(args):
     if args['extract-trajectory']:
         return dispatch_extract_trajectory(args)
 
-    analyze.analyze(args['--store'])
+    if args['reevaluate']:
+        return dispatch_reevaluate(args)
+
+    if args['timings']:
+        analyze.print_timings(args['--netcdf'])
+        return True
+
+    if args['export-energies']:
+        analyze.export_energies(args['--netcdf'], export_directory=args['--directory'])
+        return True
+
+    if args['convergence']:
+        n_processes = int(args['--nprocesses']) if args['--nprocesses'] else None
+        analyze.analyze_convergence(args['--netcdf'], table_path=args['--table'],
+                                    npoints=int(args['--npoints']), n_processes=n_processes)
+        return True
+
+    if args['batch']:
+        n_processes = int(args['--nprocesses']) if args['--nprocesses'] else None
+        analyze.analyze_batch(args['--output'], args['--table'], n_processes=n_processes,
+                              use_cache=not args['--nocache'])
+        return True
+
+    nbootstraps = int(args['--bootstrap']) if args['--bootstrap'] else 0
+    analyze.analyze(args['--store'], use_cache=not args['--nocache'], nbootstraps=nbootstraps,
+                    block_size=int(args['--blocksize']), seed=int(args['--seed']))
+    return True
+
+
+def dispatch_reevaluate(args):
+    with open(args['--protocol'], 'r') as f:
+        protocol = yaml.load(f)
+    parameters = list(protocol.keys())
+    alchemical_states = [dict(zip(parameters, values)) for values in zip(*[protocol[p] for p in parameters])]
+
+    n_processes = int(args['--nprocesses']) if args['--nprocesses'] else None
+    reevaluation.reevaluate_energies(args['--netcdf'], alchemical_states, n_processes=n_processes,
+                                     platform_name=args['--platform'])
     return True
 
 
@@ -76,7 +152,7 @@ def dispatch_extract_trajectory(args):
 
     if args['--state']:
         kwargs['state_index'] = int(args['--state'])
-    else:
+    elif args['--replica']:
         kwargs['replica_index'] = int(args['--replica'])
 
     if args['--start']:
@@ -94,6 +170,9 @@ def dispatch_extract_trajectory(args):
         kwargs['image_molecules'] = True
 
     # Extract trajectory
-    analyze.extract_trajectory(output_path, nc_path, **kwargs)
+    if args['--all-states']:
+        analyze.extract_state_trajectories(output_path, nc_path, **kwargs)
+    else:
+        analyze.extract_trajectory(output_path, nc_path, **kwargs)
 
     return True
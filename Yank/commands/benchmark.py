@@ -0,0 +1,95 @@
+#!/usr/local/bin/env python
+
+# =============================================================================================
+# MODULE DOCSTRING
+# =============================================================================================
+
+"""
+Benchmark YANK on the available OpenMM platforms.
+
+"""
+
+# =============================================================================================
+# MODULE IMPORTS
+# =============================================================================================
+
+import sys
+import json
+import logging
+
+from .. import utils
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================================
+# COMMAND-LINE INTERFACE
+# =============================================================================================
+
+usage = """
+YANK benchmark
+
+Usage:
+  yank benchmark [--systems=SYSTEMS] [--platforms=PLATFORMS] [--precisions=PRECISIONS] [--iterations=N] [--nsteps=NSTEPS] [--output=FILEPATH] [--baseline=FILEPATH] [--tolerance=TOLERANCE] [-v | --verbose]
+
+Description:
+  Run a few iterations of small, medium and large alchemical systems with each OpenMM platform and precision model,
+  and report the propagation throughput and the time spent computing energies, mixing replicas and writing the NetCDF
+  file as JSON. If the report of a previous benchmark is given as baseline, the performance regressions are added to
+  the report and the command exits with an error.
+
+Options:
+  --systems=SYSTEMS             Comma-separated benchmark systems among small, medium and large [default: small,medium,large]
+  --platforms=PLATFORMS         Comma-separated OpenMM platforms (default is all the available platforms)
+  --precisions=PRECISIONS       Comma-separated precision models among single, mixed and double (default is the
+                                default precision model of each platform)
+  --iterations=N                Number of timed iterations of each benchmark [default: 5]
+  --nsteps=NSTEPS               Number of timesteps per iteration [default: 500]
+  --output=FILEPATH             Path to the JSON report to create (default is printing the report)
+  --baseline=FILEPATH           JSON report of a previous benchmark to compare with
+  --tolerance=TOLERANCE         Relative change of a metric that is reported as a regression [default: 0.1]
+
+General Options:
+  -v, --verbose                 Print verbose output
+
+"""
+
+# =============================================================================================
+# COMMAND DISPATCH
+# =============================================================================================
+
+
+def dispatch(args):
+    from .. import benchmark
+
+    utils.config_root_logger(args['--verbose'])
+
+    def split_list(argument):
+        return None if argument is None else argument.split(',')
+
+    report = benchmark.run_benchmarks(system_names=split_list(args['--systems']),
+                                      platform_names=split_list(args['--platforms']),
+                                      precisions=split_list(args['--precisions']),
+                                      niterations=int(args['--iterations']),
+                                      nsteps_per_iteration=int(args['--nsteps']))
+
+    regressions = []
+    if args['--baseline']:
+        with open(args['--baseline'], 'r') as f:
+            baseline = json.load(f)
+        regressions = benchmark.compare_to_baseline(report, baseline, tolerance=float(args['--tolerance']))
+        report['regressions'] = regressions
+        for regression in regressions:
+            logger.warning("Regression of %s system on %s platform with %s precision: %s changed by %+.1f%% "
+                           "(%.4g -> %.4g)" % (regression['system'], regression['platform'], regression['precision'],
+                                               regression['metric'], 100 * regression['relative_change'],
+                                               regression['baseline'], regression['value']))
+
+    if args['--output']:
+        with open(args['--output'], 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if len(regressions) > 0:
+        sys.exit(1)
+    return True
@@ -0,0 +1,208 @@
+#!/usr/local/bin/env python
+
+# ==============================================================================
+# MODULE DOCSTRING
+# ==============================================================================
+
+"""
+Re-evaluate the reduced potentials of the stored configurations in new thermodynamic states.
+
+The positions and box vectors of all the replicas are stored in the NetCDF file
+at every iteration. This makes it possible to add alchemical states (e.g. new
+intermediate lambda values) or to modify the System (e.g. the dispersion cutoff)
+after the simulation, and to estimate the free energies of the new states by
+reweighting the stored samples with MBAR instead of running a new simulation.
+
+"""
+
+# ==============================================================================
+# GLOBAL IMPORTS
+# ==============================================================================
+
+import time
+import logging
+import multiprocessing
+
+import numpy as np
+import netCDF4 as netcdf
+from simtk import openmm, unit
+
+from alchemy import AbsoluteAlchemicalFactory, AlchemicalState
+
+from . import analyze
+from .repex import ThermodynamicState
+
+logger = logging.getLogger(__name__)
+
+
+# ==============================================================================
+# WORKER PROCESSES
+# ==============================================================================
+
+# Iterations read from the store file by each worker task.
+ITERATIONS_PER_TASK = 10
+
+# The Context and states of the worker process, set by _initialize_worker().
+_worker = None
+
+
+class _ReevaluationWorker(object):
+    """Context, thermodynamic states and open store file cached by a worker process."""
+
+    def __init__(self, store_filename, serialized_system, temperature, pressure,
+                 alchemical_states, platform_name):
+        self.system = openmm.XmlSerializer.deserialize(serialized_system)
+        self.is_periodic = self.system.usesPeriodicBoundaryConditions()
+        self.states = [ThermodynamicState(system=self.system, temperature=temperature, pressure=pressure)
+                       for _ in alchemical_states]
+        self.alchemical_states = alchemical_states
+
+        integrator = openmm.VerletIntegrator(1.0 * unit.femtoseconds)
+        if platform_name is None:
+            self.context = openmm.Context(self.system, integrator)
+        else:
+            platform = openmm.Platform.getPlatformByName(platform_name)
+            self.context = openmm.Context(self.system, integrator, platform)
+        self.integrator = integrator
+        self.ncfile = netcdf.Dataset(store_filename, 'r')
+
+    def compute_energies(self, iterations):
+        """Compute u_kl[n,i,l] of replica i at the given iterations in each new state l."""
+        positions = self.ncfile.variables['positions']
+        box_vectors = self.ncfile.variables['box_vectors']
+        nreplicas = positions.shape[1]
+        u_kl = np.zeros([len(iterations), nreplicas, len(self.states)], np.float64)
+        for index, iteration in enumerate(iterations):
+            iteration_positions = np.array(positions[iteration, :, :, :], np.float64)
+            iteration_box_vectors = np.array(box_vectors[iteration, :, :, :], np.float64)
+            for replica_index in range(nreplicas):
+                replica_positions = unit.Quantity(iteration_positions[replica_index], unit.nanometers)
+                replica_box_vectors = None
+                if self.is_periodic:
+                    replica_box_vectors = unit.Quantity([openmm.Vec3(*vector) for vector in
+                                                         iteration_box_vectors[replica_index]], unit.nanometers)
+                for state_index, state in enumerate(self.states):
+                    AbsoluteAlchemicalFactory.perturbContext(self.context, self.alchemical_states[state_index])
+                    u_kl[index, replica_index, state_index] = state.reduced_potential(
+                        replica_positions, box_vectors=replica_box_vectors, context=self.context)
+        return u_kl
+
+    def close(self):
+        """Close the store file and delete the Context."""
+        self.ncfile.close()
+        del self.context, self.integrator
+
+
+def _initialize_worker(*args):
+    """Create the Context and thermodynamic states of the worker process."""
+    global _worker
+    _worker = _ReevaluationWorker(*args)
+
+
+def _finalize_worker():
+    """Close the store file and delete the Context of the worker process."""
+    global _worker
+    if _worker is not None:
+        _worker.close()
+        _worker = None
+
+
+def _compute_energies(iterations):
+    """Compute the energies of a batch of iterations in the worker process."""
+    return _worker.compute_energies(iterations)
+
+
+# ==============================================================================
+# RE-EVALUATION
+# ==============================================================================
+
+def reevaluate_energies(store_filename, alchemical_states, system=None, iterations=None,
+                        n_processes=None, platform_name=None):
+    """
+    Compute the reduced potentials of the stored configurations in new alchemical states.
+
+    The energies are computed by a pool of worker processes, each caching a
+    single Context that is perturbed to the new alchemical states. The result
+    is saved next to the store file (see analyze.get_reevaluated_energies_path())
+    where analyze.analyze_phase() will find it and report the free energies
+    of the new states.
+
+    Parameters
+    ----------
+    store_filename : str
+        The path to the NetCDF store file of the phase.
+    alchemical_states : list of AlchemicalState or dict
+        The alchemical parameters of the new states.
+    system : simtk.openmm.System, optional
+        The alchemically-modified System to evaluate (e.g. with a modified
+        cutoff). Default is the System of the thermodynamic states in the
+        store file, which includes restraints.
+    iterations : list of int, optional
+        The iterations to re-evaluate. Default is the equilibrated,
+        decorrelated iterations used by analyze.analyze_phase().
+    n_processes : int, optional
+        The number of worker processes. Default is the number of CPUs.
+    platform_name : str, optional
+        The name of the OpenMM platform used by the workers.
+
+    Returns
+    -------
+    reevaluated_energies : dict
+        The 'iterations', the 'states' of the replicas at those iterations and
+        the 'energies' u_kl[n,i,l] of replica i at iteration n in the new
+        state l, as saved to the file.
+
+    """
+    alchemical_states = [alchemical_state if isinstance(alchemical_state, AlchemicalState)
+                         else AlchemicalState(**alchemical_state) for alchemical_state in alchemical_states]
+
+    # Select the decorrelated iterations of the analysis by default.
+    if iterations is None:
+        analyze.analyze_phase(store_filename)
+        iterations = analyze.get_decorrelated_iterations(store_filename)
+    iterations = np.asarray(iterations, dtype=np.int64)
+
+    ncfile = netcdf.Dataset(store_filename, 'r')
+    try:
+        states = np.array(ncfile.variables['states'][iterations, :], np.int32)
+        ncgrp_stateinfo = ncfile.groups['thermodynamic_states']
+        temperature = float(ncgrp_stateinfo.variables['temperatures'][0]) * unit.kelvin
+        pressure = None
+        if 'pressures' in ncgrp_stateinfo.variables:
+            pressure = float(ncgrp_stateinfo.variables['pressures'][0]) * unit.atmospheres
+        if system is None:
+            serialized_system = str(ncgrp_stateinfo.variables['base_system'][0])
+        else:
+            serialized_system = openmm.XmlSerializer.serialize(system)
+    finally:
+        ncfile.close()
+
+    logger.info("Re-evaluating {} iterations in {} new states...".format(len(iterations), len(alchemical_states)))
+    initial_time = time.time()
+    initargs = (store_filename, serialized_system, temperature, pressure, alchemical_states, platform_name)
+    tasks = [iterations[i:i+ITERATIONS_PER_TASK] for i in range(0, len(iterations), ITERATIONS_PER_TASK)]
+    if n_processes == 1:
+        # Run in this process, closing the store file so that it can be opened again for writing.
+        try:
+            _initialize_worker(*initargs)
+            energies = [_compute_energies(task) for task in tasks]
+        finally:
+            _finalize_worker()
+    else:
+        pool = multiprocessing.Pool(n_processes, initializer=_initialize_worker, initargs=initargs)
+        try:
+            energies = pool.map(_compute_energies, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    logger.info("Re-evaluation took {:.3f} s.".format(time.time() - initial_time))
+
+    alchemical_parameters = sorted(alchemical_states[0].keys())
+    reevaluated_energies = dict(
+        iterations=iterations, states=states, energies=np.concatenate(energies),
+        alchemical_parameters=np.array(alchemical_parameters),
+        alchemical_values=np.array([[float(alchemical_state[parameter]) for parameter in alchemical_parameters]
+                                    for alchemical_state in alchemical_states])
+    )
+    analyze.write_reevaluated_energies(store_filename, reevaluated_energies)
+    return reevaluated_energies
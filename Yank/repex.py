@@ -63,6 +63,11 @@ import os, os.path
 import math
 import copy
 import time
+import collections
+import contextlib
+import zlib
+import pickle
+import hashlib
 import datetime
 import logging
 
@@ -70,7 +75,8 @@ import numpy as np
 import mdtraj as md
 import netCDF4 as netcdf
 
-from .utils import is_terminal_verbose, delayed_termination
+from .utils import (is_terminal_verbose, delayed_termination, write_store_index,
+                    TimelineTracer, get_timeline_trace_path, get_metrics_path, write_openmetrics)
 
 logger = logging.getLogger(__name__)
 
@@ -438,6 +444,19 @@ class ThermodynamicState(object):
         volume = np.linalg.det(A) * a.unit**3
         return volume
 
+class _NullSpan(object):
+    """
+    Context manager doing nothing, used in place of the spans of a disabled timeline tracer.
+
+    """
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
 #=============================================================================================
 # Replica-exchange simulation
 #=============================================================================================
@@ -495,6 +514,40 @@ class ReplicaExchange(object):
        If True, analysis will occur each iteration (default: False).
     online_analysis_min_iterations : int
        Minimum number of iterations needed to begin online analysis (default: 20).
+    online_analysis_interval : int
+       Number of iterations between two MBAR solutions during online analysis. The
+       energies are still accumulated every iteration (default: 10).
+    online_analysis_async : bool
+       If True, online analysis runs in a separate process that publishes its latest
+       estimate to a JSON file next to the store file, and the simulation never waits
+       for it (default: False).
+    online_analysis_target_error : float
+       If positive, the simulation stops once the online analysis estimates the uncertainty
+       of the free energy difference between the end states to be at most this many kT
+       (default: 0.0).
+    online_analysis_min_effective_samples : int
+       If positive, the simulation stops only once the online analysis estimates at least
+       this many effectively uncorrelated samples (default: 0).
+    online_analysis_max_relative_change : float
+       If positive, the simulation stops only once the free energy difference between the
+       end states has changed by at most this fraction, or by at most the uncertainty of the
+       latest estimate if that is larger (e.g. for free energies close to zero), over the last
+       online_analysis_convergence_window online analysis estimates (default: 0.0).
+    online_analysis_convergence_window : int
+       Number of online analysis estimates used by online_analysis_max_relative_change
+       (default: 5).
+    export_energies : bool
+       If True, the states and energies are exported to memory-mappable .npy files next to
+       the store file at the end of each run (see analyze.export_energies()) (default: False).
+    timeline_trace : bool
+       If True, the begin and end of the propagation, energy evaluation, MPI collective calls
+       and storage writes of each rank are recorded and written at the end of each run to a
+       Chrome trace format JSON file next to the store file (default: False).
+    metrics_directory : str
+       If not None, each MPI rank rewrites an OpenMetrics text file with the throughput
+       and acceptance statistics of the simulation in this directory at each iteration,
+       to be read for example by the textfile collector of the Prometheus node exporter
+       (see utils.get_metrics_path()). This is not stored in the store file (default: None).
     show_energies : bool
        If True, will print energies at each iteration (default: True).
     show_mixing_statistics : bool
@@ -564,6 +617,15 @@ class ReplicaExchange(object):
                           'replica_mixing_scheme': 'swap-all',
                           'online_analysis': False,
                           'online_analysis_min_iterations': 20,
+                          'online_analysis_interval': 10,
+                          'online_analysis_async': False,
+                          'online_analysis_target_error': 0.0,
+                          'online_analysis_min_effective_samples': 0,
+                          'online_analysis_max_relative_change': 0.0,
+                          'online_analysis_convergence_window': 5,
+                          'export_energies': False,
+                          'timeline_trace': False,
+                          'metrics_directory': None,  # Do not save this option as its an on-the-fly setting
                           'show_energies': True,
                           'show_mixing_statistics': True
                           }
@@ -571,7 +633,11 @@ class ReplicaExchange(object):
     # Options to store.
     options_to_store = ['collision_rate', 'constraint_tolerance', 'timestep', 'nsteps_per_iteration',
                         'number_of_iterations', 'equilibration_timestep', 'number_of_equilibration_iterations', 'title',
-                        'minimize', 'replica_mixing_scheme', 'online_analysis', 'show_mixing_statistics']
+                        'minimize', 'replica_mixing_scheme', 'online_analysis', 'online_analysis_interval',
+                        'online_analysis_async', 'online_analysis_target_error',
+                        'online_analysis_min_effective_samples', 'online_analysis_max_relative_change',
+                        'online_analysis_convergence_window', 'export_energies', 'timeline_trace',
+                        'show_mixing_statistics']
 
     def __init__(self, store_filename, mpicomm=None, platform=None, mm=None, **kwargs):
         """
@@ -619,6 +685,35 @@ class ReplicaExchange(object):
         # Record store file filename
         self.store_filename = store_filename
 
+        # Replica data of the last stored iteration read by resume().
+        self._resume_replica_data = None
+
+        # Incremental online analysis, created on first use. The asynchronous
+        # online analysis process is restarted at most once if it dies.
+        self._online_analysis = None
+        self._online_analysis_worker = None
+        self._online_analysis_worker_restarted = False
+        self._online_analysis_worker_disabled = False
+
+        # Free energy estimates used to check the convergence criteria, and the
+        # iteration at which they were met (None if the simulation hasn't converged).
+        self._convergence_history = []
+        self.converged_iteration = None
+
+        # Wall clock time and numbers of accepted and proposed swaps between different
+        # states of the last iterations, averaged in the progress reports.
+        self._iteration_statistics = collections.deque(maxlen=10)
+
+        # Wall clock times of the steps of the current iteration, written to the timings group.
+        self._timings = dict()
+
+        # Timeline tracer of the current run, if the timeline_trace option is on.
+        self._tracer = None
+
+        # Number of NaN retries and proposed and accepted MC moves of this
+        # rank since the simulation object was created, exported as metrics.
+        self._event_counts = collections.Counter()
+
         # Check if netcdf file exists, assuming we want to resume if one exists.
         self._resume = os.path.exists(self.store_filename) and (os.path.getsize(self.store_filename) > 0)
         if self.mpicomm:
@@ -715,12 +810,16 @@ class ReplicaExchange(object):
         if not file_exists:
             raise Exception("NetCDF file %s does not exist; cannot resume." % self.store_filename)
 
-        # Try to restore thermodynamic states and run options from the NetCDF file.
-        ncfile = netcdf.Dataset(self.store_filename, 'r')
-        self._restore_thermodynamic_states(ncfile)
-        self._restore_options(ncfile)
-        self._restore_metadata(ncfile)
-        ncfile.close()
+        # Restore thermodynamic states, run options, and metadata from the NetCDF
+        # file. The file is read only by the root node, which broadcasts the data.
+        resume_data = self._read_store(self._read_resume_data)
+        self._build_thermodynamic_states(resume_data['thermodynamic_states'])
+        for option_name, option_value in resume_data['options'].items():
+            setattr(self, option_name, option_value)
+        self.metadata = resume_data['metadata']
+
+        # Keep the last iteration data so that we don't have to read the file again on initialization.
+        self._resume_replica_data = resume_data['replicas']
 
         # Determine number of replicas from the number of specified thermodynamic states.
         self.nreplicas = len(self.states)
@@ -778,30 +877,14 @@ class ReplicaExchange(object):
 
         return r
 
-    @classmethod
-    def _status_from_ncfile(cls, ncfile):
-        """
-        Return status dict of current calculation.
-
-        Returns
-        -------
-        status : dict
-           Returns a dict of useful information about current simulation progress.
-
-        """
-        status = dict()
-
-        status['number_of_iterations'] = ncfile.variables['positions'].shape[0]
-        status['nstates'] = ncfile.variables['positions'].shape[1]
-        status['natoms'] = ncfile.variables['positions'].shape[2]
-
-        return status
-
     @classmethod
     def status_from_store(cls, store_filename):
         """
         Return status dict of calculation on disk.
 
+        The store file is read with a lightweight read-only handle, so this is
+        safe to call while the simulation is running.
+
         Parameters
         ----------
         store_filename : str
@@ -813,10 +896,9 @@ class ReplicaExchange(object):
            Returns a dict of useful information about current simulation progress.
 
         """
-        ncfile = netcdf.Dataset(store_filename, 'r')
-        status = ReplicaExchange._status_from_ncfile(ncfile)
-        ncfile.close()
-        return status
+        from .analyze import PhaseReader
+        with PhaseReader(store_filename) as reader:
+            return reader.status()
 
     def status(self):
         """
@@ -828,11 +910,7 @@ class ReplicaExchange(object):
            Returns a dict of useful information about current simulation progress.
 
         """
-        ncfile = netcdf.Dataset(self.store_filename, 'r')
-        status = ReplicaExchange._status_from_ncfile(self.ncfile)
-        ncfile.close()
-
-        return status
+        return self.status_from_store(self.store_filename)
 
     def run(self, niterations_to_run=None):
         """
@@ -868,53 +946,111 @@ class ReplicaExchange(object):
             iteration_limit = min(self.iteration + niterations_to_run, default_iteration_limit)
         else:
             iteration_limit = default_iteration_limit
-        while (self.iteration < iteration_limit):
-            logger.debug("\nIteration %d / %d" % (self.iteration+1, iteration_limit))
-            initial_time = time.time()
-
-            # Attempt replica swaps to sample from equilibrium permuation of states associated with replicas.
-            self._mix_replicas()
-
-            # Propagate replicas.
-            self._propagate_replicas()
-
-            # Compute energies of all replicas at all states.
-            self._compute_energies()
-
-            # Show energies.
-            if self.show_energies:
-                self._show_energies()
 
-            # Write iteration to storage file.
-            self._write_iteration_netcdf()
-
-            # Increment iteration counter.
-            self.iteration += 1
-
-            # Show mixing statistics.
-            if self.show_mixing_statistics:
-                self._show_mixing_statistics()
-
-            # Perform online analysis.
-            if self.online_analysis:
-                self._analysis()
-
-            # Show timing statistics if debug level is activated
-            if logger.isEnabledFor(logging.DEBUG):
-                final_time = time.time()
-                elapsed_time = final_time - initial_time
-                estimated_time_remaining = (final_time - run_start_time) / (self.iteration - run_start_iteration) * (iteration_limit - self.iteration)
-                estimated_total_time = (final_time - run_start_time) / (self.iteration - run_start_iteration) * (iteration_limit)
-                estimated_finish_time = final_time + estimated_time_remaining
-                logger.debug("Iteration took %.3f s." % elapsed_time)
-                logger.debug("Estimated completion in %s, at %s (consuming total wall clock time %s)." % (str(datetime.timedelta(seconds=estimated_time_remaining)), time.ctime(estimated_finish_time), str(datetime.timedelta(seconds=estimated_total_time))))
+        # Stop early on convergence, unless the user explicitly asked to extend the simulation.
+        check_convergence = self._has_convergence_criteria() and self.number_of_extension_iterations == 0
+        if check_convergence and self.converged_iteration is not None:
+            logger.info("Simulation converged at iteration %d. Nothing to run." % self.converged_iteration)
+            iteration_limit = self.iteration
+
+        # Record the timeline of the run if requested. The collective calls are
+        # traced by a proxy of the communicator that is removed at the end of the
+        # run, also when an iteration raises.
+        if self.timeline_trace:
+            self._tracer = TimelineTracer(self.mpicomm)
+            if self.mpicomm:
+                self.mpicomm = self._tracer.trace_communicator(self.mpicomm)
 
-            # Perform sanity checks to see if we should terminate here.
-            self._run_sanity_checks()
+        run_completed = False
+        try:
+            while (self.iteration < iteration_limit):
+                logger.debug("\nIteration %d / %d" % (self.iteration+1, iteration_limit))
+                initial_time = time.time()
+                self._timings = dict()
+                if self._tracer is not None:
+                    self._tracer.begin('iteration', 'iteration', {'iteration': self.iteration + 1})
+
+                # Attempt replica swaps to sample from equilibrium permuation of states associated with replicas.
+                with self._timer('mixing'):
+                    self._mix_replicas()
+
+                # Propagate replicas.
+                with self._timer('propagation'):
+                    self._propagate_replicas()
+
+                # Compute energies of all replicas at all states.
+                with self._timer('energies'):
+                    self._compute_energies()
+
+                # Show energies.
+                if self.show_energies:
+                    self._show_energies()
+
+                # Write iteration to storage file. The file is synced before the
+                # timings are written so that flushing it to disk is timed as io.
+                with self._timer('io'):
+                    self._write_iteration_netcdf()
+                    with self._timer('sync'):
+                        self._sync_netcdf()
+                self._record_timing('iteration', time.time() - initial_time)
+                self._write_timings_netcdf()
+                self._write_store_index(sync=False)
+
+                # Increment iteration counter.
+                self.iteration += 1
+
+                # Show mixing statistics.
+                if self.show_mixing_statistics:
+                    self._show_mixing_statistics()
+
+                # Perform online analysis.
+                if self.online_analysis:
+                    self._analysis()
+
+                # Show timing statistics if debug level is activated
+                if logger.isEnabledFor(logging.DEBUG):
+                    final_time = time.time()
+                    elapsed_time = final_time - initial_time
+                    estimated_time_remaining = (final_time - run_start_time) / (self.iteration - run_start_iteration) * (iteration_limit - self.iteration)
+                    estimated_total_time = (final_time - run_start_time) / (self.iteration - run_start_iteration) * (iteration_limit)
+                    estimated_finish_time = final_time + estimated_time_remaining
+                    logger.debug("Iteration took %.3f s." % elapsed_time)
+                    logger.debug("Estimated completion in %s, at %s (consuming total wall clock time %s)." % (str(datetime.timedelta(seconds=estimated_time_remaining)), time.ctime(estimated_finish_time), str(datetime.timedelta(seconds=estimated_total_time))))
+
+                # Perform sanity checks to see if we should terminate here.
+                self._run_sanity_checks()
+
+                # Check if the online analysis estimate has converged.
+                converged = check_convergence and self._check_convergence()
+
+                # Publish the progress of the simulation for yank status. Swaps of
+                # a replica with itself are always accepted and are not counted.
+                self._iteration_statistics.append((time.time() - initial_time,
+                                                   self.Nij_accepted.sum() - np.trace(self.Nij_accepted),
+                                                   self.Nij_proposed.sum() - np.trace(self.Nij_proposed)))
+                self._write_progress(default_iteration_limit)
+                if self.metrics_directory is not None:
+                    self._write_metrics(default_iteration_limit)
+                if self._tracer is not None:
+                    self._tracer.end('iteration', 'iteration')
+
+                if converged:
+                    break
+            run_completed = True
+        finally:
+            # Write the timeline of the run. If an iteration raised, the other MPI
+            # ranks may never reach a collective call, so each rank writes its own events.
+            if self._tracer is not None:
+                self._write_timeline_trace(run_start_iteration, collective=run_completed)
 
         # Clean up and close storage files.
         self._finalize()
 
+        # Export the energies for downstream tools. This does nothing if they are up to date.
+        if self.export_energies and (not self.mpicomm or self.mpicomm.rank == 0):
+            from .analyze import export_energies
+            export_energies(self.store_filename)
+
         return
 
     def _initialize_create(self):
@@ -980,6 +1116,7 @@ class ReplicaExchange(object):
 
         # Store initial state.
         self._write_iteration_netcdf()
+        self._write_store_index()
 
         # Close NetCDF file.
         self.ncfile.close()
@@ -1028,16 +1165,6 @@ class ReplicaExchange(object):
         if not self._resume:
             self.replica_positions = [ copy.deepcopy(self.provided_positions[replica_index % len(self.provided_positions)]) for replica_index in range(self.nstates) ]
 
-        # Assign default box vectors.
-        self.replica_box_vectors = list()
-        for state in self.states:
-            [a,b,c] = state.system.getDefaultPeriodicBoxVectors()
-            box_vectors = unit.Quantity(np.zeros([3,3], np.float32), unit.nanometers)
-            box_vectors[0,:] = a
-            box_vectors[1,:] = b
-            box_vectors[2,:] = c
-            self.replica_box_vectors.append(box_vectors)
-
         # Assign initial replica states.
         for replica_index in range(self.nstates):
             self.replica_states[replica_index] = replica_index
@@ -1046,19 +1173,21 @@ class ReplicaExchange(object):
         if not os.path.exists(self.store_filename):
             raise Exception("Store file %s does not exist." % self.store_filename)
 
-        # Open NetCDF file for reading
-        logger.debug("Reading NetCDF file '%s'..." % self.store_filename)
-        ncfile = netcdf.Dataset(self.store_filename, 'r')
-
-        # Resume from NetCDF file.
-        self._resume_from_netcdf(ncfile)
-
-        # Close NetCDF file.
-        ncfile.close()
+        # Resume positions, box vectors, states and energies from the last
+        # iteration. If resume() has already read them, we don't read the file
+        # again. Only the root node reads the NetCDF file.
+        replica_data = self._resume_replica_data
+        if replica_data is None:
+            logger.debug("Reading NetCDF file '%s'..." % self.store_filename)
+            replica_data = self._read_store(self._read_replica_data)
+        self._resume_replica_data = None
+        self._restore_replica_data(replica_data)
 
         if (self.mpicomm is None) or (self.mpicomm.rank == 0):
             # Reopen NetCDF file for appending, and maintain handle.
             self.ncfile = netcdf.Dataset(self.store_filename, 'a')
+            # Store files created by older versions have no index yet.
+            self._write_store_index()
         else:
             self.ncfile = None
 
@@ -1117,6 +1246,11 @@ class ReplicaExchange(object):
         if hasattr(self, 'ncfile') and self.ncfile:
             self.ncfile.sync()
 
+        # Let the asynchronous online analysis publish its final estimate.
+        if getattr(self, '_online_analysis_worker', None) is not None:
+            self._online_analysis_worker.stop()
+            self._online_analysis_worker = None
+
         return
 
     def __del__(self):
@@ -1237,7 +1371,7 @@ class ReplicaExchange(object):
                 state.system.addForce(barostat)
 
         # Create Context and integrator.
-        integrator = openmm.LangevinIntegrator(state.temperature, self.collision_rate, self.timestep)
+        integrator = self.mm.LangevinIntegrator(state.temperature, self.collision_rate, self.timestep)
         integrator.setRandomNumberSeed(int(np.random.randint(0, MAX_SEED)))
         context = self._create_context(state.system, integrator)
 
@@ -1300,25 +1434,34 @@ class ReplicaExchange(object):
         replica_indices = [ replica_lookup[state_index] for state_index in range(self.mpicomm.rank, self.nstates, self.mpicomm.size) ] # list of replica indices for this node to propagate
         for replica_index in replica_indices:
             logger.debug("Node %3d/%3d propagating replica %3d state %3d..." % (self.mpicomm.rank, self.mpicomm.size, replica_index, self.replica_states[replica_index]))
-            self._propagate_replica(replica_index)
+            with self._trace('propagate', 'replica', replica=replica_index, state=int(self.replica_states[replica_index])):
+                self._record_timing('propagate', self._propagate_replica(replica_index), replica_index)
         end_time = time.time()
         elapsed_time = end_time - start_time
-        # Collect elapsed time.
-        node_elapsed_times = self.mpicomm.gather(elapsed_time, root=0) # barrier
-        if self.mpicomm.rank == 0 and logger.isEnabledFor(logging.DEBUG):
-            node_elapsed_times = np.array(node_elapsed_times)
+        # Collect elapsed time and the per-replica timings of each node.
+        replica_timings = {name: timing for name, timing in self._timings.items() if np.ndim(timing) > 0}
+        node_timings = self.mpicomm.gather((elapsed_time, replica_timings), root=0) # barrier
+        if self.mpicomm.rank == 0:
+            node_elapsed_times = np.array([node_elapsed_time for node_elapsed_time, _ in node_timings])
             end_time = time.time()
             elapsed_time = end_time - start_time
             barrier_wait_times = elapsed_time - node_elapsed_times
+            # Each node has recorded only the timings of the replicas it propagated.
+            for name in replica_timings:
+                self._timings[name] = sum(timings.get(name, 0.0) for _, timings in node_timings)
+            self._record_timing('rank_propagation', node_elapsed_times)
+            self._record_timing('rank_barrier_wait', barrier_wait_times)
+            self._record_timing('barrier_wait', barrier_wait_times[0])
             logger.debug("Running trajectories: elapsed time %.3f s (barrier time min %.3f s | max %.3f s | avg %.3f s)" % (elapsed_time, barrier_wait_times.min(), barrier_wait_times.max(), barrier_wait_times.mean()))
             logger.debug("Total time spent waiting for GPU: %.3f s" % (node_elapsed_times.sum()))
 
         # Send final configurations and box vectors back to all nodes.
         logger.debug("Synchronizing trajectories...")
         start_time = time.time()
-        replica_indices_gather = self.mpicomm.allgather(replica_indices)
-        replica_positions_gather = self.mpicomm.allgather([ self.replica_positions[replica_index] for replica_index in replica_indices ])
-        replica_box_vectors_gather = self.mpicomm.allgather([ self.replica_box_vectors[replica_index] for replica_index in replica_indices ])
+        with self._timer('synchronization'):
+            replica_indices_gather = self.mpicomm.allgather(replica_indices)
+            replica_positions_gather = self.mpicomm.allgather([ self.replica_positions[replica_index] for replica_index in replica_indices ])
+            replica_box_vectors_gather = self.mpicomm.allgather([ self.replica_box_vectors[replica_index] for replica_index in replica_indices ])
         for (source, replica_indices) in enumerate(replica_indices_gather):
             for (index, replica_index) in enumerate(replica_indices):
                 self.replica_positions[replica_index] = replica_positions_gather[source][index]
@@ -1337,7 +1480,8 @@ class ReplicaExchange(object):
         # Propagate all replicas.
         logger.debug("Propagating all replicas for %.3f ps..." % (self.nsteps_per_iteration * self.timestep / unit.picoseconds))
         for replica_index in range(self.nstates):
-            self._propagate_replica(replica_index)
+            with self._trace('propagate', 'replica', replica=replica_index, state=int(self.replica_states[replica_index])):
+                self._record_timing('propagate', self._propagate_replica(replica_index), replica_index)
 
         return
 
@@ -1463,11 +1607,13 @@ class ReplicaExchange(object):
 
             # Compute energies for this node's share of states.
             for state_index in range(self.mpicomm.rank, self.nstates, self.mpicomm.size):
-                for replica_index in range(self.nstates):
-                    self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], platform=self.platform)
+                with self._trace('energy', 'state', state=state_index):
+                    for replica_index in range(self.nstates):
+                        self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], platform=self.platform)
 
             # Send final energies to all nodes.
-            energies_gather = self.mpicomm.allgather(self.u_kl[:,self.mpicomm.rank:self.nstates:self.mpicomm.size])
+            with self._timer('synchronization'):
+                energies_gather = self.mpicomm.allgather(self.u_kl[:,self.mpicomm.rank:self.nstates:self.mpicomm.size])
             for state_index in range(self.nstates):
                 source = state_index % self.mpicomm.size # node with trajectory data
                 index = state_index // self.mpicomm.size # index within trajectory batch
@@ -1476,8 +1622,9 @@ class ReplicaExchange(object):
         else:
             # Serial version.
             for state_index in range(self.nstates):
-                for replica_index in range(self.nstates):
-                    self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], platform=self.platform)
+                with self._trace('energy', 'state', state=state_index):
+                    for replica_index in range(self.nstates):
+                        self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], platform=self.platform)
 
         end_time = time.time()
         elapsed_time = end_time - start_time
@@ -1612,7 +1759,8 @@ class ReplicaExchange(object):
             # Non-root nodes receive state information.
             logger.debug('Node {}/{}: MPI bcast - sharing replica_states'.format(
                     self.mpicomm.rank, self.mpicomm.size))
-            self.replica_states = self.mpicomm.bcast(self.replica_states, root=0)
+            with self._timer('synchronization'):
+                self.replica_states = self.mpicomm.bcast(self.replica_states, root=0)
             return
 
         logger.debug("Mixing replicas...")
@@ -1664,7 +1812,8 @@ class ReplicaExchange(object):
             # Root node will share state information with all replicas.
             logger.debug('Node {}/{}: MPI bcast - sharing replica_states'.format(
                     self.mpicomm.rank, self.mpicomm.size))
-            self.replica_states = self.mpicomm.bcast(self.replica_states, root=0)
+            with self._timer('synchronization'):
+                self.replica_states = self.mpicomm.bcast(self.replica_states, root=0)
 
         # Report on mixing.
         logger.debug("Mixing of replicas took %.3f s" % (end_time - start_time))
@@ -1673,50 +1822,31 @@ class ReplicaExchange(object):
 
     def _accumulate_mixing_statistics(self):
         """Return the mixing transition matrix Tij."""
+        from .analyze import estimate_transition_matrix
         try:
-            return self._accumulate_mixing_statistics_update()
+            self._accumulate_mixing_statistics_update()
         except AttributeError:
-            pass
+            self._accumulate_mixing_statistics_full()
         except ValueError:
             logger.info("Inconsistent transition count matrix detected, recalculating from scratch.")
+            self._accumulate_mixing_statistics_full()
 
-        return self._accumulate_mixing_statistics_full()
+        return estimate_transition_matrix(self._Nij)
 
     def _accumulate_mixing_statistics_full(self):
-        """Compute statistics of transitions iterating over all iterations of repex."""
-        states = self.ncfile.variables['states']
-        self._Nij = np.zeros([self.nstates, self.nstates], np.float64)
-        for iteration in range(states.shape[0]-1):
-            for ireplica in range(self.nstates):
-                istate = states[iteration, ireplica]
-                jstate = states[iteration + 1, ireplica]
-                self._Nij[istate, jstate] += 0.5
-                self._Nij[jstate, istate] += 0.5
-
-        Tij = np.zeros([self.nstates, self.nstates], np.float64)
-        for istate in range(self.nstates):
-            Tij[istate] = self._Nij[istate] / self._Nij[istate].sum()
-
-        return Tij
+        """Count transitions over all iterations of repex with a single read of the states."""
+        from .analyze import count_state_transitions
+        self._Nij = count_state_transitions(self.ncfile.variables['states'][:, :])
 
     def _accumulate_mixing_statistics_update(self):
-        """Compute statistics of transitions updating Nij of last iteration of repex."""
+        """Update the transition counts Nij with the last iteration of repex."""
+        from .analyze import count_state_transitions
 
         states = self.ncfile.variables['states']
         if self._Nij.sum() != (states.shape[0] - 2) * self.nstates:  # n_iter - 2 = (n_iter - 1) - 1.  Meaning that you have exactly one new iteration to process.
             raise(ValueError("Inconsistent transition count matrix detected.  Perhaps you tried updating twice in a row?"))
 
-        for ireplica in range(self.nstates):
-            istate = states[self.iteration-2, ireplica]
-            jstate = states[self.iteration-1, ireplica]
-            self._Nij[istate, jstate] += 0.5
-            self._Nij[jstate, istate] += 0.5
-
-        Tij = np.zeros([self.nstates, self.nstates], np.float64)
-        for istate in range(self.nstates):
-            Tij[istate] = self._Nij[istate] / self._Nij[istate].sum()
-
-        return Tij
+        self._Nij += count_state_transitions(states[self.iteration-2:self.iteration, :])
 
     def _show_mixing_statistics(self):
 
@@ -1727,32 +1857,12 @@ class ReplicaExchange(object):
         if not logger.isEnabledFor(logging.DEBUG):
             return
 
+        from .analyze import log_mixing_statistics
         Tij = self._accumulate_mixing_statistics()
 
-        # Print observed transition probabilities.
+        # Print observed transition probabilities and equilibration time.
         PRINT_CUTOFF = 0.001 # Cutoff for displaying fraction of accepted swaps.
-        logger.debug("Cumulative symmetrized state mixing transition matrix:")
-        str_row = "%6s" % ""
-        for jstate in range(self.nstates):
-            str_row += "%6d" % jstate
-        logger.debug(str_row)
-        for istate in range(self.nstates):
-            str_row = "%-6d" % istate
-            for jstate in range(self.nstates):
-                P = Tij[istate,jstate]
-                if (P >= PRINT_CUTOFF):
-                    str_row += "%6.3f" % P
-                else:
-                    str_row += "%6s" % ""
-            logger.debug(str_row)
-
-        # Estimate second eigenvalue and equilibration time.
-        mu = np.linalg.eigvals(Tij)
-        mu = -np.sort(-mu) # sort in descending order
-        if (mu[1] >= 1):
-            logger.debug("Perron eigenvalue is unity; Markov chain is decomposable.")
-        else:
-            logger.debug("Perron eigenvalue is %9.5f; state equilibration timescale is ~ %.1f iterations" % (mu[1], 1.0 / (1.0 - mu[1])))
+        log_mixing_statistics(Tij, cutoff=PRINT_CUTOFF, log=logger.debug)
 
     def _initialize_netcdf(self):
         """
@@ -1811,11 +1921,33 @@ class ReplicaExchange(object):
         # Create timestamp variable.
         ncvar_timestamp = ncfile.createVariable('timestamp', str, ('iteration',), zlib=False, chunksizes=(1,))
 
-        # Create group for performance statistics.
+        # Create group for performance statistics. The wall clock times of mixing,
+        # propagation, energies and io add up to the iteration time (except for
+        # small overheads), and include the MPI synchronization of each step.
         ncgrp_timings = ncfile.createGroup('timings')
-        ncvar_iteration_time = ncgrp_timings.createVariable('iteration', 'f', ('iteration',), zlib=False, chunksizes=(1,)) # total iteration time (seconds)
-        ncvar_iteration_time = ncgrp_timings.createVariable('mixing', 'f', ('iteration',), zlib=False, chunksizes=(1,)) # time for mixing
-        ncvar_iteration_time = ncgrp_timings.createVariable('propagate', 'f', ('iteration','replica'), zlib=False, chunksizes=(1,self.nreplicas)) # total time to propagate each replica
+        timings_variables = [
+            ('iteration', ('iteration',), "iteration[iteration] is the wall clock time of iteration 'iteration' up to the sync of its data to disk."),
+            ('mixing', ('iteration',), "mixing[iteration] is the wall clock time spent mixing replicas at iteration 'iteration'."),
+            ('propagation', ('iteration',), "propagation[iteration] is the wall clock time spent propagating all replicas at iteration 'iteration'."),
+            ('propagate', ('iteration', 'replica'), "propagate[iteration][replica] is the time spent integrating the dynamics of replica 'replica' at iteration 'iteration'."),
+            ('mc_moves', ('iteration', 'replica'), "mc_moves[iteration][replica] is the time spent in Monte Carlo moves of replica 'replica' at iteration 'iteration'."),
+            ('energies', ('iteration',), "energies[iteration] is the wall clock time spent computing the energies of all replicas in all states at iteration 'iteration'."),
+            ('synchronization', ('iteration',), "synchronization[iteration] is the wall clock time spent in MPI collective calls sharing states, configurations and energies at iteration 'iteration'."),
+            ('barrier_wait', ('iteration',), "barrier_wait[iteration] is the wall clock time the root node waited for the other nodes to complete the propagation at iteration 'iteration'."),
+            ('io', ('iteration',), "io[iteration] is the wall clock time spent writing iteration 'iteration' to the NetCDF file and syncing it to disk."),
+            ('sync', ('iteration',), "sync[iteration] is the wall clock time spent syncing the NetCDF file to disk at iteration 'iteration'."),
+        ]
+        if self.mpicomm:
+            ncgrp_timings.createDimension('rank', self.mpicomm.size)
+            timings_variables += [
+                ('rank_propagation', ('iteration', 'rank'), "rank_propagation[iteration][rank] is the wall clock time node 'rank' spent propagating its replicas at iteration 'iteration'."),
+                ('rank_barrier_wait', ('iteration', 'rank'), "rank_barrier_wait[iteration][rank] is the wall clock time node 'rank' waited for the slowest node after the propagation at iteration 'iteration'."),
+            ]
+        for name, dimensions, long_name in timings_variables:
+            chunksizes = (1,) + tuple(self.nreplicas if dimension == 'replica' else self.mpicomm.size for dimension in dimensions[1:])
+            ncvar_timing = ncgrp_timings.createVariable(name, 'f', dimensions, zlib=False, chunksizes=chunksizes)
+            setattr(ncvar_timing, 'units', 's')
+            setattr(ncvar_timing, 'long_name', long_name)
 
         # Store thermodynamic states.
         self._store_thermodynamic_states(ncfile)
@@ -1848,11 +1980,12 @@ class ReplicaExchange(object):
 
         initial_time = time.time()
 
-        # Store replica positions.
+        # Store replica positions. All replicas share a single compressed chunk,
+        # which must be written at once to avoid compressing it once per replica.
+        x = np.zeros([self.nstates, self.natoms, 3], np.float32)
         for replica_index in range(self.nstates):
-            positions = self.replica_positions[replica_index]
-            x = positions / unit.nanometers
-            self.ncfile.variables['positions'][self.iteration,replica_index,:,:] = x[:,:]
+            x[replica_index,:,:] = self.replica_positions[replica_index] / unit.nanometers
+        self.ncfile.variables['positions'][self.iteration,:,:,:] = x
 
         # Store box vectors and volume.
         for replica_index in range(self.nstates):
@@ -1878,17 +2011,258 @@ class ReplicaExchange(object):
         # Store timestamp this iteration was written.
         self.ncfile.variables['timestamp'][self.iteration] = time.ctime()
 
-        # Force sync to disk to avoid data loss.
+        # The data is synced to disk once per iteration after all of it has been written.
+        elapsed_time = time.time() - initial_time
+        logger.debug("Writing data to NetCDF file took %.3f s" % elapsed_time)
+
+        return
+
+    def _write_timeline_trace(self, first_iteration, collective=True):
+        """
+        Write the timeline trace of the current run, stop tracing and restore the communicator.
+
+        Parameters
+        ----------
+        first_iteration : int
+           The iteration from which the run started.
+        collective : bool, optional, default=True
+           If True, the events of all the MPI ranks are gathered and written to
+           a single file by the root node, and this is a collective call. Otherwise,
+           each rank writes its own events to a separate file.
+
+        """
+        if self.mpicomm:
+            self.mpicomm = self.mpicomm.mpicomm
+        if collective or not self.mpicomm:
+            trace_path = get_timeline_trace_path(self.store_filename, first_iteration)
+        else:
+            trace_path = get_timeline_trace_path(self.store_filename, first_iteration, rank=self.mpicomm.rank)
+        metadata = {'store_filename': self.store_filename, 'nstates': self.nstates,
+                    'first_iteration': first_iteration, 'last_iteration': self.iteration,
+                    'mpi_size': self.mpicomm.size if self.mpicomm else 1}
+        self._tracer.write(trace_path, metadata, collective=collective)
+        self._tracer = None
+        logger.debug("Timeline trace written to {}".format(trace_path))
+
+    @contextlib.contextmanager
+    def _timer(self, name):
+        """
+        Context manager recording the wall clock time spent in its block as timing 'name' of the current iteration.
+
+        """
+        start_time = time.time()
+        with self._trace(name):
+            yield
+        self._record_timing(name, time.time() - start_time)
+
+    def _trace(self, name, category='step', **args):
+        """
+        Context manager recording its block as a span of the timeline trace.
+
+        This does nothing when the timeline_trace option is off.
+
+        """
+        if self._tracer is None:
+            return _NULL_SPAN
+        return self._tracer.span(name, category, **args)
+
+    def _record_timing(self, name, elapsed_time, replica_index=None):
+        """
+        Accumulate the wall clock time spent in a step of the current iteration.
+
+        Parameters
+        ----------
+        name : str
+           The name of the variable of the timings group storing the timing.
+        elapsed_time : float or np.ndarray
+           The elapsed time (in seconds).
+        replica_index : int, optional
+           If given, the time is accumulated in the per-replica timings of this replica.
+
+        """
+        if replica_index is None:
+            self._timings[name] = self._timings.get(name, 0.0) + elapsed_time
+        else:
+            if name not in self._timings:
+                self._timings[name] = np.zeros([self.nstates], np.float64)
+            self._timings[name][replica_index] += elapsed_time
+
+    @delayed_termination
+    def _write_timings_netcdf(self):
+        """
+        Write the timings of the current iteration to the timings group of the NetCDF file.
+
+        """
+
+        if self.mpicomm:
+            # Only the root node will write data.
+            if self.mpicomm.rank != 0: return
+
+        ncgrp_timings = self.ncfile.groups['timings']
+        for name, elapsed_time in self._timings.items():
+            # Store files created by previous versions don't have all the timings, and
+            # the simulation may have been resumed with a different number of MPI nodes.
+            ncvar_timing = ncgrp_timings.variables.get(name, None)
+            if ncvar_timing is None or ncvar_timing.shape[1:] != np.shape(elapsed_time):
+                continue
+            ncvar_timing[self.iteration] = elapsed_time
+
+    def _sync_netcdf(self):
+        """
+        Sync the NetCDF file to disk to avoid data loss.
+
+        """
+
+        if self.mpicomm:
+            # Only the root node writes the store file.
+            if self.mpicomm.rank != 0: return
+
         presync_time = time.time()
         self.ncfile.sync()
+        logger.debug("Syncing NetCDF file took %.3f s" % (time.time() - presync_time))
 
-        # Print statistics.
-        final_time = time.time()
-        sync_time = final_time - presync_time
-        elapsed_time = final_time - initial_time
-        logger.debug("Writing data to NetCDF file took %.3f s (%.3f s for sync)" % (elapsed_time, sync_time))
+    @delayed_termination
+    def _write_store_index(self, sync=True):
+        """
+        Publish the current iteration as committed to concurrent readers.
 
-        return
+        This must be called after all the data of the iteration (including the
+        data written by subclasses in _write_iteration_netcdf()) has been synced
+        to disk, so that the file is synced only once per iteration.
+
+        Parameters
+        ----------
+        sync : bool, optional, default=True
+           If True, the NetCDF file is synced first. The main loop syncs it
+           before writing the timings to time the sync, so the timings of an
+           iteration are flushed to disk with the data of the next one.
+
+        """
+
+        if self.mpicomm:
+            # Only the root node writes the store file.
+            if self.mpicomm.rank != 0: return
+
+        if sync:
+            self._sync_netcdf()
+
+        write_store_index(self.store_filename, self.iteration + 1)
+
+    def _write_progress(self, number_of_iterations):
+        """
+        Publish the progress of the simulation to the progress file next to the store file.
+
+        Parameters
+        ----------
+        number_of_iterations : int
+           The total number of iterations to run, used to estimate the completion time.
+
+        """
+        from .analyze import write_progress
+
+        if self.mpicomm:
+            # Only the root node writes the store file.
+            if self.mpicomm.rank != 0: return
+
+        iteration_times, naccepted, nproposed = np.array(self._iteration_statistics).T
+        iteration_time = iteration_times.mean()
+        naccepted, nproposed = naccepted.sum(), nproposed.sum()
+        ns_per_iteration = self.nsteps_per_iteration * self.timestep / unit.nanoseconds
+        online_estimate = self._get_online_estimate()
+        neighbor_bar_estimate = None
+        if online_estimate is not None:
+            # Only the asynchronous online analysis computes a neighbor BAR
+            # estimate, so the root node never solves BAR in the sampling loop.
+            if online_estimate.get('neighbor_bar', None) is not None:
+                neighbor_bar_estimate = {'iteration': int(online_estimate['iteration']),
+                                         'DeltaF': online_estimate['neighbor_bar']['DeltaF'],
+                                         'dDeltaF': online_estimate['neighbor_bar']['dDeltaF']}
+            online_estimate = {'iteration': int(online_estimate['iteration']),
+                               'DeltaF': float(online_estimate['DeltaF']),
+                               'dDeltaF': float(online_estimate['dDeltaF']),
+                               'Neff_max': float(online_estimate['Neff_max'])}
+        converged_iteration = None if self.converged_iteration is None else int(self.converged_iteration)
+        progress = {'iteration': int(self.iteration),
+                    'number_of_iterations': int(number_of_iterations),
+                    'nstates': int(self.nstates),
+                    'natoms': int(self.natoms),
+                    'timestamp': time.time(),
+                    'iteration_time': float(iteration_time),
+                    'ns_per_day': float(ns_per_iteration * 86400.0 / iteration_time),
+                    'acceptance': float(naccepted) / nproposed if nproposed > 0 else 0.0,
+                    'converged_iteration': converged_iteration,
+                    'online_estimate': online_estimate,
+                    'neighbor_bar_estimate': neighbor_bar_estimate}
+        write_progress(self.store_filename, progress)
+
+    def _write_metrics(self, number_of_iterations):
+        """
+        Export the statistics of the simulation to the OpenMetrics text file of this rank.
+
+        Swap acceptance and online analysis estimates are known only to the root
+        node, so they are exported only by rank 0. Failures to write the file
+        are logged, but do not stop the simulation.
+
+        Parameters
+        ----------
+        number_of_iterations : int
+           The total number of iterations to run.
+
+        """
+        rank = self.mpicomm.rank if self.mpicomm else 0
+        iteration_times, naccepted, nproposed = np.array(self._iteration_statistics).T
+        ns_per_iteration = self.nsteps_per_iteration * self.timestep / unit.nanoseconds
+
+        metrics = [
+            ('yank_iterations', 'counter', 'Number of completed iterations.', [({}, self.iteration)]),
+            ('yank_target_iterations', 'gauge', 'Number of iterations to run.', [({}, number_of_iterations)]),
+            ('yank_iteration_seconds', 'gauge', 'Wall clock time of the last iteration.',
+             [({}, iteration_times[-1])]),
+            ('yank_ns_per_day', 'gauge', 'Simulated nanoseconds per day over the last iterations.',
+             [({}, ns_per_iteration * 86400.0 / iteration_times.mean())]),
+            ('yank_write_seconds', 'gauge',
+             'Wall clock time spent writing the last iteration to the store file and syncing it to disk.',
+             [({}, self._timings.get('io', 0.0))]),
+            ('yank_nan_retries', 'counter', 'Number of propagations retried after a NaN.',
+             [({}, self._event_counts['nan_retries'])]),
+        ]
+
+        # Swaps are attempted only by the root node.
+        swap_samples = []
+        if nproposed.sum() > 0:
+            swap_samples.append(({}, naccepted.sum() / nproposed.sum()))
+        metrics.append(('yank_swap_acceptance_ratio', 'gauge',
+                        'Fraction of accepted swaps between different states over the last iterations.',
+                        swap_samples))
+
+        mc_samples = []
+        for move in ['displacement', 'rotation']:
+            nproposed_moves = self._event_counts['mc_{}_proposed'.format(move)]
+            if nproposed_moves > 0:
+                naccepted_moves = self._event_counts['mc_{}_accepted'.format(move)]
+                mc_samples.append(({'move': move}, float(naccepted_moves) / nproposed_moves))
+        metrics.append(('yank_mc_acceptance_ratio', 'gauge',
+                        'Fraction of accepted MC ligand moves proposed by this rank.', mc_samples))
+
+        online_estimate = self._get_online_estimate() if rank == 0 else None
+        if online_estimate is not None:
+            metrics.append(('yank_online_delta_f', 'gauge',
+                            'Online estimate of the free energy difference between the end states in kT.',
+                            [({}, online_estimate['DeltaF'])]))
+            metrics.append(('yank_online_delta_f_error', 'gauge',
+                            'Standard error of the online free energy estimate in kT.',
+                            [({}, online_estimate['dDeltaF'])]))
+
+        metrics.append(('yank_last_update_timestamp_seconds', 'gauge', 'Time of the last update of this file.',
+                        [({}, time.time())]))
+
+        phase_name = os.path.splitext(os.path.basename(self.store_filename))[0]
+        labels = {'phase': phase_name, 'rank': rank, 'store': os.path.abspath(self.store_filename)}
+        metrics_path = get_metrics_path(self.metrics_directory, self.store_filename, rank)
+        try:
+            write_openmetrics(metrics_path, metrics, labels)
+        except (IOError, OSError) as e:
+            logger.warning("Could not export metrics to {}: {}".format(metrics_path, e))
 
     def _run_sanity_checks(self):
         """
@@ -1952,14 +2326,33 @@ class ReplicaExchange(object):
 
         # TODO: Store other thermodynamic variables store in ThermodynamicState?  Generalize?
 
-        # Systems.
-        ncvar_serialized_states = ncgrp_stateinfo.createVariable('systems', str, ('replica',), zlib=True)
-        setattr(ncvar_serialized_states, 'long_name', "systems[state] is the serialized OpenMM System corresponding to the thermodynamic state 'state'")
+        # Systems. Identical Systems are serialized only once, and each state refers to its System by index.
+        serialized_systems = list() # serialized_systems[i] is the i-th unique serialized System
+        system_indices = np.zeros([self.nstates], np.int32) # system_indices[state] is the index of the state System
+        system_index_by_id = dict() # System objects shared among states are serialized only once
+        system_index_by_hash = dict() # identical Systems that are different objects are stored only once
         for state_index in range(self.nstates):
-            logger.debug("Serializing state %d..." % state_index)
-            serialized = self.states[state_index].system.__getstate__()
-            logger.debug("Serialized state is %d B | %.3f KB | %.3f MB" % (len(serialized), len(serialized) / 1024.0, len(serialized) / 1024.0 / 1024.0))
-            ncvar_serialized_states[state_index] = serialized
+            system = self.states[state_index].system
+            if id(system) not in system_index_by_id:
+                logger.debug("Serializing state %d..." % state_index)
+                serialized = system.__getstate__()
+                system_hash = hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+                if system_hash not in system_index_by_hash:
+                    logger.debug("Serialized state is %d B | %.3f KB | %.3f MB" % (len(serialized), len(serialized) / 1024.0, len(serialized) / 1024.0 / 1024.0))
+                    system_index_by_hash[system_hash] = len(serialized_systems)
+                    serialized_systems.append(serialized)
+                system_index_by_id[id(system)] = system_index_by_hash[system_hash]
+            system_indices[state_index] = system_index_by_id[id(system)]
+        logger.debug("Storing %d unique Systems for %d states." % (len(serialized_systems), self.nstates))
+
+        ncgrp_stateinfo.createDimension('unique_system', len(serialized_systems))
+        ncvar_serialized_states = ncgrp_stateinfo.createVariable('systems', str, ('unique_system',), zlib=True)
+        setattr(ncvar_serialized_states, 'long_name', "systems[system_index] is the serialized OpenMM System shared by all thermodynamic states with that system index")
+        for (system_index, serialized) in enumerate(serialized_systems):
+            ncvar_serialized_states[system_index] = serialized
+        ncvar_system_indices = ncgrp_stateinfo.createVariable('system_indices', 'i4', ('replica',))
+        setattr(ncvar_system_indices, 'long_name', "system_indices[state] is the index in systems of the OpenMM System of thermodynamic state 'state'")
+        ncvar_system_indices[:] = system_indices[:]
         final_time = time.time()
         elapsed_time = final_time - initial_time
 
@@ -1967,14 +2360,27 @@ class ReplicaExchange(object):
 
         return
 
-    def _restore_thermodynamic_states(self, ncfile):
+    def _read_thermodynamic_states(self, ncfile):
         """
-        Restore the thermodynamic states from a NetCDF file.
+        Read the thermodynamic states data from a NetCDF file.
 
-        """
-        logger.debug("Restoring thermodynamic states from NetCDF file...")
-        initial_time = time.time()
+        The Systems are not deserialized. Use _build_thermodynamic_states() to
+        create the ThermodynamicState objects from the returned data.
+
+        Parameters
+        ----------
+        ncfile : netcdf.Dataset
+            The NetCDF file from which to read the thermodynamic states.
+
+        Returns
+        -------
+        states_data : dict
+            The number of states ('nstates'), their temperatures in kelvin and
+            pressures in atmospheres ('temperatures', 'pressures'), the list of
+            unique serialized Systems ('systems') and the index of the System
+            of each state ('system_indices').
 
+        """
         # Make sure this NetCDF file contains thermodynamic state information.
         if not 'thermodynamic_states' in ncfile.groups:
             raise Exception("Could not restore thermodynamic states from %s" % self.store_filename)
@@ -1982,8 +2388,75 @@ class ReplicaExchange(object):
         # Create a group to store state information.
         ncgrp_stateinfo = ncfile.groups['thermodynamic_states']
 
-        # Get number of states.
-        self.nstates = ncgrp_stateinfo.variables['nstates'].getValue()
+        states_data = dict()
+        nstates = int(ncgrp_stateinfo.variables['nstates'].getValue())
+        states_data['nstates'] = nstates
+        states_data['temperatures'] = np.array(ncgrp_stateinfo.variables['temperatures'][:], np.float64)
+        if 'pressures' in ncgrp_stateinfo.variables:
+            states_data['pressures'] = np.array(ncgrp_stateinfo.variables['pressures'][:], np.float64)
+        else:
+            states_data['pressures'] = None
+
+        # Read the unique serialized Systems and the index of the System of each state.
+        ncvar_systems = ncgrp_stateinfo.variables['systems']
+        if 'system_indices' in ncgrp_stateinfo.variables:
+            system_indices = np.array(ncgrp_stateinfo.variables['system_indices'][:], np.int32)
+            serialized_systems = [str(ncvar_systems[system_index]) for system_index in range(ncvar_systems.shape[0])]
+        else:
+            # Files created by older versions store one System per state, so
+            # we deduplicate them here to avoid deserializing the same System
+            # multiple times.
+            system_indices = np.zeros([nstates], np.int32)
+            system_index_by_hash = dict()
+            serialized_systems = list()
+            for state_index in range(nstates):
+                serialized = str(ncvar_systems[state_index])
+                system_hash = hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+                if system_hash not in system_index_by_hash:
+                    system_index_by_hash[system_hash] = len(serialized_systems)
+                    serialized_systems.append(serialized)
+                system_indices[state_index] = system_index_by_hash[system_hash]
+        states_data['systems'] = serialized_systems
+        states_data['system_indices'] = system_indices
+
+        return states_data
+
+    def _build_thermodynamic_states(self, states_data):
+        """
+        Create the thermodynamic states from the data read by _read_thermodynamic_states().
+
+        Thermodynamic states that were stored with identical Systems share the same
+        System object, which is deserialized only once. When running with MPI, each
+        node deserializes only the Systems of the states it propagates, plus the
+        System of the first state, which is used as representative System. The
+        System of the other states is set to None.
+
+        Parameters
+        ----------
+        states_data : dict
+            The thermodynamic states data returned by _read_thermodynamic_states().
+
+        """
+        logger.debug("Restoring thermodynamic states...")
+        initial_time = time.time()
+
+        self.nstates = states_data['nstates']
+        system_indices = states_data['system_indices']
+
+        # Determine the states whose System is needed on this node.
+        if self.mpicomm is None:
+            needed_state_indices = set(range(self.nstates))
+        else:
+            needed_state_indices = set(range(self.mpicomm.rank, self.nstates, self.mpicomm.size))
+            needed_state_indices.add(0)
+
+        # Reconstitute each needed unique System object only once.
+        systems = dict()
+        for system_index in sorted(set(system_indices[state_index] for state_index in needed_state_indices)):
+            system = self.mm.System()
+            system.__setstate__(states_data['systems'][system_index])
+            systems[system_index] = system
+        logger.debug("Restored %d unique Systems for %d states." % (len(systems), self.nstates))
 
         # Read state information.
         self.states = list()
@@ -1991,23 +2464,29 @@ class ReplicaExchange(object):
             # Populate a new ThermodynamicState object.
             state = ThermodynamicState()
             # Read temperature.
-            state.temperature = float(ncgrp_stateinfo.variables['temperatures'][state_index]) * unit.kelvin
+            state.temperature = float(states_data['temperatures'][state_index]) * unit.kelvin
             # Read pressure, if present.
-            if 'pressures' in ncgrp_stateinfo.variables:
-                state.pressure = float(ncgrp_stateinfo.variables['pressures'][state_index]) * unit.atmospheres
-            # Reconstitute System object.
-            state.system = self.mm.System()
-            state.system.__setstate__(str(ncgrp_stateinfo.variables['systems'][state_index]))
+            if states_data['pressures'] is not None:
+                state.pressure = float(states_data['pressures'][state_index]) * unit.atmospheres
+            # Set System object (shared among states with identical Systems).
+            state.system = systems.get(system_indices[state_index], None)
             # Store state.
             self.states.append(state)
 
         final_time = time.time()
         elapsed_time = final_time - initial_time
-        logger.debug("Restoring thermodynamic states from NetCDF file took %.3f s." % elapsed_time)
+        logger.debug("Restoring thermodynamic states took %.3f s." % elapsed_time)
+
+    def _restore_thermodynamic_states(self, ncfile):
+        """
+        Restore the thermodynamic states from a NetCDF file.
 
+        """
+        self._build_thermodynamic_states(self._read_thermodynamic_states(ncfile))
         return True
 
-    def _convert_netcdf_store_type(self, stored_type):
+    @classmethod
+    def _convert_netcdf_store_type(cls, stored_type):
         """
         Convert the stored NetCDF datatype from string to type without relying on unsafe eval() function
 
@@ -2101,7 +2580,8 @@ class ReplicaExchange(object):
 
         return
 
-    def _restore_dict_from_netcdf(self, ncgrp):
+    @classmethod
+    def _restore_dict_from_netcdf(cls, ncgrp):
         """
         Restore dict from NetCDF.
 
@@ -2126,10 +2606,10 @@ class ReplicaExchange(object):
             type_name = getattr(option_ncvar, 'type')
             # TODO: Remove the if/elseif structure into one handy function
             # Get option value.
-            if type_name == 'NoneType':
+            if type_name in ('NoneType', 'builtins.NoneType'):
                 option_value = None
             else: # Handle all Types not None
-                option_type = self._convert_netcdf_store_type(type_name)
+                option_type = cls._convert_netcdf_store_type(type_name)
                 if option_ncvar.shape == ():
                     # Handle Standard Types
                     option_value = option_type(option_ncvar.getValue())
@@ -2194,9 +2674,14 @@ class ReplicaExchange(object):
 
         return
 
-    def _restore_options(self, ncfile):
+    def _read_options(self, ncfile):
         """
-        Restore run parameters from NetCDF file.
+        Read run parameters from NetCDF file.
+
+        Returns
+        -------
+        options : dict
+            The stored run parameters.
 
         """
 
@@ -2210,7 +2695,14 @@ class ReplicaExchange(object):
         ncgrp_options = ncfile.groups['options']
 
         # Restore options as dict.
-        options = self._restore_dict_from_netcdf(ncgrp_options)
+        return self._restore_dict_from_netcdf(ncgrp_options)
+
+    def _restore_options(self, ncfile):
+        """
+        Restore run parameters from NetCDF file.
+
+        """
+        options = self._read_options(ncfile)
 
         # Set these as attributes.
         for option_name in options.keys():
@@ -2243,50 +2735,189 @@ class ReplicaExchange(object):
             The NetCDF file in which metadata is to be stored.
 
         """
-        self.metadata = None
+        self.metadata = self._read_metadata(ncfile)
+
+    def _read_metadata(self, ncfile):
+        """
+        Read metadata from NetCDF file.
+
+        Parameters
+        ----------
+        ncfile : netcdf.Dataset
+            The NetCDF file in which metadata is stored.
+
+        Returns
+        -------
+        metadata : dict or None
+            The stored metadata, or None if the file has no metadata.
+
+        """
         if 'metadata' in ncfile.groups:
             ncgrp = ncfile.groups['metadata']
-            self.metadata = self._restore_dict_from_netcdf(ncgrp)
+            return self._restore_dict_from_netcdf(ncgrp)
+        return None
 
-    def _resume_from_netcdf(self, ncfile):
+    def _read_replica_data(self, ncfile):
         """
-        Resume execution by reading current positions and energies from a NetCDF file.
+        Read positions, box vectors, states and energies of the last iteration from a NetCDF file.
 
         Parameters
         ----------
         ncfile : netcdf.Dataset
-            The NetCDF file in which metadata is to be stored.
+            The NetCDF file to read.
+
+        Returns
+        -------
+        replica_data : dict
+            The data of the last stored iteration. Use _restore_replica_data()
+            to resume the simulation from it.
 
         """
 
         # TODO: Perform sanity check on file before resuming
 
+        # Each variable is read with a single hyperslab access.
+        replica_data = dict()
+        iteration = ncfile.variables['positions'].shape[0] - 1
+        replica_data['iteration'] = iteration
+        replica_data['positions'] = np.array(ncfile.variables['positions'][iteration,:,:,:])
+        replica_data['box_vectors'] = np.array(ncfile.variables['box_vectors'][iteration,:,:,:])
+        replica_data['states'] = np.array(ncfile.variables['states'][iteration,:])
+        replica_data['energies'] = np.array(ncfile.variables['energies'][iteration,:,:])
+        if 'converged_iteration' in ncfile.ncattrs():
+            replica_data['converged_iteration'] = int(ncfile.converged_iteration)
+        else:
+            replica_data['converged_iteration'] = None
+        return replica_data
+
+    def _restore_replica_data(self, replica_data):
+        """
+        Resume execution from the last iteration data read by _read_replica_data().
+
+        Parameters
+        ----------
+        replica_data : dict
+            The data returned by _read_replica_data().
+
+        """
+
         # Get current dimensions.
-        self.iteration = ncfile.variables['positions'].shape[0] - 1
-        self.nstates = ncfile.variables['positions'].shape[1]
-        self.natoms = ncfile.variables['positions'].shape[2]
+        self.iteration = replica_data['iteration']
+        self.converged_iteration = replica_data['converged_iteration']
+        self.nstates, self.natoms = replica_data['positions'].shape[:2]
         self.nreplicas = self.nstates
         logger.debug("iteration = %d, nstates = %d, natoms = %d" % (self.iteration, self.nstates, self.natoms))
 
         # Restore positions.
         self.replica_positions = list()
         for replica_index in range(self.nstates):
-            x = ncfile.variables['positions'][self.iteration,replica_index,:,:].astype(np.float64).copy()
+            x = replica_data['positions'][replica_index,:,:].astype(np.float64)
             positions = unit.Quantity(x, unit.nanometers)
             self.replica_positions.append(positions)
 
         # Restore box vectors.
         self.replica_box_vectors = list()
         for replica_index in range(self.nstates):
-            x = ncfile.variables['box_vectors'][self.iteration,replica_index,:,:].astype(np.float64).copy()
+            x = replica_data['box_vectors'][replica_index,:,:].astype(np.float64)
             box_vectors = unit.Quantity(x, unit.nanometers)
             self.replica_box_vectors.append(box_vectors)
 
         # Restore state information.
-        self.replica_states = ncfile.variables['states'][self.iteration,:].copy()
+        self.replica_states = replica_data['states'].copy()
 
         # Restore energies.
-        self.u_kl = ncfile.variables['energies'][self.iteration,:,:].copy()
+        self.u_kl = replica_data['energies'].copy()
+
+    def _resume_from_netcdf(self, ncfile):
+        """
+        Resume execution by reading current positions and energies from a NetCDF file.
+
+        Parameters
+        ----------
+        ncfile : netcdf.Dataset
+            The NetCDF file in which metadata is to be stored.
+
+        """
+        self._restore_replica_data(self._read_replica_data(ncfile))
+
+    def _read_resume_data(self, ncfile):
+        """
+        Read all the data needed to resume the simulation from a NetCDF file.
+
+        Parameters
+        ----------
+        ncfile : netcdf.Dataset
+            The NetCDF file to read.
+
+        Returns
+        -------
+        resume_data : dict
+            The thermodynamic states data, the options, the metadata and the
+            last iteration data, under the keys 'thermodynamic_states',
+            'options', 'metadata' and 'replicas' respectively.
+
+        """
+        resume_data = dict()
+        resume_data['thermodynamic_states'] = self._read_thermodynamic_states(ncfile)
+        resume_data['options'] = self._read_options(ncfile)
+        resume_data['metadata'] = self._read_metadata(ncfile)
+        resume_data['replicas'] = self._read_replica_data(ncfile)
+        return resume_data
+
+    def _read_store(self, read_function):
+        """
+        Read data from the store file on the root node and share it with all nodes.
+
+        Only the root node opens the store file, to avoid many simultaneous reads
+        on shared filesystems. The data is broadcast to the other nodes as a single
+        compressed buffer. If the root node cannot read the store file, the error
+        is broadcast instead and all nodes raise.
+
+        Parameters
+        ----------
+        read_function : function
+            A function with signature read_function(ncfile) returning the data to
+            read. The returned data must be picklable.
+
+        Returns
+        -------
+        data
+            The data returned by read_function on the root node.
+
+        """
+        if (self.mpicomm is None) or (self.mpicomm.rank == 0):
+            initial_time = time.time()
+            try:
+                ncfile = netcdf.Dataset(self.store_filename, 'r')
+                try:
+                    data = read_function(ncfile)
+                finally:
+                    ncfile.close()
+            except Exception as e:
+                # The other nodes would otherwise wait for the data forever.
+                if self.mpicomm is not None:
+                    error_message = 'Node 0 could not read the store file {}: {}: {}'.format(
+                        self.store_filename, type(e).__name__, e)
+                    self.mpicomm.bcast((None, error_message), root=0)
+                raise
+            logger.debug("Reading store file took %.3f s." % (time.time() - initial_time))
+
+        if self.mpicomm is None:
+            return data
+
+        if self.mpicomm.rank == 0:
+            buffer = zlib.compress(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+            logger.debug("Sharing %.3f MB of store file data." % (len(buffer) / 1024.0 / 1024.0))
+        else:
+            buffer = None
+        logger.debug('Node {}/{}: MPI bcast - sharing store file data'.format(
+                self.mpicomm.rank, self.mpicomm.size))
+        buffer, error_message = self.mpicomm.bcast((buffer, None), root=0)
+        if self.mpicomm.rank != 0:
+            if error_message is not None:
+                raise RuntimeError(error_message)
+            data = pickle.loads(zlib.decompress(buffer))
+        return data
 
     def _show_energies(self):
         """
@@ -2320,7 +2951,8 @@ class ReplicaExchange(object):
         """
         Compute trace for replica ensemble minus log probability.
 
-        Extract timeseries of u_n = - log q(X_n) from store file
+        Extract timeseries of u_n = - log q(X_n) from the online analysis
+        buffers, which are filled from the store file on first use
 
         where q(X_n) = \pi_{k=1}^K u_{s_{nk}}(x_{nk})
 
@@ -2333,105 +2965,208 @@ class ReplicaExchange(object):
         u_n : numpy array of numpy.float64
         u   _n[n] is -log q(X_n)
 
-        TODO
-        ----
-        * Later, we should have this quantity computed and stored on the fly in the store file.
-        But we may want to do this without breaking backward compatibility.
+        """
+        return self._update_online_analysis().u_n.copy()
 
+    def _has_convergence_criteria(self):
         """
+        Return True if at least one convergence criterion is set.
 
-        # Get current dimensions.
-        niterations = self.ncfile.variables['energies'].shape[0]
-        nstates = self.ncfile.variables['energies'].shape[1]
-        natoms = self.ncfile.variables['energies'].shape[2]
+        """
+        has_criteria = (self.online_analysis_target_error > 0.0 or
+                        self.online_analysis_min_effective_samples > 0 or
+                        self.online_analysis_max_relative_change > 0.0)
+        if has_criteria and not self.online_analysis:
+            logger.warning("Convergence criteria are ignored when online_analysis is disabled.")
+            return False
+        return has_criteria
+
+    def _get_online_estimate(self):
+        """
+        Return the latest online analysis estimate of the free energy difference between the end states.
+
+        Returns
+        -------
+        estimate : dict or None
+           The estimate with keys 'iteration', 'DeltaF', 'dDeltaF' and 'Neff_max',
+           or None if no estimate is available yet.
+
+        """
+        if self.online_analysis_async:
+            from .analyze import read_online_analysis
+            return read_online_analysis(self.store_filename)
+        if self.analysis is None:
+            return None
+        return {'iteration': self._online_analysis.last_estimate_iteration,
+                'DeltaF': self.analysis['Delta_f_ij'][0, -1],
+                'dDeltaF': self.analysis['dDelta_f_ij'][0, -1],
+                'Neff_max': self.analysis['Neff_max']}
+
+    def _check_convergence(self):
+        """
+        Check the latest online analysis estimate against the convergence criteria.
+
+        The root node takes the decision and broadcasts it. When the criteria are
+        met, the iteration is recorded in the store file so that resuming the
+        simulation does not run it any further.
+
+        Returns
+        -------
+        converged : bool
+           True if all the convergence criteria are met.
+
+        """
+        converged = False
+        if not self.mpicomm or self.mpicomm.rank == 0:
+            estimate = self._get_online_estimate()
+            if estimate is not None:
+                history = self._convergence_history
+                if len(history) == 0 or history[-1][0] != estimate['iteration']:
+                    history.append((estimate['iteration'], estimate['DeltaF']))
+
+                criteria = []
+                if self.online_analysis_target_error > 0.0:
+                    criteria.append(estimate['dDeltaF'] <= self.online_analysis_target_error)
+                if self.online_analysis_min_effective_samples > 0:
+                    criteria.append(estimate['Neff_max'] >= self.online_analysis_min_effective_samples)
+                if self.online_analysis_max_relative_change > 0.0:
+                    window = self.online_analysis_convergence_window
+                    DeltaF = np.array([DeltaF for _, DeltaF in history[-window:]])
+                    max_change = np.abs(DeltaF - DeltaF[-1]).max()
+                    # A relative tolerance alone can never be met when the free energy is close
+                    # to zero, so changes within the statistical uncertainty are always accepted.
+                    tolerance = max(self.online_analysis_max_relative_change * abs(DeltaF[-1]), estimate['dDeltaF'])
+                    criteria.append(len(DeltaF) >= window and max_change <= tolerance)
+                converged = len(criteria) > 0 and all(criteria)
+
+                if converged:
+                    logger.info("Simulation converged at iteration %d: DeltaF = %.3f +- %.3f kT (Neff = %.1f)" %
+                                (self.iteration, estimate['DeltaF'], estimate['dDeltaF'], estimate['Neff_max']))
+                    self.ncfile.converged_iteration = self.iteration
+                    self.ncfile.sync()
+
+        if self.mpicomm:
+            converged = self.mpicomm.bcast(converged, root=0)
+        if converged:
+            self.converged_iteration = self.iteration
+        return converged
 
-        # Extract energies.
-        energies = ncfile.variables['energies']
-        u_kln_replica = np.zeros([nstates, nstates, niterations], np.float64)
-        for n in range(niterations):
-            u_kln_replica[:,:,n] = energies[n,:,:]
+    def _update_online_analysis(self):
+        """
+        Bring the incremental online analysis up to date with the store file.
+
+        The energies of the last iteration are appended to the in-memory buffers
+        of the analysis. The whole store file is read only the first time, or if
+        the buffers have gone out of sync with it (e.g. after a resume).
+
+        Returns
+        -------
+        online_analysis : yank.analyze.OnlineAnalysis
+           The up-to-date online analysis.
 
-        # Deconvolute replicas
-        u_kln = np.zeros([nstates, nstates, niterations], np.float64)
-        for iteration in range(niterations):
-            state_indices = ncfile.variables['states'][iteration,:]
-            u_kln[state_indices,:,iteration] = energies[iteration,:,:]
+        """
+        from .analyze import OnlineAnalysis
+
+        niterations = self.ncfile.variables['states'].shape[0]
+        online_analysis = self._online_analysis
+        if online_analysis is not None and online_analysis.niterations + 1 == niterations:
+            online_analysis.append(self.ncfile.variables['states'][niterations-1, :],
+                                   self.ncfile.variables['energies'][niterations-1, :, :])
+        elif online_analysis is None or online_analysis.niterations != niterations:
+            online_analysis = OnlineAnalysis.from_ncfile(self.ncfile,
+                                                         min_iterations=self.online_analysis_min_iterations)
+            # Warm-start MBAR from the previous solution, if any.
+            if self._online_analysis is not None:
+                online_analysis.f_k = self._online_analysis.f_k
+            self._online_analysis = online_analysis
+        online_analysis.min_iterations = self.online_analysis_min_iterations
+        return online_analysis
 
-        # Compute total negative log probability over all iterations.
-        u_n = np.zeros([niterations], np.float64)
-        for iteration in range(niterations):
-            u_n[iteration] = np.sum(np.diagonal(u_kln[:,:,iteration]))
+    def _submit_online_analysis(self):
+        """
+        Submit the energies of the new iterations to the asynchronous online analysis.
 
-        return u_n
+        The analysis process is started on first use and receives all the
+        iterations already in the store file. If it dies, it is restarted once;
+        if it dies again, the asynchronous online analysis is disabled, since
+        each restart submits the whole store file again.
 
-    def _analysis(self):
+        """
+        from .analyze import OnlineAnalysisWorker
+
+        if self._online_analysis_worker_disabled:
+            return
+
+        niterations = self.ncfile.variables['states'].shape[0]
+        worker = self._online_analysis_worker
+        if worker is not None and not worker.is_alive:
+            logger.warning("The online analysis process died at iteration %d with exit code %s." %
+                           (self.iteration, worker.exitcode))
+            worker.stop(timeout=0)
+            worker = self._online_analysis_worker = None
+            if self._online_analysis_worker_restarted:
+                logger.warning("Disabling the asynchronous online analysis.")
+                self._online_analysis_worker_disabled = True
+                return
+            self._online_analysis_worker_restarted = True
+        if worker is None or worker.niterations > niterations:
+            if worker is not None:
+                worker.stop(timeout=0)
+            worker = OnlineAnalysisWorker(self.store_filename, self.nstates,
+                                          min_iterations=self.online_analysis_min_iterations,
+                                          interval=self.online_analysis_interval)
+            self._online_analysis_worker = worker
+        if worker.niterations < niterations:
+            worker.submit(self.ncfile.variables['states'][worker.niterations:, :],
+                          self.ncfile.variables['energies'][worker.niterations:, :, :])
+
+    def _analysis(self, force=False):
         """
         Perform online analysis each iteration.
 
-        Every iteration, this will update the estimate of the state relative free energy differences and statistical uncertainties.
-        We can additionally request further analysis.
+        Every iteration, the energies of the new iteration are appended to the
+        online analysis buffers. Every online_analysis_interval iterations, this
+        will update the estimate of the state relative free energy differences
+        and statistical uncertainties with an MBAR solution warm-started from the
+        previous estimate. If online_analysis_async is set, the energies are
+        instead submitted to a separate analysis process.
+
+        Parameters
+        ----------
+        force : bool, optional, default=False
+           If True, the estimate is updated regardless of online_analysis_interval.
 
         """
 
         # Only root node can perform analysis.
         if self.mpicomm and (self.mpicomm.rank != 0): return
 
-        # Determine how many iterations there are data available for.
-        replica_states = self.ncfile.variables['states'][:,:]
-        u_nkl_replica = self.ncfile.variables['energies'][:,:,:]
+        # Hand the energies to the analysis process without waiting for MBAR.
+        if self.online_analysis_async and not force:
+            self._submit_online_analysis()
+            return
 
-        # Determine number of iterations completed.
-        number_of_iterations_completed = replica_states.shape[0]
-        nstates = replica_states.shape[1]
+        online_analysis = self._update_online_analysis()
 
         # Online analysis can only be performed after a sufficient quantity of data has been collected.
-        if (number_of_iterations_completed < self.online_analysis_min_iterations):
+        if online_analysis.niterations < self.online_analysis_min_iterations:
             logger.debug("Online analysis will be performed after %d iterations have elapsed." % self.online_analysis_min_iterations)
             self.analysis = None
             return
 
-        # Deconvolute replicas and compute total simulation effective self-energy timeseries.
-        u_kln = np.zeros([nstates, nstates, number_of_iterations_completed], np.float32)
-        u_n = np.zeros([number_of_iterations_completed], np.float64)
-        for iteration in range(number_of_iterations_completed):
-            state_indices = replica_states[iteration,:]
-            u_n[iteration] = 0.0
-            for replica_index in range(nstates):
-                state_index = state_indices[replica_index]
-                u_n[iteration] += u_nkl_replica[iteration,replica_index,state_index]
-                u_kln[state_index,:,iteration] = u_nkl_replica[iteration,replica_index,:]
-
-        # Determine optimal equilibration time, statistical inefficiency, and effectively uncorrelated sample indices.
-        from pymbar import timeseries
-        [t0, g, Neff_max] = timeseries.detectEquilibration(u_n)
-        indices = t0 + timeseries.subsampleCorrelatedData(u_n[t0:], g=g)
-        N_k = indices.size * np.ones([nstates], np.int32)
-
-        # Next, analyze with pymbar, initializing with last estimate of free energies.
-        from pymbar import MBAR
-        if hasattr(self, 'f_k'):
-            mbar = MBAR(u_kln[:,:,indices], N_k, initial_f_k=self.f_k)
-        else:
-            mbar = MBAR(u_kln[:,:,indices], N_k)
-
-        # Cache current free energy estimate to save time in future MBAR solutions.
-        self.f_k = mbar.f_k
-
-        # Compute entropy and enthalpy.
-        [Delta_f_ij, dDelta_f_ij, Delta_u_ij, dDelta_u_ij, Delta_s_ij, dDelta_s_ij] = mbar.computeEntropyAndEnthalpy()
-
-        # Store analysis summary.
-        # TODO: Convert this to an object?
-        analysis = dict()
-        analysis['equilibration_end'] = t0
-        analysis['g'] = g
-        analysis['indices'] = indices
-        analysis['Delta_f_ij'] = Delta_f_ij
-        analysis['dDelta_f_ij'] = dDelta_f_ij
-        analysis['Delta_u_ij'] = Delta_u_ij
-        analysis['dDelta_u_ij'] = dDelta_u_ij
-        analysis['Delta_s_ij'] = Delta_s_ij
-        analysis['dDelta_s_ij'] = dDelta_s_ij
+        # Re-solve MBAR only every online_analysis_interval iterations.
+        interval = max(1, self.online_analysis_interval)
+        elapsed_iterations = online_analysis.niterations - self.online_analysis_min_iterations
+        if not force and self.analysis is not None and elapsed_iterations % interval != 0:
+            return
+
+        analysis = online_analysis.estimate()
+        t0 = analysis['equilibration_end']
+        g = analysis['g']
+        Neff_max = analysis['Neff_max']
+        Delta_f_ij, dDelta_f_ij = analysis['Delta_f_ij'], analysis['dDelta_f_ij']
+        Delta_u_ij, dDelta_u_ij = analysis['Delta_u_ij'], analysis['dDelta_u_ij']
+        Delta_s_ij, dDelta_s_ij = analysis['Delta_s_ij'], analysis['dDelta_s_ij']
 
         def matrix2str(x):
             """
@@ -2496,6 +3231,8 @@ class ReplicaExchange(object):
            The last iteration in the discarded equilibrated region
         g : float
            Estimated statistical inefficiency of production region
+        Neff_max : float
+           Estimated effective number of uncorrelated samples
         indices : list of int
            Equilibrated, effectively uncorrelated iteration indices used in analysis
         Delta_f_ij : numpy array of nstates x nstates
@@ -2516,7 +3253,7 @@ class ReplicaExchange(object):
             self._initialize_resume()
 
         # Update analysis on root node.
-        self._analysis()
+        self._analysis(force=True)
 
         if self.mpicomm: self.analysis = self.mpicomm.bcast(self.analysis, root=0) # broadcast analysis from root node
 
@@ -2664,7 +3401,8 @@ class ParallelTempering(ReplicaExchange):
                 # Set positions.
                 context.setPositions(self.replica_positions[replica_index])
                 # Compute potential energy.
-                openmm_state = context.getState(getEnergy=True)
+                with self._trace('energy', 'replica', replica=replica_index):
+                    openmm_state = context.getState(getEnergy=True)
                 potential_energy = openmm_state.getPotentialEnergy()
                 # Compute energies at this state for all replicas.
                 for state_index in range(self.nstates):
@@ -2673,7 +3411,8 @@ class ParallelTempering(ReplicaExchange):
                     self.u_kl[replica_index,state_index] = beta * potential_energy
 
             # Gather energies.
-            energies_gather = self.mpicomm.allgather(self.u_kl[self.mpicomm.rank:self.nstates:self.mpicomm.size,:])
+            with self._timer('synchronization'):
+                energies_gather = self.mpicomm.allgather(self.u_kl[self.mpicomm.rank:self.nstates:self.mpicomm.size,:])
             for replica_index in range(self.nstates):
                 source = replica_index % self.mpicomm.size # node with trajectory data
                 index = replica_index // self.mpicomm.size # index within trajectory batch
@@ -2695,7 +3434,8 @@ class ParallelTempering(ReplicaExchange):
                 # Set positions.
                 context.setPositions(self.replica_positions[replica_index])
                 # Compute potential energy.
-                openmm_state = context.getState(getEnergy=True)
+                with self._trace('energy', 'replica', replica=replica_index):
+                    openmm_state = context.getState(getEnergy=True)
                 potential_energy = openmm_state.getPotentialEnergy()
                 # Compute energies at this state for all replicas.
                 for state_index in range(self.nstates):
@@ -288,18 +288,13 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
 
         return
 
-    def _restore_thermodynamic_states(self, ncfile):
+    def _read_thermodynamic_states(self, ncfile):
         """
-        Restore the thermodynamic states from a NetCDF file.
+        Read the thermodynamic states data from a NetCDF file.
 
-        """
-        logger.debug("Restoring thermodynamic states from NetCDF file...")
-        initial_time = time.time()
-
-        # Define reference units
-        temperature_unit = unit.kelvin
-        pressure_unit = unit.atmospheres
+        See ReplicaExchange._read_thermodynamic_states for details.
 
+        """
         # Make sure this NetCDF file contains thermodynamic state information.
         if not 'thermodynamic_states' in ncfile.groups:
             raise Exception("Could not restore thermodynamic states from %s" % self.store_filename)
@@ -307,60 +302,104 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
         # Create a group to store state information.
         ncgrp_stateinfo = ncfile.groups['thermodynamic_states']
 
+        states_data = dict()
+        states_data['nstates'] = int(ncgrp_stateinfo.variables['nstates'].getValue())
+        states_data['temperatures'] = np.array(ncgrp_stateinfo.variables['temperatures'][:], np.float64)
+        if 'pressures' in ncgrp_stateinfo.variables:
+            states_data['pressures'] = np.array(ncgrp_stateinfo.variables['pressures'][:], np.float64)
+        else:
+            states_data['pressures'] = None
+
+        # Read reference system.
+        states_data['base_system'] = str(ncgrp_stateinfo.variables['base_system'][0])
+
+        # Read alchemical states.
+        ncgrp_alchemical = ncfile.groups['alchemical_states']
+        states_data['alchemical_states'] = {key: np.array(ncgrp_alchemical.variables[key][:], np.float64)
+                                            for key in ncgrp_alchemical.variables.keys()}
+
+        # Read expanded cutoff states.
+        states_data['expanded_cutoff_states'] = None
+        if 'expanded_cutoff_states' in ncfile.groups:
+            ncgrp_stateinfo = ncfile.groups['expanded_cutoff_states']
+            expanded_data = dict()
+            expanded_data['temperature'] = float(ncgrp_stateinfo.variables['temperatures'][0])
+            if 'pressures' in ncgrp_stateinfo.variables:
+                expanded_data['pressure'] = float(ncgrp_stateinfo.variables['pressures'][0])
+            else:
+                expanded_data['pressure'] = None
+            for system_name in ['fully_interacting_expanded_system', 'noninteracting_expanded_system']:
+                expanded_data[system_name] = str(ncgrp_stateinfo.variables[system_name][0])
+            states_data['expanded_cutoff_states'] = expanded_data
+
+        return states_data
+
+    def _build_thermodynamic_states(self, states_data):
+        """
+        Create the thermodynamic states from the data read by _read_thermodynamic_states().
+
+        All the alchemical states share the same reference System object.
+
+        """
+        logger.debug("Restoring thermodynamic states...")
+        initial_time = time.time()
+
+        # Define reference units
+        temperature_unit = unit.kelvin
+        pressure_unit = unit.atmospheres
+
         # Get number of states.
-        self.nstates = ncgrp_stateinfo.variables['nstates'].getValue()
+        self.nstates = states_data['nstates']
 
         # Read thermodynamic state information.
         self.states = list()
         # Read reference system
         self.base_system = self.mm.System()
-        self.base_system.__setstate__(str(ncgrp_stateinfo.variables['base_system'][0]))
+        self.base_system.__setstate__(states_data['base_system'])
         # Read other parameters.
         for state_index in range(self.nstates):
             # Populate a new ThermodynamicState object.
             state = ThermodynamicState()
             # Read temperature.
-            state.temperature = float(ncgrp_stateinfo.variables['temperatures'][state_index]) * temperature_unit
+            state.temperature = float(states_data['temperatures'][state_index]) * temperature_unit
             # Read pressure, if present.
-            if 'pressures' in ncgrp_stateinfo.variables:
-                state.pressure = float(ncgrp_stateinfo.variables['pressures'][state_index]) * pressure_unit
+            if states_data['pressures'] is not None:
+                state.pressure = float(states_data['pressures'][state_index]) * pressure_unit
             # Read alchemical states.
             state.alchemical_state = AlchemicalState()
-            for key in ncfile.groups['alchemical_states'].variables.keys():
-                state.alchemical_state[key] = float(ncfile.groups['alchemical_states'].variables[key][state_index])
+            for key, values in states_data['alchemical_states'].items():
+                state.alchemical_state[key] = float(values[state_index])
             # Set System object (which points to reference system).
             state.system = self.base_system
             # Store state.
             self.states.append(state)
 
         # expanded cutoff states
-        if 'expanded_cutoff_states' in ncfile.groups:
-            ncgrp_stateinfo = ncfile.groups['expanded_cutoff_states']
+        expanded_data = states_data['expanded_cutoff_states']
+        if expanded_data is not None:
             # Populate a new ThermodynamicState object
             fully_interacting_expanded_state = ThermodynamicState()
             noninteracting_expanded_state = ThermodynamicState()
             # Read temperature.
-            fully_interacting_expanded_state.temperature = float(ncgrp_stateinfo.variables['temperatures'][0]) * temperature_unit
-            noninteracting_expanded_state.temperature = float(ncgrp_stateinfo.variables['temperatures'][0]) * temperature_unit
+            fully_interacting_expanded_state.temperature = expanded_data['temperature'] * temperature_unit
+            noninteracting_expanded_state.temperature = expanded_data['temperature'] * temperature_unit
             # Read pressure, if present.
-            if 'pressures' in ncgrp_stateinfo.variables:
-                 fully_interacting_expanded_state.pressure = float(ncgrp_stateinfo.variables['pressures'][0]) * pressure_unit
-                 noninteracting_expanded_state.pressure = float(ncgrp_stateinfo.variables['pressures'][0]) * pressure_unit
+            if expanded_data['pressure'] is not None:
+                 fully_interacting_expanded_state.pressure = expanded_data['pressure'] * pressure_unit
+                 noninteracting_expanded_state.pressure = expanded_data['pressure'] * pressure_unit
             # Set System object
             fully_interacting_expanded_state.system = self.mm.System()
             noninteracting_expanded_state.system = self.mm.System()
 
-            fully_interacting_expanded_state.system.__setstate__(str(ncgrp_stateinfo.variables['fully_interacting_expanded_system'][0]))
-            noninteracting_expanded_state.system.__setstate__(str(ncgrp_stateinfo.variables['noninteracting_expanded_system'][0]))
+            fully_interacting_expanded_state.system.__setstate__(expanded_data['fully_interacting_expanded_system'])
+            noninteracting_expanded_state.system.__setstate__(expanded_data['noninteracting_expanded_system'])
 
             self.fully_interacting_expanded_state = fully_interacting_expanded_state
             self.noninteracting_expanded_state = noninteracting_expanded_state
 
         final_time = time.time()
         elapsed_time = final_time - initial_time
-        logger.debug("Restoring thermodynamic states from NetCDF file took %.3f s." % elapsed_time)
-
-        return True
+        logger.debug("Restoring thermodynamic states took %.3f s." % elapsed_time)
 
     def _cache_context(self):
         """
@@ -372,7 +411,7 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
         initial_time = time.time()
         logger.debug("Creating and caching Context and Integrator.")
         state = self.states[0]
-        self._integrator = openmm.LangevinIntegrator(state.temperature, self.collision_rate, self.timestep)
+        self._integrator = self.mm.LangevinIntegrator(state.temperature, self.collision_rate, self.timestep)
         self._integrator.setRandomNumberSeed(int(np.random.randint(0, MAX_SEED)))
         self._context = self._create_context(state.system, self._integrator)
         final_time = time.time()
@@ -386,8 +425,8 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
             fully_interacting_expanded_state = self.fully_interacting_expanded_state
             noninteracting_expanded_state = self.noninteracting_expanded_state
 
-            fully_interacting_expanded_state_integrator = openmm.VerletIntegrator(self.timestep)
-            noninteracting_expanded_state_integrator = openmm.VerletIntegrator(self.timestep)
+            fully_interacting_expanded_state_integrator = self.mm.VerletIntegrator(self.timestep)
+            noninteracting_expanded_state_integrator = self.mm.VerletIntegrator(self.timestep)
 
             self._fully_interacting_expanded_context = self._create_context(fully_interacting_expanded_state.system,
                                                                             fully_interacting_expanded_state_integrator)
@@ -687,42 +726,50 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
         # TODO: Can combine these displacements and/or use cached potential energies to speed up this phase.
         # TODO: Break MC displacement and rotation into member functions and write separate unit tests.
         if self.mc_displacement and (self.mc_atoms is not None):
-            initial_time = time.time()
-            # Store original positions and energy.
-            original_positions = self.replica_positions[replica_index]
-            u_old = state.reduced_potential(original_positions, box_vectors=box_vectors, context=context)
-            # Make symmetric Gaussian trial displacement of ligand.
-            perturbed_positions = self.propose_displacement(self.displacement_sigma, original_positions, self.mc_atoms)
-            u_new = state.reduced_potential(perturbed_positions, box_vectors=box_vectors, context=context)
-            # Accept or reject with Metropolis criteria.
-            du = u_new - u_old
-            if (not np.isnan(u_new)) and ((du <= 0.0) or (np.random.rand() < np.exp(-du))):
-                self.displacement_trials_accepted += 1
-                self.replica_positions[replica_index] = perturbed_positions
-            #print("translation du = %f (%d)" % (du, self.displacement_trials_accepted))
-            # Print timing information.
-            final_time = time.time()
-            elapsed_time = final_time - initial_time
-            self.displacement_trial_time += elapsed_time
+            with self._trace('mc_displacement', 'mc', replica=replica_index):
+                initial_time = time.time()
+                # Store original positions and energy.
+                original_positions = self.replica_positions[replica_index]
+                u_old = state.reduced_potential(original_positions, box_vectors=box_vectors, context=context)
+                # Make symmetric Gaussian trial displacement of ligand.
+                perturbed_positions = self.propose_displacement(self.displacement_sigma, original_positions, self.mc_atoms)
+                u_new = state.reduced_potential(perturbed_positions, box_vectors=box_vectors, context=context)
+                # Accept or reject with Metropolis criteria.
+                du = u_new - u_old
+                self._event_counts['mc_displacement_proposed'] += 1
+                if (not np.isnan(u_new)) and ((du <= 0.0) or (np.random.rand() < np.exp(-du))):
+                    self.displacement_trials_accepted += 1
+                    self._event_counts['mc_displacement_accepted'] += 1
+                    self.replica_positions[replica_index] = perturbed_positions
+                #print("translation du = %f (%d)" % (du, self.displacement_trials_accepted))
+                # Print timing information.
+                final_time = time.time()
+                elapsed_time = final_time - initial_time
+                self.displacement_trial_time += elapsed_time
+                self._record_timing('mc_moves', elapsed_time, replica_index)
 
         # Attempt random rotation of ligand.
         if self.mc_rotation and (self.mc_atoms is not None):
-            initial_time = time.time()
-            # Store original positions and energy.
-            original_positions = self.replica_positions[replica_index]
-            u_old = state.reduced_potential(original_positions, box_vectors=box_vectors, context=context)
-            # Compute new potential.
-            perturbed_positions = self.propose_rotation(original_positions, self.mc_atoms)
-            u_new = state.reduced_potential(perturbed_positions, box_vectors=box_vectors, context=context)
-            du = u_new - u_old
-            if (not np.isnan(u_new)) and ((du <= 0.0) or (np.random.rand() < np.exp(-du))):
-                self.rotation_trials_accepted += 1
-                self.replica_positions[replica_index] = perturbed_positions
-            #print("rotation du = %f (%d)" % (du, self.rotation_trials_accepted))
-            # Accumulate timing information.
-            final_time = time.time()
-            elapsed_time = final_time - initial_time
-            self.rotation_trial_time += elapsed_time
+            with self._trace('mc_rotation', 'mc', replica=replica_index):
+                initial_time = time.time()
+                # Store original positions and energy.
+                original_positions = self.replica_positions[replica_index]
+                u_old = state.reduced_potential(original_positions, box_vectors=box_vectors, context=context)
+                # Compute new potential.
+                perturbed_positions = self.propose_rotation(original_positions, self.mc_atoms)
+                u_new = state.reduced_potential(perturbed_positions, box_vectors=box_vectors, context=context)
+                du = u_new - u_old
+                self._event_counts['mc_rotation_proposed'] += 1
+                if (not np.isnan(u_new)) and ((du <= 0.0) or (np.random.rand() < np.exp(-du))):
+                    self.rotation_trials_accepted += 1
+                    self._event_counts['mc_rotation_accepted'] += 1
+                    self.replica_positions[replica_index] = perturbed_positions
+                #print("rotation du = %f (%d)" % (du, self.rotation_trials_accepted))
+                # Accumulate timing information.
+                final_time = time.time()
+                elapsed_time = final_time - initial_time
+                self.rotation_trial_time += elapsed_time
+                self._record_timing('mc_moves', elapsed_time, replica_index)
 
         #
         # Propagate with dynamics.
@@ -754,7 +801,8 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
                 if np.isnan(context.getState(getEnergy=True).getPotentialEnergy() / state.kT):
                     raise Exception('Potential for replica %d is NaN before dynamics' % replica_index)
                 # Run dynamics.
-                integrator.step(self.nsteps_per_iteration)
+                with self._trace('integrate', 'replica', replica=replica_index):
+                    integrator.step(self.nsteps_per_iteration)
                 integrator_end_time = time.time()
                 # Get final positions
                 getstate_start_time = time.time()
@@ -775,6 +823,7 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
                 if str(e) == 'Particle coordinate is nan':
                     # If it's a NaN, increment the NaN counter and try again
                     nan_counter += 1
+                    self._event_counts['nan_retries'] += 1
                     if nan_counter >= MAX_NAN_RETRIES:
                         raise Exception('Maximum number of NAN retries (%d) exceeded.' % MAX_NAN_RETRIES)
                     logger.info('NaN detected in replica %d. Retrying (%d / %d).' % (replica_index, nan_counter, MAX_NAN_RETRIES))
@@ -812,14 +861,15 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
         # TODO: Streamline this idiom.
         if self.mpicomm:
             # MPI
-            from mpi4py import MPI
             if self.mc_displacement and (self.mc_atoms is not None):
+                from mpi4py import MPI
                 self.displacement_trials_accepted = self.mpicomm.reduce(self.displacement_trials_accepted, op=MPI.SUM)
                 self.displacement_trial_time = self.mpicomm.reduce(self.displacement_trial_time, op=MPI.SUM)
                 if self.mpicomm.rank == 0:
                     logger.debug("Displacement MC trial times consumed %.3f s aggregate (%d accepted)" % (self.displacement_trial_time, self.displacement_trials_accepted))
 
             if self.mc_rotation and (self.mc_atoms is not None):
+                from mpi4py import MPI
                 self.rotation_trials_accepted = self.mpicomm.reduce(self.rotation_trials_accepted, op=MPI.SUM)
                 self.rotation_trial_time = self.mpicomm.reduce(self.rotation_trial_time, op=MPI.SUM)
                 if self.mpicomm.rank == 0:
@@ -870,14 +920,22 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
         if (self.fully_interacting_expanded_state is not None) and (self.noninteracting_expanded_state is not None):
             self.ncfile.variables['fully_interacting_expanded_cutoff_energies'][self.iteration, :] = self.u_k_full[:]
             self.ncfile.variables['noninteracting_expanded_cutoff_energies'][self.iteration, :] = self.u_k_non[:]
-            self.ncfile.sync()
 
-    def _resume_from_netcdf(self, ncfile):
-        super(ModifiedHamiltonianExchange, self)._resume_from_netcdf(ncfile)
-        # Restore fully interacting energies
+    def _read_replica_data(self, ncfile):
+        replica_data = super(ModifiedHamiltonianExchange, self)._read_replica_data(ncfile)
+        # Read fully interacting energies
         if 'fully_interacting_expanded_cutoff_energies' in ncfile.variables:
-            self.u_k_full = ncfile.variables['fully_interacting_expanded_cutoff_energies'][self.iteration, :].copy()
-            self.u_k_non = ncfile.variables['noninteracting_expanded_cutoff_energies'][self.iteration, :].copy()
+            iteration = replica_data['iteration']
+            replica_data['u_k_full'] = np.array(ncfile.variables['fully_interacting_expanded_cutoff_energies'][iteration, :])
+            replica_data['u_k_non'] = np.array(ncfile.variables['noninteracting_expanded_cutoff_energies'][iteration, :])
+        return replica_data
+
+    def _restore_replica_data(self, replica_data):
+        super(ModifiedHamiltonianExchange, self)._restore_replica_data(replica_data)
+        # Restore fully interacting energies
+        if 'u_k_full' in replica_data:
+            self.u_k_full = replica_data['u_k_full'].copy()
+            self.u_k_non = replica_data['u_k_non'].copy()
 
     def _compute_energies(self):
         """
@@ -905,13 +963,15 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
 
             # Compute energies for this node's share of states.
             for state_index in range(self.mpicomm.rank, self.nstates, self.mpicomm.size):
-                # Set alchemical state.
-                AbsoluteAlchemicalFactory.perturbContext(context, self.states[state_index].alchemical_state)
-                for replica_index in range(self.nstates):
-                    self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], context=context)
+                with self._trace('energy', 'state', state=state_index):
+                    # Set alchemical state.
+                    AbsoluteAlchemicalFactory.perturbContext(context, self.states[state_index].alchemical_state)
+                    for replica_index in range(self.nstates):
+                        self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], context=context)
 
             # Send final energies to all nodes.
-            energies_gather = self.mpicomm.allgather(self.u_kl[:,self.mpicomm.rank:self.nstates:self.mpicomm.size])
+            with self._timer('synchronization'):
+                energies_gather = self.mpicomm.allgather(self.u_kl[:,self.mpicomm.rank:self.nstates:self.mpicomm.size])
             for state_index in range(self.nstates):
                 source = state_index % self.mpicomm.size # node with trajectory data
                 index = state_index // self.mpicomm.size # index within trajectory batch
@@ -920,10 +980,11 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
         else:
             # Serial version.
             for state_index in range(self.nstates):
-                # Set alchemical state.
-                AbsoluteAlchemicalFactory.perturbContext(context, self.states[state_index].alchemical_state)
-                for replica_index in range(self.nstates):
-                    self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], context=context)
+                with self._trace('energy', 'state', state=state_index):
+                    # Set alchemical state.
+                    AbsoluteAlchemicalFactory.perturbContext(context, self.states[state_index].alchemical_state)
+                    for replica_index in range(self.nstates):
+                        self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], context=context)
 
         end_time = time.time()
         elapsed_time = end_time - start_time
@@ -949,8 +1010,9 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
                     self.u_k_non[replica_index] = self.noninteracting_expanded_state.reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], context=noninteracting_expanded_context)
 
                 # Send final energies to all nodes.
-                energies_gather_full = self.mpicomm.allgather(self.u_k_full[self.mpicomm.rank:self.nstates:self.mpicomm.size])
-                energies_gather_non = self.mpicomm.allgather(self.u_k_non[self.mpicomm.rank:self.nstates:self.mpicomm.size])
+                with self._timer('synchronization'):
+                    energies_gather_full = self.mpicomm.allgather(self.u_k_full[self.mpicomm.rank:self.nstates:self.mpicomm.size])
+                    energies_gather_non = self.mpicomm.allgather(self.u_k_non[self.mpicomm.rank:self.nstates:self.mpicomm.size])
                 for replica_index in range(self.nstates):
                     source = replica_index % self.mpicomm.size # node with data
                     index = replica_index // self.mpicomm.size # index within batch
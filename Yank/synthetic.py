@@ -0,0 +1,449 @@
+#!/usr/local/bin/env python
+
+# ==============================================================================
+# MODULE DOCSTRING
+# ==============================================================================
+
+"""
+Synthetic OpenMM backend to test and benchmark the replica exchange machinery.
+
+ReplicaExchange accepts an implementation of the OpenMM API through its ``mm``
+argument. SyntheticOpenMM implements the Context, Integrator and minimizer used
+by ModifiedHamiltonianExchange with an analytic model: each particle is an
+independent 3D harmonic oscillator whose spring constant depends linearly on
+the alchemical parameters of the Context, and the integrator samples exactly
+from the Boltzmann distribution of the current state with a configurable
+correlation between iterations. The free energy differences between the
+alchemical states are known analytically, and the wall clock time of each
+integration step and energy evaluation can be configured, so that the cost of
+the bookkeeping (mixing, I/O, MPI synchronization, analysis) can be measured
+for any number of states and atoms without running real dynamics on a GPU.
+
+SyntheticCommunicator mocks an mpi4py communicator of several ranks within a
+single process, in which every other rank contributes a copy of the data of
+the local rank. The data goes through pickle as it would through MPI.
+
+"""
+
+# ==============================================================================
+# GLOBAL IMPORTS
+# ==============================================================================
+
+import copy
+import time
+import pickle
+
+import numpy as np
+from simtk import openmm, unit
+
+from alchemy import AlchemicalState
+
+from .repex import ThermodynamicState, MAX_SEED
+
+kB = unit.BOLTZMANN_CONSTANT_kB * unit.AVOGADRO_CONSTANT_NA  # Boltzmann constant
+
+# Alchemical parameters of the synthetic System.
+SYNTHETIC_PARAMETERS = ('lambda_electrostatics', 'lambda_sterics')
+
+
+# ==============================================================================
+# SYNTHETIC OPENMM OBJECTS
+# ==============================================================================
+
+class SyntheticState(object):
+    """Snapshot of a SyntheticContext mimicking simtk.openmm.State."""
+
+    def __init__(self, positions=None, box_vectors=None, potential_energy=None, parameters=None):
+        self._positions = positions
+        self._box_vectors = box_vectors
+        self._potential_energy = potential_energy
+        self._parameters = parameters
+
+    def getPositions(self, asNumpy=False):
+        if self._positions is None:
+            raise Exception('Invalid request: positions were not requested in getState()')
+        if asNumpy:
+            return unit.Quantity(self._positions, unit.nanometers)
+        return unit.Quantity([openmm.Vec3(*position) for position in self._positions], unit.nanometers)
+
+    def getPeriodicBoxVectors(self, asNumpy=False):
+        if asNumpy:
+            return unit.Quantity(self._box_vectors, unit.nanometers)
+        return unit.Quantity([openmm.Vec3(*box_vector) for box_vector in self._box_vectors], unit.nanometers)
+
+    def getPotentialEnergy(self):
+        if self._potential_energy is None:
+            raise Exception('Invalid request: energy was not requested in getState()')
+        return self._potential_energy * unit.kilojoules_per_mole
+
+    def getParameters(self):
+        return copy.copy(self._parameters)
+
+
+class SyntheticIntegrator(object):
+    """
+    Integrator sampling the harmonic oscillators of a SyntheticContext.
+
+    With a collision rate, each call to step() draws new positions from the
+    Boltzmann distribution at the integrator temperature with a correlation
+    exp(-collision_rate * timestep * nsteps) with the previous positions, as the
+    exact solution of overdamped Langevin dynamics. Without it (Verlet), the
+    positions are left unchanged.
+
+    """
+
+    def __init__(self, backend, timestep, temperature=None, collision_rate=None):
+        self._backend = backend
+        self._timestep = timestep
+        self._temperature = temperature
+        self._collision_rate = collision_rate
+        self._random_state = np.random.RandomState(backend.random_state.randint(0, MAX_SEED))
+        self._context = None
+
+    def getStepSize(self):
+        return self._timestep
+
+    def getTemperature(self):
+        return self._temperature
+
+    def setTemperature(self, temperature):
+        self._temperature = temperature
+
+    def getFriction(self):
+        return self._collision_rate
+
+    def setRandomNumberSeed(self, seed):
+        # As in OpenMM, a seed of 0 picks a random seed.
+        self._random_state = np.random.RandomState(seed if seed != 0 else None)
+
+    def step(self, nsteps):
+        if self._context is None:
+            raise Exception('Integrator is not bound to a Context')
+        if self._backend.step_time > 0.0:
+            time.sleep(self._backend.step_time * nsteps)
+        if self._collision_rate is None or self._temperature is None:
+            return
+
+        context = self._context
+        kT = (kB * self._temperature).value_in_unit(unit.kilojoules_per_mole)
+        sigma = np.sqrt(kT / self._backend.compute_spring_constant(context._parameters))
+        elapsed_time = nsteps * self._timestep.value_in_unit(unit.picoseconds)
+        correlation = np.exp(-self._collision_rate.value_in_unit(unit.picoseconds**-1) * elapsed_time)
+        positions = context._get_positions()
+        noise = self._random_state.standard_normal(positions.shape)
+        positions = correlation * positions + np.sqrt(1.0 - correlation**2) * sigma * noise
+        context._positions = unit.Quantity(positions, unit.nanometers)
+
+
+class SyntheticContext(object):
+    """
+    Context of independent harmonic oscillators mimicking simtk.openmm.Context.
+
+    The potential energy is 0.5 * K(lambda) * sum(x**2) over the interacting
+    particles, where K(lambda) is computed by SyntheticOpenMM.compute_spring_constant()
+    from the global parameters defined by the forces of the System.
+
+    Unlike OpenMM, setPositions() keeps a reference to the positions and only
+    converts the coordinates needed by the energy, so that the cost of an
+    energy evaluation does not depend on the number of particles.
+
+    """
+
+    def __init__(self, backend, system, integrator):
+        self._backend = backend
+        self._system = system
+        self._integrator = integrator
+        integrator._context = self
+
+        # Read the global parameters and their default values from the System forces.
+        self._parameters = dict()
+        for force_index in range(system.getNumForces()):
+            force = system.getForce(force_index)
+            if hasattr(force, 'getNumGlobalParameters'):
+                for parameter_index in range(force.getNumGlobalParameters()):
+                    parameter_name = force.getGlobalParameterName(parameter_index)
+                    self._parameters[parameter_name] = force.getGlobalParameterDefaultValue(parameter_index)
+
+        self._natoms = system.getNumParticles()
+        self._positions = unit.Quantity(np.zeros([self._natoms, 3], np.float64), unit.nanometers)
+        self._box_vectors = np.array([box_vector.value_in_unit(unit.nanometers)
+                                      for box_vector in system.getDefaultPeriodicBoxVectors()], np.float64)
+
+    def getSystem(self):
+        return self._system
+
+    def getIntegrator(self):
+        return self._integrator
+
+    def getParameter(self, name):
+        return self._parameters[name]
+
+    def setParameter(self, name, value):
+        if name not in self._parameters:
+            raise Exception('Called setParameter() with invalid parameter name %s' % name)
+        self._parameters[name] = value
+
+    def setPositions(self, positions):
+        if not unit.is_quantity(positions):
+            positions = unit.Quantity(np.asarray(positions, np.float64), unit.nanometers)
+        if len(positions) != self._natoms:
+            raise Exception('Called setPositions() on a Context with the wrong number of positions')
+        self._positions = positions
+
+    def setPeriodicBoxVectors(self, a, b, c):
+        self._box_vectors = np.array([vector.value_in_unit(unit.nanometers) if unit.is_quantity(vector) else vector
+                                      for vector in [a, b, c]], np.float64)
+
+    def setVelocitiesToTemperature(self, temperature, randomSeed=0):
+        # Velocities are not part of the model.
+        pass
+
+    def getState(self, getPositions=False, getEnergy=False, getParameters=False, enforcePeriodicBox=False, **kwargs):
+        positions, potential_energy, parameters = None, None, None
+        if getPositions:
+            positions = self._get_positions()
+        if getEnergy:
+            potential_energy = self._compute_potential_energy()
+        if getParameters:
+            parameters = copy.copy(self._parameters)
+        return SyntheticState(positions=positions, box_vectors=self._box_vectors.copy(),
+                              potential_energy=potential_energy, parameters=parameters)
+
+    def _get_positions(self, nparticles=None):
+        """Return a copy of the positions of the first nparticles (default all) in nm."""
+        positions = self._positions
+        if nparticles is not None and nparticles < self._natoms:
+            positions = positions[:nparticles]
+        # value_in_unit() always returns a copy.
+        return np.asarray(positions.value_in_unit(unit.nanometers), np.float64)
+
+    def _compute_potential_energy(self):
+        """Return the potential energy in kJ/mol."""
+        if self._backend.energy_time > 0.0:
+            time.sleep(self._backend.energy_time)
+        positions = self._get_positions(self._backend.get_ninteracting_particles(self._natoms)).ravel()
+        return 0.5 * self._backend.compute_spring_constant(self._parameters) * np.dot(positions, positions)
+
+
+class SyntheticLocalEnergyMinimizer(object):
+    """Minimizer moving all the harmonic oscillators to their minimum."""
+
+    @staticmethod
+    def minimize(context, tolerance=10.0, maxIterations=0):
+        context._positions = unit.Quantity(np.zeros([context._natoms, 3], np.float64), unit.nanometers)
+
+
+class SyntheticOpenMM(object):
+    """
+    Synthetic implementation of the OpenMM API to pass as ``mm`` to ReplicaExchange.
+
+    Only the objects used by ModifiedHamiltonianExchange are synthetic: the
+    System and the other attributes are taken from simtk.openmm. The base
+    ReplicaExchange computes energies with new OpenMM Contexts and cannot use
+    this backend.
+
+    Parameters
+    ----------
+    step_time : float, optional, default=0.0
+        Wall clock time (in seconds) spent in each integration step.
+    energy_time : float, optional, default=0.0
+        Wall clock time (in seconds) spent in each energy evaluation.
+    spring_constant : simtk.unit.Quantity, optional, default=100 kJ/mol/nm**2
+        Spring constant of the harmonic oscillators when all the alchemical
+        parameters are 0.
+    ninteracting_particles : int, optional, default=None
+        Number of particles (the first ones) entering the potential energy. The
+        other particles are only propagated and stored, which allows measuring
+        the bookkeeping overhead of large systems at a fixed energy cost. All
+        particles interact if None.
+    seed : int, optional, default=None
+        Seed of the random number generator of the integrators.
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> from yank.sampling import ModifiedHamiltonianExchange
+    >>> base_state, alchemical_states, positions = create_synthetic_testsystem(natoms=100, nstates=4)
+    >>> store_filename = tempfile.NamedTemporaryFile().name
+    >>> simulation = ModifiedHamiltonianExchange(store_filename, mm=SyntheticOpenMM(seed=0))
+    >>> simulation.create(base_state, alchemical_states, positions, options={'number_of_iterations': 3})
+    >>> simulation.run()
+
+    """
+
+    System = openmm.System
+    LocalEnergyMinimizer = SyntheticLocalEnergyMinimizer
+
+    def __init__(self, step_time=0.0, energy_time=0.0,
+                 spring_constant=100.0*unit.kilojoules_per_mole/unit.nanometers**2,
+                 ninteracting_particles=None, seed=None):
+        self.step_time = step_time
+        self.energy_time = energy_time
+        self.spring_constant = spring_constant.value_in_unit(unit.kilojoules_per_mole/unit.nanometers**2)
+        self.ninteracting_particles = ninteracting_particles
+        self.random_state = np.random.RandomState(seed)
+
+    def __getattr__(self, name):
+        return getattr(openmm, name)
+
+    def Context(self, system, integrator, platform=None, properties=None):
+        return SyntheticContext(self, system, integrator)
+
+    def LangevinIntegrator(self, temperature, frictionCoeff, stepSize):
+        return SyntheticIntegrator(self, stepSize, temperature=temperature, collision_rate=frictionCoeff)
+
+    def VerletIntegrator(self, stepSize):
+        return SyntheticIntegrator(self, stepSize)
+
+    def get_ninteracting_particles(self, natoms):
+        """Number of interacting particles of a System with natoms particles."""
+        if self.ninteracting_particles is None:
+            return natoms
+        return min(natoms, self.ninteracting_particles)
+
+    def compute_spring_constant(self, parameters):
+        """
+        Spring constant (in kJ/mol/nm**2) for the given alchemical parameters.
+
+        The spring constant is K0 * (1 + sum(lambda)), where the sum runs over
+        the parameters whose name starts with 'lambda_'.
+
+        """
+        lambda_sum = sum(value for name, value in parameters.items() if name.startswith('lambda_'))
+        return self.spring_constant * (1.0 + lambda_sum)
+
+    def compute_reduced_free_energies(self, alchemical_states, natoms):
+        """
+        Analytical reduced free energies of the alchemical states of a synthetic System.
+
+        Parameters
+        ----------
+        alchemical_states : list of AlchemicalState
+            The alchemical states. Only the SYNTHETIC_PARAMETERS are considered.
+        natoms : int
+            The number of particles of the System.
+
+        Returns
+        -------
+        f_k : numpy.array
+            The reduced free energy of each state relative to the first one.
+
+        """
+        spring_constants = np.array([self.compute_spring_constant({name: alchemical_state[name]
+                                                                   for name in SYNTHETIC_PARAMETERS})
+                                     for alchemical_state in alchemical_states])
+        # The partition function of a 3D harmonic oscillator is proportional to K**(-3/2).
+        f_k = 1.5 * self.get_ninteracting_particles(natoms) * np.log(spring_constants)
+        return f_k - f_k[0]
+
+
+# ==============================================================================
+# SYNTHETIC TEST SYSTEMS
+# ==============================================================================
+
+def create_synthetic_system(natoms):
+    """
+    Create a System of natoms particles defining the SYNTHETIC_PARAMETERS.
+
+    The System has no interactions, the parameters are defined by an empty
+    CustomBondForce so that AbsoluteAlchemicalFactory.perturbContext() sets them.
+
+    """
+    system = openmm.System()
+    for _ in range(natoms):
+        system.addParticle(12.0 * unit.amu)
+    force = openmm.CustomBondForce('0')
+    for parameter_name in SYNTHETIC_PARAMETERS:
+        force.addGlobalParameter(parameter_name, 1.0)
+    system.addForce(force)
+    return system
+
+
+def create_synthetic_testsystem(natoms, nstates, temperature=300.0*unit.kelvin):
+    """
+    Create the arguments of ModifiedHamiltonianExchange.create() for a synthetic System.
+
+    Parameters
+    ----------
+    natoms : int
+        The number of particles.
+    nstates : int
+        The number of alchemical states, from fully interacting to decoupled.
+    temperature : simtk.unit.Quantity, optional, default=300 K
+        The temperature of the thermodynamic states.
+
+    Returns
+    -------
+    base_state : ThermodynamicState
+        The reference state holding the synthetic System.
+    alchemical_states : list of AlchemicalState
+        The alchemical states with linearly decreasing lambda parameters.
+    positions : simtk.unit.Quantity
+        The natoms x 3 initial positions.
+
+    """
+    base_state = ThermodynamicState(system=create_synthetic_system(natoms), temperature=temperature)
+    lambda_values = np.linspace(1.0, 0.0, nstates)
+    alchemical_states = [AlchemicalState(**{name: float(lambda_value) for name in SYNTHETIC_PARAMETERS})
+                         for lambda_value in lambda_values]
+    positions = unit.Quantity(0.1 * np.random.randn(natoms, 3), unit.nanometers)
+    return base_state, alchemical_states, positions
+
+
+# ==============================================================================
+# SYNTHETIC MPI COMMUNICATOR
+# ==============================================================================
+
+class SyntheticCommunicator(object):
+    """
+    Mock of an mpi4py communicator of several ranks running in a single process.
+
+    The local process plays the given rank, and every other rank contributes a
+    copy of the local data to the collective operations. The data is pickled and
+    unpickled once per rank to account for the serialization cost of MPI, and an
+    optional latency is added to each collective call.
+
+    Parameters
+    ----------
+    size : int, optional, default=2
+        The number of simulated ranks.
+    rank : int, optional, default=0
+        The rank of the local process.
+    latency : float, optional, default=0.0
+        Wall clock time (in seconds) added to each collective call.
+
+    """
+
+    def __init__(self, size=2, rank=0, latency=0.0):
+        self.size = size
+        self.rank = rank
+        self.latency = latency
+
+    def _exchange(self, obj, nranks):
+        if self.latency > 0.0:
+            time.sleep(self.latency)
+        return [pickle.loads(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)) for _ in range(nranks)]
+
+    def barrier(self):
+        self._exchange(None, 0)
+
+    def bcast(self, obj, root=0):
+        if self.rank == root:
+            self._exchange(obj, self.size - 1)
+            return obj
+        return self._exchange(obj, 1)[0]
+
+    def gather(self, obj, root=0):
+        gathered = self._exchange(obj, self.size)
+        return gathered if self.rank == root else None
+
+    def allgather(self, obj):
+        return self._exchange(obj, self.size)
+
+    def reduce(self, obj, op=None, root=0):
+        # Only sums are supported.
+        reduced = sum(self._exchange(obj, self.size))
+        return reduced if self.rank == root else None
+
+    def Abort(self, errorcode=0):
+        raise SystemExit(errorcode)
@@ -0,0 +1,689 @@
+#!/usr/local/bin/env python
+
+"""
+Test analysis facilities in analyze.py.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import os
+import time
+import logging
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+import numpy as np
+import mdtraj
+from pymbar import BAR, timeseries, testsystems
+import netCDF4 as netcdf
+from mdtraj.utils import enter_temp_directory
+
+from yank import utils
+from yank.analyze import *
+
+
+#=============================================================================================
+# SUBROUTINES FOR TESTING
+#=============================================================================================
+
+def create_store_file(store_filename, niterations=50, nstates=4, seed=0):
+    """Create a minimal store file with random states and energies.
+
+    Returns
+    -------
+    replica_states : numpy.array
+        replica_states[n,i] is the state of replica i at iteration n.
+    u_nkl : numpy.array
+        u_nkl[n,i,l] is the reduced potential of replica i at iteration n evaluated at state l.
+
+    """
+    random_state = np.random.RandomState(seed)
+    replica_states = np.array([random_state.permutation(nstates) for _ in range(niterations)])
+    u_nkl = random_state.normal(size=(niterations, nstates, nstates))
+
+    ncfile = netcdf.Dataset(store_filename, 'w')
+    ncfile.createDimension('iteration', 0)
+    ncfile.createDimension('replica', nstates)
+    ncfile.createVariable('states', 'i4', ('iteration', 'replica'))[:] = replica_states
+    ncfile.createVariable('energies', 'f8', ('iteration', 'replica', 'replica'))[:] = u_nkl
+    ncfile.close()
+    return replica_states, u_nkl
+
+
+def deconvolute_reference(replica_states, u_nkl):
+    """Deconvolute replica energies one iteration at a time."""
+    niterations, nstates = replica_states.shape
+    u_kln = np.zeros([nstates, nstates, niterations])
+    u_n = np.zeros([niterations])
+    for iteration in range(niterations):
+        for replica_index, state_index in enumerate(replica_states[iteration]):
+            u_kln[state_index, :, iteration] = u_nkl[iteration, replica_index, :]
+            u_n[iteration] += u_nkl[iteration, replica_index, state_index]
+    return u_kln, u_n
+
+
+def random_phase_data(niterations, nstates=3, seed=0):
+    """Generate random states and energies of a phase with overlapping thermodynamic states."""
+    random_state = np.random.RandomState(seed)
+    replica_states = np.array([random_state.permutation(nstates) for _ in range(niterations)])
+    u_nkl = random_state.normal(scale=0.1, size=(niterations, nstates, nstates)) + np.arange(nstates)
+    return replica_states, u_nkl
+
+
+def create_phase_store_file(store_filename, replica_states, u_nkl, mode='w'):
+    """Create (or extend with mode='a') a store file that can be analyzed with analyze_phase()."""
+    niterations, nstates = replica_states.shape
+    ncfile = netcdf.Dataset(store_filename, mode)
+    if mode == 'w':
+        ncfile.createDimension('iteration', 0)
+        ncfile.createDimension('replica', nstates)
+        ncfile.createDimension('atom', 1)
+        ncfile.createDimension('spatial', 3)
+        ncfile.createVariable('positions', 'f4', ('iteration', 'replica', 'atom', 'spatial'))
+        ncfile.createVariable('states', 'i4', ('iteration', 'replica'))
+        ncfile.createVariable('energies', 'f8', ('iteration', 'replica', 'replica'))
+        ncgrp = ncfile.createGroup('thermodynamic_states')
+        ncgrp.createVariable('temperatures', 'f8', ('replica',))[:] = 300.0
+    ncfile.variables['states'][:] = replica_states
+    ncfile.variables['energies'][:] = u_nkl
+    ncfile.variables['positions'][:niterations] = 0.0
+    ncfile.close()
+
+
+def create_trajectory_store_file(store_filename, niterations=12, nstates=3, nwaters=10, seed=0):
+    """Create a store file of a periodic system made of a solute and water molecules with random positions.
+
+    Returns
+    -------
+    topology : mdtraj.Topology
+        The topology of the system.
+    replica_states : numpy.array
+        replica_states[n,i] is the state of replica i at iteration n.
+    positions : numpy.array
+        positions[n,i] are the positions of replica i at iteration n in nm.
+    box_vectors : numpy.array
+        box_vectors[n,i] are the box vectors of replica i at iteration n in nm.
+
+    """
+    from simtk import openmm
+
+    topology = mdtraj.Topology()
+    chain = topology.add_chain()
+    residue = topology.add_residue('LIG', chain)
+    solute_atoms = [topology.add_atom('C%d' % i, mdtraj.element.carbon, residue) for i in range(5)]
+    for atom1, atom2 in zip(solute_atoms[:-1], solute_atoms[1:]):
+        topology.add_bond(atom1, atom2)
+    for _ in range(nwaters):
+        residue = topology.add_residue('HOH', chain)
+        oxygen = topology.add_atom('O', mdtraj.element.oxygen, residue)
+        for name in ['H1', 'H2']:
+            topology.add_bond(oxygen, topology.add_atom(name, mdtraj.element.hydrogen, residue))
+
+    system = openmm.System()
+    for _ in range(topology.n_atoms):
+        system.addParticle(1.0)
+    system.setDefaultPeriodicBoxVectors(*[openmm.Vec3(*row) for row in 2.0 * np.eye(3)])
+    nonbonded_force = openmm.NonbondedForce()
+    nonbonded_force.setNonbondedMethod(openmm.NonbondedForce.CutoffPeriodic)
+    for _ in range(topology.n_atoms):
+        nonbonded_force.addParticle(0.0, 0.1, 0.0)
+    system.addForce(nonbonded_force)
+
+    # Random positions spread over several periodic images and slightly different boxes.
+    random_state = np.random.RandomState(seed)
+    replica_states = np.array([random_state.permutation(nstates) for _ in range(niterations)])
+    positions = random_state.uniform(-1.0, 3.0, size=(niterations, nstates, topology.n_atoms, 3)).astype(np.float32)
+    box_sizes = random_state.uniform(1.8, 2.2, size=(niterations, nstates, 1, 1))
+    box_vectors = (box_sizes * np.eye(3)).astype(np.float32)
+
+    ncfile = netcdf.Dataset(store_filename, 'w')
+    ncfile.createDimension('iteration', 0)
+    ncfile.createDimension('replica', nstates)
+    ncfile.createDimension('atom', topology.n_atoms)
+    ncfile.createDimension('spatial', 3)
+    ncfile.createVariable('states', 'i4', ('iteration', 'replica'))[:] = replica_states
+    ncfile.createVariable('positions', 'f4', ('iteration', 'replica', 'atom', 'spatial'))[:] = positions
+    ncfile.createVariable('box_vectors', 'f4', ('iteration', 'replica', 'spatial', 'spatial'))[:] = box_vectors
+    ncgrp = ncfile.createGroup('metadata')
+    ncgrp.createDimension('scalar', 1)
+    ncgrp.createVariable('reference_system', str, 'scalar')[0] = openmm.XmlSerializer.serialize(system)
+    ncgrp.createVariable('topology', str, 'scalar')[0] = utils.serialize_topology(topology)
+    ncfile.close()
+    return topology, replica_states, positions, box_vectors
+
+
+#=============================================================================================
+# TESTING FUNCTIONS
+#=============================================================================================
+
+def test_deconvolute_energies():
+    """Chunked deconvolution of the store file matches a per-iteration deconvolution."""
+    with enter_temp_directory():
+        replica_states, u_nkl = create_store_file('simulation.nc', niterations=50)
+        u_kln, u_n = deconvolute_reference(replica_states, u_nkl)
+        iterations = np.array([3, 4, 17, 29, 48])
+
+        ncfile = netcdf.Dataset('simulation.nc', 'r')
+        try:
+            for chunk_size in [1, 7, 1000]:
+                assert np.allclose(extract_u_n(ncfile, chunk_size=chunk_size), u_n)
+                assert np.allclose(deconvolute_energies(ncfile, chunk_size=chunk_size), u_kln)
+                assert np.allclose(deconvolute_energies(ncfile, iterations, chunk_size=chunk_size),
+                                   u_kln[:, :, iterations])
+        finally:
+            ncfile.close()
+
+
+def test_committed_iterations():
+    """Readers ignore the iterations that are not published in the store index."""
+    with enter_temp_directory():
+        replica_states, u_nkl = random_phase_data(niterations=200)
+        create_phase_store_file('committed.nc', replica_states[:150], u_nkl[:150])
+        create_phase_store_file('simulation.nc', replica_states, u_nkl)
+
+        ncfile = netcdf.Dataset('simulation.nc', 'r')
+        try:
+            # Store files without an index are complete.
+            assert utils.get_committed_iterations(ncfile) == 200
+            utils.write_store_index('simulation.nc', 150)
+            assert utils.get_committed_iterations(ncfile) == 150
+            assert extract_u_n(ncfile).shape == (150,)
+            assert deconvolute_energies(ncfile).shape == (3, 3, 150)
+            assert NeighborBAR.from_ncfile(ncfile).niterations == 149
+        finally:
+            ncfile.close()
+
+        # The analysis of the in-progress file is the analysis of the committed iterations.
+        analysis = analyze_phase('simulation.nc', use_cache=False)
+        expected = analyze_phase('committed.nc', use_cache=False)
+        assert np.allclose(analysis['DeltaF'], expected['DeltaF'])
+        assert np.allclose(analysis['dDeltaF'], expected['dDeltaF'])
+
+
+def test_phase_reader():
+    """PhaseReader exposes the committed iterations, options and metadata of a store file."""
+    with enter_temp_directory():
+        replica_states, u_nkl = random_phase_data(niterations=100)
+        create_phase_store_file('simulation.nc', replica_states, u_nkl)
+        ncfile = netcdf.Dataset('simulation.nc', 'a')
+        ncgrp = ncfile.createGroup('metadata')
+        ncvar = ncgrp.createVariable('standard_state_correction', 'f8')
+        ncvar.assignValue(-1.5)
+        setattr(ncvar, 'type', 'float')
+        ncfile.close()
+        utils.write_store_index('simulation.nc', 80)
+
+        with PhaseReader('simulation.nc') as reader:
+            assert reader.status() == dict(number_of_iterations=80, nstates=3, natoms=1)
+            assert reader.states.shape == (80, 3)
+            assert np.all(reader.states[:] == replica_states[:80])
+            assert np.all(reader.states[-1] == replica_states[79])
+            assert np.allclose(reader.energies[[2, 5], 1], u_nkl[[2, 5], 1])
+            assert np.allclose(reader.energies[10:2:-3, :, 0], u_nkl[10:2:-3, :, 0])
+            try:
+                reader.states[80]
+                assert False, 'Uncommitted iterations must not be readable.'
+            except IndexError:
+                pass
+            chunks = list(reader.iterate_chunks(['states', 'energies'], first_iteration=5, chunk_size=30))
+            assert [chunk[0] for chunk in chunks] == [5, 35, 65]
+            assert np.allclose(np.concatenate([chunk[2] for chunk in chunks]), u_nkl[5:80])
+            assert reader.options == {}
+            assert reader.metadata['standard_state_correction'] == -1.5
+
+            # The analysis is the online analysis of the committed iterations.
+            analysis = reader.analyze()
+            online_analysis = OnlineAnalysis(nstates=3)
+            online_analysis.extend(replica_states[:80], u_nkl[:80])
+            assert np.allclose(analysis['Delta_f_ij'], online_analysis.estimate()['Delta_f_ij'])
+        assert reader._ncfile is None
+
+
+def test_print_status_progress():
+    """print_status reports throughput and completion time from the progress files only."""
+    with enter_temp_directory():
+        # The NetCDF file is not a valid store file, so it must not be opened.
+        with open('complex.nc', 'w') as f:
+            f.write('not a NetCDF file')
+        progress = dict(iteration=250, number_of_iterations=1000, nstates=12, natoms=2000,
+                        timestamp=time.time(), iteration_time=2.0, ns_per_day=43.2, acceptance=0.25,
+                        converged_iteration=None,
+                        online_estimate=dict(iteration=240, DeltaF=-10.0, dDeltaF=0.3, Neff_max=80.0),
+                        neighbor_bar_estimate=dict(iteration=250, DeltaF=-9.5, dDeltaF=0.4))
+        write_progress('complex.nc', progress)
+        assert read_progress('complex.nc') == progress
+
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        analyze_logger = logging.getLogger('yank.analyze')
+        analyze_logger.addHandler(handler)
+        analyze_logger.setLevel(logging.INFO)
+        try:
+            assert print_status('.')
+        finally:
+            analyze_logger.removeHandler(handler)
+        assert '       250 / 1000 iterations completed' in messages
+        assert any('43.20 ns/day' in message and '25.0%' in message for message in messages)
+        assert any('estimated completion in 0:25:00' in message for message in messages)
+        assert any('DeltaF = -10.000 +- 0.300 kT' in message for message in messages)
+        assert any('neighbor BAR estimate at iteration 250: DeltaF = -9.500 +- 0.400 kT' in message
+                   for message in messages)
+
+
+def test_transition_matrix():
+    """Vectorized transition counts and matrix match an explicit loop."""
+    with enter_temp_directory():
+        replica_states, _ = create_store_file('simulation.nc', niterations=30, nstates=5)
+        niterations, nstates = replica_states.shape
+
+        Nij = np.zeros([nstates, nstates])
+        for iteration in range(niterations - 1):
+            for replica_index in range(nstates):
+                Nij[replica_states[iteration, replica_index], replica_states[iteration+1, replica_index]] += 1
+        assert np.all(count_state_transitions(replica_states) == Nij)
+
+        Tij = estimate_transition_matrix(Nij)
+        assert np.allclose(Tij.sum(axis=1), 1.0)
+        assert np.allclose(Tij, (Nij + Nij.T) / (Nij + Nij.T).sum(axis=1)[:, np.newaxis])
+
+        ncfile = netcdf.Dataset('simulation.nc', 'r')
+        try:
+            Tij_ncfile, relaxation_time = compute_mixing_statistics(ncfile)
+        finally:
+            ncfile.close()
+        assert np.allclose(Tij_ncfile, Tij)
+        assert relaxation_time == compute_relaxation_time(Tij)[1]
+
+    # Unvisited states transition to themselves, and a decomposable chain never relaxes.
+    Tij = estimate_transition_matrix(np.array([[2.0, 0.0, 0.0], [0.0, 3.0, 0.0], [0.0, 0.0, 0.0]]))
+    assert np.all(Tij == np.eye(3))
+    assert np.isinf(compute_relaxation_time(Tij)[1])
+
+
+def test_statistical_inefficiency():
+    """FFT statistical inefficiency matches pymbar's direct estimate."""
+    A_n = testsystems.correlated_timeseries_example(N=2000, tau=5.0, seed=0)
+    assert np.isclose(statistical_inefficiency(A_n), timeseries.statisticalInefficiency(A_n, fast=False))
+    assert statistical_inefficiency(np.ones(10)) == 11
+
+
+def test_detect_equilibration():
+    """Coarse-to-fine equilibration detection agrees with pymbar's exhaustive search."""
+    A_t = testsystems.correlated_timeseries_example(N=2000, tau=5.0, seed=0)
+    A_t[:200] += np.linspace(3.0, 0.0, 200)
+    t0, g, Neff_max = timeseries.detectEquilibration(A_t, fast=False)
+
+    # With a grid larger than the series, the search is exhaustive.
+    assert detect_equilibration(A_t, grid_size=len(A_t))[0] == t0
+    fast_t0, fast_g, fast_Neff_max = detect_equilibration(A_t)
+    assert np.isclose(fast_Neff_max, Neff_max, rtol=0.05)
+
+    # Incremental detection finds the same region as detection from scratch.
+    detector = EquilibrationDetector()
+    for chunk_start in range(0, len(A_t), 500):
+        detector.extend(A_t[chunk_start:chunk_start+500])
+        assert np.isclose(detector.detect()[2], detect_equilibration(A_t[:chunk_start+500])[2], rtol=0.05)
+
+
+def test_online_analysis_deconvolution():
+    """OnlineAnalysis deconvolutes replicas incrementally as a full deconvolution would."""
+    nstates, niterations = 4, 50
+    random_state = np.random.RandomState(0)
+    replica_states = np.array([random_state.permutation(nstates) for _ in range(niterations)])
+    u_nkl = random_state.normal(size=(niterations, nstates, nstates))
+    u_kln, u_n = deconvolute_reference(replica_states, u_nkl)
+
+    # Mix single appends and bulk extensions to exercise buffer growth.
+    online_analysis = OnlineAnalysis(nstates)
+    for iteration in range(10):
+        online_analysis.append(replica_states[iteration], u_nkl[iteration])
+    online_analysis.extend(replica_states[10:], u_nkl[10:])
+
+    assert online_analysis.niterations == niterations
+    assert np.allclose(online_analysis.u_kln, u_kln)
+    assert np.allclose(online_analysis.u_n, u_n)
+
+
+def test_online_analysis_min_iterations():
+    """OnlineAnalysis does not estimate free energies before min_iterations."""
+    online_analysis = OnlineAnalysis(2, min_iterations=5)
+    online_analysis.append(np.array([0, 1]), np.zeros([2, 2]))
+    assert online_analysis.estimate() is None
+
+
+def test_neighbor_bar():
+    """Neighbor BAR recovers the free energy of harmonic oscillators and can be updated incrementally."""
+    nstates, niterations = 4, 2000
+    spring_constants = np.array([1.0, 1.5, 2.2, 3.0])
+    random_state = np.random.RandomState(0)
+    replica_states = np.array([random_state.permutation(nstates) for _ in range(niterations)])
+    x = random_state.normal(size=(niterations, nstates)) / np.sqrt(spring_constants[replica_states])
+    u_nkl = 0.5 * spring_constants * x[:, :, np.newaxis]**2
+
+    neighbor_bar = NeighborBAR(nstates)
+    for iteration in range(10):
+        neighbor_bar.append(replica_states[iteration], u_nkl[iteration])
+    neighbor_bar.estimate()
+    neighbor_bar.extend(replica_states[10:], u_nkl[10:])
+    estimate = neighbor_bar.estimate()
+
+    # Each pair is the BAR estimate of its work values.
+    u_kln, _ = deconvolute_reference(replica_states, u_nkl)
+    for k in range(nstates - 1):
+        w_F = u_kln[k, k+1] - u_kln[k, k]
+        w_R = u_kln[k+1, k] - u_kln[k+1, k+1]
+        assert np.isclose(estimate['DeltaF_k'][k], BAR(w_F, w_R)[0])
+
+    DeltaF = 0.5 * np.log(spring_constants[-1] / spring_constants[0])
+    assert abs(estimate['DeltaF'] - DeltaF) < 4 * estimate['dDeltaF']
+
+
+def test_online_analysis_results_file():
+    """The estimates published by the asynchronous online analysis can be read back."""
+    nstates = 3
+    analysis = {'equilibration_end': 2, 'g': 1.5, 'Neff_max': 10.0,
+                'Delta_f_ij': np.arange(nstates**2, dtype=np.float64).reshape(nstates, nstates),
+                'dDelta_f_ij': np.ones([nstates, nstates])}
+    with enter_temp_directory():
+        store_filename = 'complex.nc'
+        assert read_online_analysis(store_filename) is None
+        write_online_analysis(get_online_analysis_path(store_filename), analysis, niterations=20)
+        results = read_online_analysis(store_filename)
+    assert results['iteration'] == 20
+    assert results['DeltaF'] == analysis['Delta_f_ij'][0, -1]
+    assert np.allclose(results['dDelta_f_ij'], analysis['dDelta_f_ij'])
+    assert results['neighbor_bar'] is None
+
+
+def test_online_analysis_worker_loop():
+    """The analysis process publishes the MBAR and neighbor BAR estimates of all the submitted iterations."""
+    from yank import analyze
+    replica_states, u_nkl = random_phase_data(niterations=60)
+    energies_queue = queue.Queue()
+    for chunk_start in range(0, 60, 25):
+        energies_queue.put((replica_states[chunk_start:chunk_start+25], u_nkl[chunk_start:chunk_start+25]))
+    energies_queue.put(None)
+
+    with enter_temp_directory():
+        store_filename = 'complex.nc'
+        analyze._run_online_analysis_worker(energies_queue, store_filename, nstates=3,
+                                            min_iterations=20, interval=10)
+        results = read_online_analysis(store_filename)
+
+    online_analysis = OnlineAnalysis(nstates=3, min_iterations=20)
+    online_analysis.extend(replica_states, u_nkl)
+    assert results['iteration'] == 60
+    assert np.isclose(results['DeltaF'], online_analysis.estimate()['Delta_f_ij'][0, -1])
+
+    # The initial frame is skipped as when reading the store file.
+    neighbor_bar = NeighborBAR(nstates=3)
+    neighbor_bar.extend(replica_states[1:], u_nkl[1:])
+    estimate = neighbor_bar.estimate()
+    assert np.isclose(results['neighbor_bar']['DeltaF'], estimate['DeltaF'])
+    assert np.isclose(results['neighbor_bar']['dDeltaF'], estimate['dDeltaF'])
+
+
+def test_trajectory_writer():
+    """TrajectoryWriter streams chunks of frames to the same file mdtraj would write."""
+    topology = mdtraj.Topology()
+    residue = topology.add_residue('LIG', topology.add_chain())
+    for _ in range(5):
+        topology.add_atom('C', mdtraj.element.carbon, residue)
+    random_state = np.random.RandomState(0)
+    trajectory = mdtraj.Trajectory(random_state.rand(10, 5, 3).astype(np.float32), topology)
+    trajectory.unitcell_vectors = np.tile(2.0 * np.eye(3, dtype=np.float32), (10, 1, 1))
+
+    with enter_temp_directory():
+        for extension in ['dcd', 'xtc', 'nc', 'pdb']:
+            output_path = 'trajectory.' + extension
+            with TrajectoryWriter(output_path) as writer:
+                writer.write(trajectory[:4])
+                writer.write(trajectory[4:])
+            written_trajectory = mdtraj.load(output_path, top=topology)
+            assert written_trajectory.n_frames == 10
+            assert np.allclose(written_trajectory.xyz, trajectory.xyz, atol=1e-3)
+            assert np.allclose(written_trajectory.unitcell_lengths, 2.0, atol=1e-3)
+
+
+def test_extract_trajectory():
+    """Trajectories extracted a few frames at a time match the positions in the store file."""
+    from yank import analyze
+    with enter_temp_directory():
+        topology, replica_states, positions, box_vectors = create_trajectory_store_file('complex.nc')
+        solute_indices = topology.select('resname LIG')
+        frames = np.arange(1, len(replica_states))  # The first frame is never extracted.
+        state_replicas = np.argsort(replica_states, axis=1)[frames, 2]
+
+        # Read two frames of the solute or a single frame of the whole system at a time.
+        chunk_bytes = analyze.TRAJECTORY_CHUNK_BYTES
+        analyze.TRAJECTORY_CHUNK_BYTES = 2 * (len(solute_indices) + 3) * 3 * 4
+        try:
+            extract_trajectory('replica.dcd', 'complex.nc', replica_index=1, start_frame=2, skip_frame=3)
+            extract_trajectory('state.dcd', 'complex.nc', state_index=2)
+            extract_trajectory('solute.dcd', 'complex.nc', state_index=2, keep_solvent=False)
+            extract_trajectory('imaged.dcd', 'complex.nc', state_index=2, image_molecules=True)
+        finally:
+            analyze.TRAJECTORY_CHUNK_BYTES = chunk_bytes
+
+        trajectory = mdtraj.load('replica.dcd', top=topology)
+        assert np.allclose(trajectory.xyz, positions[[2, 5, 8, 11], 1], atol=1e-3)
+        assert np.allclose(trajectory.unitcell_vectors, box_vectors[[2, 5, 8, 11], 1], atol=1e-3)
+
+        # Frames of a state are read from the replica in that state at each iteration.
+        trajectory = mdtraj.load('state.dcd', top=topology)
+        assert np.allclose(trajectory.xyz, positions[frames, state_replicas], atol=1e-3)
+        assert np.allclose(trajectory.unitcell_vectors, box_vectors[frames, state_replicas], atol=1e-3)
+
+        trajectory = mdtraj.load('solute.dcd', top=topology.subset(solute_indices))
+        assert np.allclose(trajectory.xyz, positions[frames, state_replicas][:, solute_indices], atol=1e-3)
+
+        # Imaging each chunk is equivalent to imaging the whole trajectory.
+        reference_trajectory = mdtraj.Trajectory(positions[frames, state_replicas], topology)
+        reference_trajectory.unitcell_vectors = box_vectors[frames, state_replicas]
+        reference_trajectory.image_molecules(inplace=True)
+        assert not np.allclose(reference_trajectory.xyz, positions[frames, state_replicas], atol=1e-3)
+        trajectory = mdtraj.load('imaged.dcd', top=topology)
+        assert np.allclose(trajectory.xyz, reference_trajectory.xyz, atol=1e-3)
+
+
+def test_extract_state_trajectories():
+    """The trajectories of all states extracted in a single pass match the extraction of each state."""
+    from yank import analyze
+    with enter_temp_directory():
+        topology, replica_states, positions, box_vectors = create_trajectory_store_file('complex.nc')
+        solute_topology = topology.subset(topology.select('resname LIG'))
+        nstates = replica_states.shape[1]
+        frames = np.arange(1, len(replica_states))  # The first frame is never extracted.
+        state_replicas = np.argsort(replica_states, axis=1)[frames]
+
+        # Read two frames of all the replicas at a time.
+        chunk_bytes = analyze.TRAJECTORY_CHUNK_BYTES
+        analyze.TRAJECTORY_CHUNK_BYTES = 2 * nstates * (topology.n_atoms + 3) * 3 * 4
+        try:
+            output_paths = extract_state_trajectories('all.dcd', 'complex.nc', n_threads=2)
+            solute_output_paths = extract_state_trajectories('solute.dcd', 'complex.nc', keep_solvent=False,
+                                                             image_molecules=True)
+            for state_index in range(nstates):
+                extract_trajectory('state{}.dcd'.format(state_index), 'complex.nc', state_index=state_index)
+                extract_trajectory('solute{}.dcd'.format(state_index), 'complex.nc', state_index=state_index,
+                                   keep_solvent=False, image_molecules=True)
+        finally:
+            analyze.TRAJECTORY_CHUNK_BYTES = chunk_bytes
+
+        assert output_paths == ['all-state{}.dcd'.format(state_index) for state_index in range(nstates)]
+        for state_index in range(nstates):
+            trajectory = mdtraj.load(output_paths[state_index], top=topology)
+            reference_trajectory = mdtraj.load('state{}.dcd'.format(state_index), top=topology)
+            assert np.allclose(trajectory.xyz, reference_trajectory.xyz)
+            assert np.allclose(trajectory.unitcell_vectors, reference_trajectory.unitcell_vectors)
+            state_positions = positions[frames, state_replicas[:, state_index]]
+            assert np.allclose(trajectory.xyz, state_positions, atol=1e-3)
+
+            trajectory = mdtraj.load(solute_output_paths[state_index], top=solute_topology)
+            reference_trajectory = mdtraj.load('solute{}.dcd'.format(state_index), top=solute_topology)
+            assert np.allclose(trajectory.xyz, reference_trajectory.xyz)
+
+
+def test_analysis_cache():
+    """The cached and incrementally updated analysis match an analysis from scratch."""
+    replica_states, u_nkl = random_phase_data(niterations=60)
+    with enter_temp_directory():
+        store_filename = 'complex.nc'
+        create_phase_store_file(store_filename, replica_states[:40], u_nkl[:40])
+        entry = analyze_phase(store_filename)
+        assert os.path.isfile(get_analysis_cache_path(store_filename))
+        assert analyze_phase(store_filename)['DeltaF'] == entry['DeltaF']
+
+        # New iterations update the cache incrementally.
+        create_phase_store_file(store_filename, replica_states, u_nkl, mode='a')
+        entry = analyze_phase(store_filename)
+        reference_entry = analyze_phase(store_filename, use_cache=False)
+
+    for key in ['DeltaF', 'dDeltaF', 'DeltaH', 'dDeltaH']:
+        assert np.isclose(entry[key], reference_entry[key], atol=1e-5)
+
+
+def test_bootstrap():
+    """Bootstrap replicates are reproducible and consistent with the MBAR uncertainty."""
+    replica_states, u_nkl = random_phase_data(niterations=200)
+    u_kln, _ = deconvolute_reference(replica_states, u_nkl)
+    bootstrap = bootstrap_free_energy(u_kln, nbootstraps=40, seed=1, n_processes=1)
+    assert len(bootstrap['DeltaF_samples']) == 40
+    assert np.allclose(bootstrap_free_energy(u_kln, nbootstraps=40, seed=1, n_processes=2)['DeltaF_samples'],
+                       bootstrap['DeltaF_samples'])
+    lower, upper = bootstrap['confidence_interval']
+    assert lower < np.median(bootstrap['DeltaF_samples']) < upper
+
+    # Unsampled states (e.g. expanded cutoff states) are supported.
+    nstates = u_kln.shape[0]
+    u_kln_expanded = np.zeros([nstates + 1, nstates + 1, u_kln.shape[2]])
+    u_kln_expanded[:nstates, :nstates] = u_kln
+    u_kln_expanded[:nstates, -1] = u_kln[:, -1] + 0.5
+    N_k = np.array([u_kln.shape[2]] * nstates + [0])
+    bootstrap = bootstrap_free_energy(u_kln_expanded, N_k=N_k, nbootstraps=10, n_processes=1)
+    assert np.allclose(bootstrap['DeltaF_samples'] - 0.5, bootstrap_free_energy(u_kln, nbootstraps=10,
+                                                                                    n_processes=1)['DeltaF_samples'])
+
+    with enter_temp_directory():
+        create_phase_store_file('complex.nc', replica_states, u_nkl)
+        entry = analyze_phase('complex.nc', nbootstraps=40, block_size=5, n_processes=1)
+    assert np.isclose(entry['dDeltaF_bootstrap'], entry['dDeltaF'], rtol=0.5)
+
+
+def test_convergence():
+    """Forward and reverse estimates on the full data match MBAR and do not depend on the parallelization."""
+    replica_states, u_nkl = random_phase_data(niterations=200)
+    with enter_temp_directory():
+        create_phase_store_file('complex.nc', replica_states, u_nkl)
+        entry = analyze_phase('complex.nc')
+        convergence = analyze_convergence('complex.nc', table_path='convergence.csv', npoints=5, n_processes=1)
+        with open('convergence.csv', 'r') as f:
+            assert len(f.readlines()) == 6
+    assert np.allclose(convergence['fractions'], [0.2, 0.4, 0.6, 0.8, 1.0], atol=0.01)
+    assert np.isclose(convergence['DeltaF_forward'][-1], entry['DeltaF'])
+    assert np.isclose(convergence['DeltaF_reverse'][-1], entry['DeltaF'])
+
+    u_kln, _ = deconvolute_reference(replica_states[1:], u_nkl[1:])
+    serial = compute_convergence(u_kln, npoints=4, n_processes=1)
+    parallel = compute_convergence(u_kln, npoints=4, n_processes=4)
+    assert np.allclose(serial['DeltaF_forward'], parallel['DeltaF_forward'], atol=1e-6)
+    assert np.allclose(serial['dDeltaF_reverse'], parallel['dDeltaF_reverse'], atol=1e-6)
+
+
+def test_export_energies():
+    """Exported arrays match the store file and are memory-mapped on load."""
+    with enter_temp_directory():
+        replica_states, u_nkl = random_phase_data(niterations=50)
+        create_phase_store_file('simulation.nc', replica_states, u_nkl)
+        ncfile = netcdf.Dataset('simulation.nc', 'a')
+        ncfile.createVariable('fully_interacting_expanded_cutoff_energies', 'f8', ('iteration', 'replica'))[:] = \
+            u_nkl[:, :, 0] - 1.0
+        ncfile.close()
+        utils.write_store_index('simulation.nc', 40)
+
+        manifest = export_energies('simulation.nc', chunk_size=7)
+        assert manifest['niterations'] == 40
+        assert manifest['arrays']['u_kln']['dimensions'] == ['sampled_state', 'evaluated_state', 'iteration']
+        assert manifest['arrays']['energies']['dimensions'] == ['iteration', 'replica', 'evaluated_state']
+        arrays = load_exported_energies(get_energies_export_directory('simulation.nc'))
+        assert isinstance(arrays['u_kln'], np.memmap)
+        assert np.all(arrays['states'] == replica_states[:40])
+        assert np.allclose(arrays['energies'], u_nkl[:40])
+        ncfile = netcdf.Dataset('simulation.nc', 'r')
+        try:
+            assert np.allclose(arrays['u_kln'], deconvolute_energies(ncfile))
+            assert np.allclose(arrays['fully_interacting_expanded_cutoff_u_kn'],
+                               deconvolute_energies(ncfile, variable_name='fully_interacting_expanded_cutoff_energies'))
+        finally:
+            ncfile.close()
+        assert 'noninteracting_expanded_cutoff_u_kn' not in arrays
+
+        # The export is updated only when new iterations are committed.
+        assert export_energies('simulation.nc')['timestamp'] == manifest['timestamp']
+        utils.write_store_index('simulation.nc', 50)
+        assert export_energies('simulation.nc')['niterations'] == 50
+
+
+
+def test_timings_summary():
+    """The timings summary breaks down the iteration time of the timed and committed iterations."""
+    with enter_temp_directory():
+        replica_states, u_nkl = random_phase_data(niterations=11)
+        create_phase_store_file('simulation.nc', replica_states, u_nkl)
+        ncfile = netcdf.Dataset('simulation.nc', 'a')
+        ncgrp = ncfile.createGroup('timings')
+        ncgrp.createDimension('rank', 2)
+        timings = dict(mixing=0.5, propagation=6.0, energies=2.0, io=1.0, synchronization=0.25, barrier_wait=1.0,
+                       sync=0.75)
+        for name, elapsed_time in timings.items():
+            ncgrp.createVariable(name, 'f', ('iteration',))[1:] = elapsed_time
+        ncgrp.createVariable('iteration', 'f', ('iteration',))[1:] = 10.0
+        ncgrp.createVariable('propagate', 'f', ('iteration', 'replica'))[1:] = np.tile([1.0, 2.0, 1.5], (10, 1))
+        ncgrp.createVariable('rank_propagation', 'f', ('iteration', 'rank'))[1:] = np.tile([5.0, 3.0], (10, 1))
+        ncgrp.createVariable('rank_barrier_wait', 'f', ('iteration', 'rank'))[1:] = np.tile([1.0, 3.0], (10, 1))
+        ncfile.close()
+        utils.write_store_index('simulation.nc', 9)
+
+        # The initial frame is not timed.
+        summary = compute_timings_summary('simulation.nc')
+        assert summary['niterations'] == 8
+        assert np.isclose(summary['total_time'], 80.0)
+        assert list(summary['steps']) == ['mixing', 'propagation', 'energies', 'io', 'other']
+        assert np.isclose(summary['steps']['propagation']['fraction'], 0.6)
+        assert np.isclose(summary['steps']['other']['mean'], 0.5)
+        assert np.isclose(summary['details']['propagate']['mean'], 4.5)
+        assert np.isclose(summary['details']['barrier_wait']['total'], 8.0)
+        assert np.isclose(summary['details']['sync']['mean'], 0.75)
+        assert 'mc_moves' not in summary['details']
+        assert np.allclose(summary['replica_propagate'], [1.0, 2.0, 1.5])
+        assert np.allclose(summary['rank_barrier_wait'], [1.0, 3.0])
+        assert print_timings('simulation.nc')['niterations'] == 8
+        assert compute_timings_summary('simulation.nc', first_iteration=5)['niterations'] == 4
+
+def test_analyze_batch():
+    """Batch analysis writes the free energy of every experiment in the output tree."""
+    with enter_temp_directory():
+        expected_rows = {}
+        for seed, experiment in enumerate(['experiments/ligand0', 'experiments/ligand1']):
+            os.makedirs(experiment)
+            with open(os.path.join(experiment, 'analysis.yaml'), 'w') as f:
+                f.write("- [complex, 1]\n- [solvent, -1]\n")
+            for phase in ['complex', 'solvent']:
+                store_filename = os.path.join(experiment, phase + '.nc')
+                create_phase_store_file(store_filename, *random_phase_data(niterations=30, seed=seed))
+            expected_rows[experiment] = analyze(experiment, use_cache=False)
+
+        rows = analyze_batch('.', 'results.csv', n_processes=2)
+        assert [row['experiment'] for row in rows] == sorted(expected_rows)
+        with open('results.csv', 'r') as f:
+            assert len(f.readlines()) == 3
+    for row in rows:
+        assert np.isclose(row['DeltaF'], expected_rows[row['experiment']]['DeltaF'])
+        assert np.isclose(row['dDeltaH'], expected_rows[row['experiment']]['dDeltaH'])
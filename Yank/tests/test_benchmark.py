@@ -0,0 +1,42 @@
+#!/usr/local/bin/env python
+
+"""
+Test benchmark.py facility.
+
+"""
+
+# ==============================================================================
+# GLOBAL IMPORTS
+# ==============================================================================
+
+import copy
+
+from yank.benchmark import *
+
+
+# ==============================================================================
+# TESTS
+# ==============================================================================
+
+def test_compare_to_baseline():
+    """Only the changes of metrics in the wrong direction above the tolerance are regressions."""
+    benchmark = dict(system='small', platform='CUDA', precision='mixed', propagation_ns_per_day=100.0,
+                     ns_per_day=80.0, iteration_time=1.0, energies_time=0.1, mixing_time=0.01,
+                     io_time=0.05, overhead_fraction=0.2)
+    baseline = dict(benchmarks=[benchmark])
+    report = copy.deepcopy(baseline)
+    assert compare_to_baseline(report, baseline) == []
+
+    # Faster runs and changes within the tolerance are not regressions.
+    report['benchmarks'][0].update(propagation_ns_per_day=150.0, ns_per_day=75.0, energies_time=0.05)
+    assert compare_to_baseline(report, baseline) == []
+
+    report['benchmarks'][0].update(ns_per_day=60.0, io_time=0.1)
+    regressions = compare_to_baseline(report, baseline)
+    assert [regression['metric'] for regression in regressions] == ['ns_per_day', 'io_time']
+    assert regressions[0]['relative_change'] == -0.25
+    assert len(compare_to_baseline(report, baseline, tolerance=1.5)) == 0
+
+    # Benchmarks that are not in the baseline are not compared.
+    report['benchmarks'][0]['platform'] = 'OpenCL'
+    assert compare_to_baseline(report, baseline) == []
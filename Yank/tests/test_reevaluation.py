@@ -0,0 +1,69 @@
+#!/usr/local/bin/env python
+
+"""
+Test reevaluation.py facility.
+
+"""
+
+# ==============================================================================
+# GLOBAL IMPORTS
+# ==============================================================================
+
+import numpy as np
+import netCDF4 as netcdf
+from openmmtools import testsystems
+from mdtraj.utils import enter_temp_directory
+
+from yank.sampling import *
+from yank.analyze import analyze_phase
+from yank.reevaluation import *
+
+
+# ==============================================================================
+# TESTS
+# ==============================================================================
+
+def test_reevaluate_energies():
+    """Energies re-evaluated in the simulated states match the stored ones."""
+    toluene_test = testsystems.TolueneImplicit()
+    ligand_atoms = range(15)
+    alchemical_factory = AbsoluteAlchemicalFactory(toluene_test.system,
+                                                   ligand_atoms=ligand_atoms)
+
+    base_state = ThermodynamicState(temperature=300.0*unit.kelvin)
+    base_state.system = alchemical_factory.alchemically_modified_system
+
+    alchemical_states = [AlchemicalState(lambda_electrostatics=1.0, lambda_sterics=1.0),
+                         AlchemicalState(lambda_electrostatics=0.0, lambda_sterics=1.0),
+                         AlchemicalState(lambda_electrostatics=0.0, lambda_sterics=0.0)]
+
+    with enter_temp_directory():
+        store_file_name = 'simulation.nc'
+        simulation = ModifiedHamiltonianExchange(store_file_name)
+        simulation.create(base_state, alchemical_states, toluene_test.positions,
+                          options={'number_of_iterations': 5, 'minimize': False})
+        simulation.run()
+        del simulation
+
+        # Re-evaluate the end states and an intermediate state.
+        new_states = [dict(lambda_electrostatics=1.0, lambda_sterics=1.0),
+                      dict(lambda_electrostatics=0.0, lambda_sterics=0.5),
+                      dict(lambda_electrostatics=0.0, lambda_sterics=0.0)]
+        iterations = np.arange(1, 5)
+        reevaluated_energies = reevaluate_energies(store_file_name, new_states, iterations=iterations,
+                                                   n_processes=1)
+
+        # The store file is closed after the re-evaluation and can be resumed.
+        netcdf.Dataset(store_file_name, 'a').close()
+        ncfile = netcdf.Dataset(store_file_name, 'r')
+        try:
+            stored_energies = ncfile.variables['energies'][1:5, :, :]
+        finally:
+            ncfile.close()
+        assert np.allclose(reevaluated_energies['energies'][:, :, [0, 2]], stored_energies[:, :, [0, 2]],
+                           rtol=1e-4, atol=1e-3)
+
+        # The analysis reports the free energies of the new states.
+        entry = analyze_phase(store_file_name)
+        assert len(entry['DeltaF_reevaluated']) == 3
+        assert np.isclose(entry['DeltaF_reevaluated'][0], 0.0, atol=1e-6)
@@ -14,6 +14,7 @@ TODO
 # =============================================================================================
 
 import sys
+import copy
 
 import math
 
@@ -25,6 +26,8 @@ import simtk.unit as units
 
 from nose import tools
 
+import netCDF4 as netcdf
+from mdtraj.utils import enter_temp_directory
 from openmmtools import testsystems
 
 from yank import utils
@@ -411,6 +414,95 @@ def test_unknown_parameters():
     """Test ReplicaExchange raises exception on wrong initialization."""
     ReplicaExchange(store_filename='test', wrong_parameter=False)
 
+
+def test_deduplicated_systems():
+    """Test that identical Systems are stored once and shared on resume."""
+    testsystem = testsystems.HarmonicOscillator()
+    system, positions = testsystem.system, testsystem.positions
+    other_testsystem = testsystems.HarmonicOscillator(K=50.0*units.kilocalories_per_mole/units.angstroms**2)
+
+    # Same object, identical copy, and a different System.
+    systems = [system, system, copy.deepcopy(system), other_testsystem.system]
+    states = [ThermodynamicState(system=s, temperature=300.0*units.kelvin) for s in systems]
+
+    with enter_temp_directory():
+        store_filename = 'simulation.nc'
+        simulation = ReplicaExchange(store_filename)
+        simulation.create(states, positions)
+        del simulation
+
+        # Only two unique Systems should be stored.
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        ncgrp_stateinfo = ncfile.groups['thermodynamic_states']
+        assert ncgrp_stateinfo.variables['systems'].shape == (2,)
+        assert list(ncgrp_stateinfo.variables['system_indices'][:]) == [0, 0, 0, 1]
+        ncfile.close()
+
+        # Restored states with identical Systems share the same object.
+        simulation = ReplicaExchange(store_filename)
+        simulation.resume()
+        restored_systems = [state.system for state in simulation.states]
+        assert restored_systems[0] is restored_systems[1] is restored_systems[2]
+        assert restored_systems[0] is not restored_systems[3]
+
+
+def test_convergence_early_termination():
+    """Test that a simulation stops when the online analysis meets the convergence criteria."""
+    testsystem = testsystems.HarmonicOscillator()
+    system, positions = testsystem.system, testsystem.positions
+    temperatures = [300.0, 310.0, 320.0] * units.kelvin
+    states = [ThermodynamicState(system=system, temperature=temperature) for temperature in temperatures]
+
+    with enter_temp_directory():
+        store_filename = 'simulation.nc'
+        simulation = ReplicaExchange(store_filename)
+        simulation.number_of_iterations = 50
+        simulation.nsteps_per_iteration = 10
+        simulation.online_analysis = True
+        simulation.online_analysis_min_iterations = 5
+        simulation.online_analysis_interval = 1
+        simulation.online_analysis_min_effective_samples = 1
+        simulation.create(states, positions)
+        simulation.run()
+        converged_iteration = simulation.iteration
+        assert converged_iteration < 50
+        assert simulation.converged_iteration == converged_iteration
+        del simulation
+
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        assert ncfile.converged_iteration == converged_iteration
+        ncfile.close()
+
+        # Resuming a converged simulation does not run any further.
+        simulation = ReplicaExchange(store_filename)
+        simulation.resume()
+        simulation.run()
+        assert simulation.iteration == converged_iteration
+
+
+def test_convergence_relative_change_near_zero():
+    """Test that the relative change criterion can be met by free energies close to zero."""
+    estimates = [dict(iteration=10 * (i + 1), DeltaF=DeltaF, dDeltaF=0.05, Neff_max=100.0)
+                 for i, DeltaF in enumerate([0.02, -0.01, 0.01, 0.3])]
+
+    with enter_temp_directory():
+        simulation = ReplicaExchange('simulation.nc')
+        simulation.online_analysis = True
+        simulation.online_analysis_max_relative_change = 0.01
+        simulation.online_analysis_convergence_window = 3
+        simulation.ncfile = netcdf.Dataset('simulation.nc', 'w')
+        converged = []
+        for estimate in estimates:
+            simulation._get_online_estimate = lambda estimate=estimate: estimate
+            simulation.iteration = estimate['iteration']
+            converged.append(simulation._check_convergence())
+        simulation.ncfile.close()
+        simulation.ncfile = None
+
+    # Changes within the uncertainty are accepted, larger changes are not.
+    assert converged == [False, False, True, False]
+
+
 # =============================================================================================
 # MAIN AND TESTS
 # =============================================================================================
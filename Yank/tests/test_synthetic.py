@@ -0,0 +1,313 @@
+#!/usr/local/bin/env python
+
+"""
+Test synthetic.py facility.
+
+"""
+
+# ==============================================================================
+# GLOBAL IMPORTS
+# ==============================================================================
+
+import os
+import json
+import logging
+
+import netCDF4 as netcdf
+from pymbar import timeseries
+from mdtraj.utils import enter_temp_directory
+
+from yank import analyze, utils
+from yank.synthetic import *
+from yank.sampling import ModifiedHamiltonianExchange
+
+
+# ==============================================================================
+# TESTS
+# ==============================================================================
+
+def test_synthetic_free_energies():
+    """The free energies of a synthetic simulation agree with the analytical ones."""
+    np.random.seed(0)
+    natoms, nstates = 10, 4
+    base_state, alchemical_states, positions = create_synthetic_testsystem(natoms, nstates)
+    mm = SyntheticOpenMM(seed=0)
+    options = {'number_of_iterations': 201, 'minimize': False, 'number_of_equilibration_iterations': 0,
+               'show_energies': False, 'show_mixing_statistics': False,
+               'online_analysis': True, 'online_analysis_async': True}
+
+    with enter_temp_directory():
+        store_filename = 'simulation.nc'
+        simulation = ModifiedHamiltonianExchange(store_filename, mm=mm)
+        simulation.create(base_state, alchemical_states, positions, options=options)
+        simulation.run()
+        del simulation
+
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        Deltaf_ij, dDeltaf_ij = analyze.estimate_free_energies(ncfile)
+        ncfile.close()
+        neighbor_bar_estimate = analyze.read_online_analysis(store_filename)['neighbor_bar']
+
+    f_k = mm.compute_reduced_free_energies(alchemical_states, natoms)
+    error = abs(Deltaf_ij[0, -1] - f_k[-1])
+    assert error < 5.0 * dDeltaf_ij[0, -1], (Deltaf_ij[0, -1], f_k[-1], dDeltaf_ij[0, -1])
+
+    # The neighbor BAR estimate published by the asynchronous online analysis agrees too.
+    error = abs(neighbor_bar_estimate['DeltaF'] - f_k[-1])
+    assert error < 5.0 * neighbor_bar_estimate['dDeltaF'], (neighbor_bar_estimate, f_k[-1])
+
+
+def test_synthetic_equilibration():
+    """Equilibration detection on the u_n timeseries of a simulation agrees with pymbar."""
+    np.random.seed(0)
+    base_state, alchemical_states, positions = create_synthetic_testsystem(natoms=10, nstates=4)
+    # Start far from equilibrium, and propagate for a fraction of the
+    # relaxation time at each iteration to obtain correlated samples.
+    positions *= 10.0
+    options = {'number_of_iterations': 300, 'minimize': False, 'number_of_equilibration_iterations': 0,
+               'nsteps_per_iteration': 20, 'show_energies': False, 'show_mixing_statistics': False}
+
+    with enter_temp_directory():
+        store_filename = 'simulation.nc'
+        simulation = ModifiedHamiltonianExchange(store_filename, mm=SyntheticOpenMM(seed=0))
+        simulation.create(base_state, alchemical_states, positions, options=options)
+        simulation.run()
+        del simulation
+
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        u_n = analyze.extract_u_n(ncfile)[1:]
+        ncfile.close()
+
+    t0, g, Neff_max = timeseries.detectEquilibration(u_n, fast=False)
+    assert t0 > 0 and g > 2.0, (t0, g)
+    assert analyze.detect_equilibration(u_n, grid_size=len(u_n))[0] == t0
+    assert np.isclose(analyze.detect_equilibration(u_n)[2], Neff_max, rtol=0.05)
+    assert np.isclose(analyze.statistical_inefficiency(u_n[t0:]),
+                      timeseries.statisticalInefficiency(u_n[t0:], fast=False))
+
+
+def test_synthetic_online_analysis_async():
+    """The asynchronous online analysis publishes its estimates for yank status."""
+    np.random.seed(0)
+    base_state, alchemical_states, positions = create_synthetic_testsystem(natoms=5, nstates=4)
+    options = {'number_of_iterations': 50, 'minimize': False, 'number_of_equilibration_iterations': 0,
+               'show_energies': False, 'show_mixing_statistics': False, 'online_analysis': True,
+               'online_analysis_async': True, 'online_analysis_min_iterations': 20, 'online_analysis_interval': 10}
+
+    with enter_temp_directory():
+        store_filename = 'complex.nc'
+        simulation = ModifiedHamiltonianExchange(store_filename, mm=SyntheticOpenMM(seed=0))
+        simulation.create(base_state, alchemical_states, positions, options=options)
+        simulation.run()
+        del simulation
+
+        # The analysis process publishes the estimate of all the iterations when the run ends.
+        online_analysis = analyze.read_online_analysis(store_filename)
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        analysis = analyze.OnlineAnalysis.from_ncfile(ncfile, min_iterations=20).estimate()
+        ncfile.close()
+        assert online_analysis['iteration'] == 50
+        assert np.isclose(online_analysis['DeltaF'], analysis['Delta_f_ij'][0, -1])
+        assert online_analysis['neighbor_bar'] is not None
+
+        # The progress reports of a resumed run include the published estimates.
+        simulation = ModifiedHamiltonianExchange(store_filename, mm=SyntheticOpenMM(seed=0))
+        simulation.resume(options={'number_of_iterations': 52})
+        simulation.run()
+        del simulation
+        progress = analyze.read_progress(store_filename)
+        assert analyze.read_online_analysis(store_filename)['iteration'] == 52
+
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        analyze_logger = logging.getLogger('yank.analyze')
+        analyze_logger.addHandler(handler)
+        analyze_logger.setLevel(logging.INFO)
+        try:
+            assert analyze.print_status('.')
+        finally:
+            analyze_logger.removeHandler(handler)
+
+    assert progress['online_estimate']['iteration'] >= 50
+    assert progress['neighbor_bar_estimate']['iteration'] == progress['online_estimate']['iteration']
+    assert any('online estimate at iteration' in message for message in messages)
+    assert any('neighbor BAR estimate at iteration' in message for message in messages)
+
+
+def test_synthetic_online_analysis_worker_restart():
+    """An online analysis process that keeps dying is restarted only once."""
+    np.random.seed(0)
+    base_state, alchemical_states, positions = create_synthetic_testsystem(natoms=5, nstates=4)
+    workers = []
+
+    class DeadWorker(object):
+        def __init__(self, *args, **kwargs):
+            self.niterations = 0
+            self.is_alive = False
+            self.exitcode = 1
+            workers.append(self)
+
+        def submit(self, replica_states, u_kl):
+            self.niterations += len(replica_states)
+
+        def stop(self, timeout=None):
+            pass
+
+    worker_class = analyze.OnlineAnalysisWorker
+    analyze.OnlineAnalysisWorker = DeadWorker
+    try:
+        with enter_temp_directory():
+            simulation = ModifiedHamiltonianExchange('simulation.nc', mm=SyntheticOpenMM(seed=0))
+            simulation.create(base_state, alchemical_states, positions,
+                              options={'number_of_iterations': 5, 'online_analysis': True,
+                                       'online_analysis_async': True})
+            simulation.run()
+            del simulation
+    finally:
+        analyze.OnlineAnalysisWorker = worker_class
+    assert len(workers) == 2
+
+
+def test_synthetic_communicator():
+    """A simulation runs and resumes with a mocked MPI communicator."""
+    np.random.seed(0)
+    base_state, alchemical_states, positions = create_synthetic_testsystem(natoms=5, nstates=5)
+    mpicomm = SyntheticCommunicator(size=2)
+    assert mpicomm.allgather([1, 2]) == [[1, 2], [1, 2]]
+    assert mpicomm.gather(1, root=1) is None
+    assert mpicomm.reduce(3) == 6
+
+    with enter_temp_directory():
+        store_filename = 'simulation.nc'
+        simulation = ModifiedHamiltonianExchange(store_filename, mm=SyntheticOpenMM(seed=0), mpicomm=mpicomm)
+        simulation.create(base_state, alchemical_states, positions, options={'number_of_iterations': 3})
+        simulation.run()
+        del simulation
+
+        simulation = ModifiedHamiltonianExchange(store_filename, mm=SyntheticOpenMM(seed=0), mpicomm=mpicomm)
+        simulation.resume(options={'number_of_iterations': 5})
+        simulation.run()
+        assert simulation.iteration == 5
+        del simulation
+
+        # The sync of each iteration is timed and counted as io.
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        ncvars_timings = ncfile.groups['timings'].variables
+        io_times, sync_times = ncvars_timings['io'][1:], ncvars_timings['sync'][1:]
+        ncfile.close()
+    assert not np.ma.is_masked(sync_times)
+    assert np.all(sync_times <= io_times)
+
+
+def test_synthetic_communicator_read_error():
+    """All ranks raise when the root node cannot read the store file."""
+    # The root node records the broadcast objects, and the other rank receives them.
+    broadcast_objects = []
+
+    class RootCommunicator(SyntheticCommunicator):
+        def bcast(self, obj, root=0):
+            broadcast_objects.append(obj)
+            return super(RootCommunicator, self).bcast(obj, root=root)
+
+    class OtherCommunicator(SyntheticCommunicator):
+        def bcast(self, obj, root=0):
+            return broadcast_objects.pop(0)
+
+    with enter_temp_directory():
+        # A store file without any of the data needed to resume.
+        store_filename = 'simulation.nc'
+        ncfile = netcdf.Dataset(store_filename, 'w')
+        ncfile.createDimension('iteration', 0)
+        ncfile.close()
+
+        for mpicomm in [RootCommunicator(size=2, rank=0), OtherCommunicator(size=2, rank=1)]:
+            simulation = ModifiedHamiltonianExchange(store_filename, mm=SyntheticOpenMM(seed=0), mpicomm=mpicomm)
+            try:
+                simulation.resume()
+            except Exception as e:
+                if mpicomm.rank == 1:
+                    assert 'Node 0 could not read the store file' in str(e), str(e)
+            else:
+                raise AssertionError('Rank {} did not raise'.format(mpicomm.rank))
+        assert len(broadcast_objects) == 0
+
+
+def test_synthetic_timeline_trace():
+    """The timeline trace records the steps of each rank of a run."""
+    np.random.seed(0)
+    base_state, alchemical_states, positions = create_synthetic_testsystem(natoms=5, nstates=4)
+    mpicomm = SyntheticCommunicator(size=2)
+
+    with enter_temp_directory():
+        store_filename = 'simulation.nc'
+        simulation = ModifiedHamiltonianExchange(store_filename, mm=SyntheticOpenMM(seed=0), mpicomm=mpicomm)
+        simulation.create(base_state, alchemical_states, positions,
+                          options={'number_of_iterations': 2, 'timeline_trace': True})
+        simulation.run()
+        assert simulation.mpicomm is mpicomm
+        del simulation
+
+        # The first iteration of the run follows the initial iteration written by create().
+        with open(utils.get_timeline_trace_path(store_filename, 1), 'r') as f:
+            trace = json.load(f)
+
+    events = trace['traceEvents']
+    assert trace['otherData']['last_iteration'] == 2
+    assert set(event['pid'] for event in events) == {0, 1}
+    names = set(event['name'] for event in events)
+    for name in ['iteration', 'propagate', 'energy', 'allgather', 'io']:
+        assert name in names, name
+    for pid in [0, 1]:
+        phases = [event['ph'] for event in events if event['pid'] == pid]
+        assert phases.count('B') == phases.count('E')
+
+    # An interrupted run restores the communicator and writes the events of each rank.
+    def raise_error():
+        raise RuntimeError('interrupted')
+
+    with enter_temp_directory():
+        simulation = ModifiedHamiltonianExchange(store_filename, mm=SyntheticOpenMM(seed=0), mpicomm=mpicomm)
+        simulation.create(base_state, alchemical_states, positions,
+                          options={'number_of_iterations': 2, 'timeline_trace': True})
+        simulation._write_timings_netcdf = raise_error
+        try:
+            simulation.run()
+        except RuntimeError:
+            pass
+        else:
+            assert False, 'The run was not interrupted.'
+        assert simulation.mpicomm is mpicomm
+        del simulation
+
+        with open(utils.get_timeline_trace_path(store_filename, 1, rank=0), 'r') as f:
+            trace = json.load(f)
+    assert 'propagate' in set(event['name'] for event in trace['traceEvents'])
+
+
+def test_synthetic_metrics():
+    """Each iteration rewrites the OpenMetrics text file of the simulation."""
+    np.random.seed(0)
+    base_state, alchemical_states, positions = create_synthetic_testsystem(natoms=5, nstates=4)
+
+    with enter_temp_directory():
+        store_filename = 'simulation.nc'
+        simulation = ModifiedHamiltonianExchange(store_filename, mm=SyntheticOpenMM(seed=0))
+        simulation.create(base_state, alchemical_states, positions,
+                          options={'number_of_iterations': 3, 'metrics_directory': '.'})
+        simulation.run()
+        del simulation
+
+        store_path = os.path.abspath(store_filename)
+        metrics_path = utils.get_metrics_path('.', store_filename, rank=0)
+        with open(metrics_path, 'r') as f:
+            lines = f.read().splitlines()
+        assert not os.path.exists(metrics_path + '.tmp')
+
+    assert lines[-1] == '# EOF'
+    samples = dict(line.rsplit(' ', 1) for line in lines if not line.startswith('#'))
+    labels = '{{phase="simulation",rank="0",store="{}"}}'.format(store_path)
+    assert float(samples['yank_iterations_total' + labels]) == 3
+    assert float(samples['yank_nan_retries_total' + labels]) == 0
+    assert 0.0 <= float(samples['yank_swap_acceptance_ratio' + labels]) <= 1.0
+    assert 'yank_ns_per_day' + labels in samples
@@ -3,9 +3,11 @@ import re
 import sys
 import copy
 import glob
+import hashlib
 import json
 import shutil
 import signal
+import time
 import pandas
 import inspect
 import logging
@@ -229,6 +231,148 @@ def delayed_termination(func):
     return _delayed_termination
 
 
+# =======================================================================================
+# Timeline tracing
+# =======================================================================================
+
+def get_timeline_trace_path(store_filename, first_iteration, rank=None):
+    """Return the path of the timeline trace of a run of a phase.
+
+    Parameters
+    ----------
+    store_filename : str
+       The path to the NetCDF store file of the phase.
+    first_iteration : int
+       The iteration from which the run started, which identifies the run.
+    rank : int, optional, default=None
+       If given, the path of the trace holding only the events of this MPI
+       rank, written when a run is interrupted.
+
+    Returns
+    -------
+    trace_path : str
+       The path to the JSON trace file. This never has a .nc extension so
+       that it is not mistaken for a phase store file.
+
+    """
+    trace_path = os.path.splitext(store_filename)[0] + '.trace-{}'.format(first_iteration)
+    if rank is not None:
+        trace_path += '-rank{}'.format(rank)
+    return trace_path + '.json'
+
+
+class TimelineTracer(object):
+    """Record the begin and end events of the steps of a simulation in Chrome trace format.
+
+    The events are timestamped in microseconds from an origin that all MPI ranks
+    take right after a barrier, so that the timelines of the ranks share a common
+    clock, and each rank is shown as a separate process. The trace can be opened
+    with chrome://tracing or https://ui.perfetto.dev.
+
+    Parameters
+    ----------
+    mpicomm : mpi4py communicator, optional, default=None
+       The communicator of the simulation. This is a collective call.
+
+    Attributes
+    ----------
+    events : list of dict
+       The events recorded by this rank.
+
+    """
+
+    def __init__(self, mpicomm=None):
+        self.mpicomm = mpicomm
+        self.rank = 0 if mpicomm is None else mpicomm.rank
+        self.events = []
+        if mpicomm is not None:
+            mpicomm.barrier()
+        self.start_time = time.time()
+
+    def begin(self, name, category, args=None):
+        """Record the beginning of a step."""
+        event = {'name': name, 'cat': category, 'ph': 'B', 'pid': self.rank, 'tid': 0,
+                 'ts': (time.time() - self.start_time) * 1.0e6}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def end(self, name, category):
+        """Record the end of the last step that began with the same name."""
+        self.events.append({'name': name, 'cat': category, 'ph': 'E', 'pid': self.rank, 'tid': 0,
+                            'ts': (time.time() - self.start_time) * 1.0e6})
+
+    @contextmanager
+    def span(self, name, category, **args):
+        """Context manager recording the beginning and the end of its block."""
+        self.begin(name, category, args)
+        try:
+            yield
+        finally:
+            self.end(name, category)
+
+    def trace_communicator(self, mpicomm):
+        """Return a proxy of the communicator recording each collective call in the trace."""
+        return _TracedCommunicator(mpicomm, self)
+
+    def write(self, trace_path, metadata=None, collective=True):
+        """Gather the events of all ranks and atomically write the trace from the root rank.
+
+        Parameters
+        ----------
+        trace_path : str
+           The path to the JSON trace file.
+        metadata : dict, optional, default=None
+           Additional information about the run stored in the trace.
+        collective : bool, optional, default=True
+           If True, this is a collective call. Otherwise, each rank writes
+           only its own events, and trace_path must be different for each rank.
+
+        """
+        if self.mpicomm is None or not collective:
+            events_per_rank = {self.rank: self.events}
+        else:
+            gathered_events = self.mpicomm.gather(self.events, root=0)
+            if self.mpicomm.rank != 0:
+                return
+            events_per_rank = dict(enumerate(gathered_events))
+
+        trace_events = []
+        for rank, events in sorted(events_per_rank.items()):
+            trace_events.append({'name': 'process_name', 'ph': 'M', 'pid': rank, 'tid': 0,
+                                 'args': {'name': 'rank {}'.format(rank)}})
+            trace_events.extend(events)
+        other_data = {'start_time': time.ctime(self.start_time)}
+        if metadata is not None:
+            other_data.update(metadata)
+        trace = {'traceEvents': trace_events, 'displayTimeUnit': 'ms', 'otherData': other_data}
+
+        tmp_path = trace_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(trace, f)
+        os.rename(tmp_path, trace_path)
+
+
+class _TracedCommunicator(object):
+    """Proxy of an mpi4py communicator recording its collective calls in a TimelineTracer."""
+
+    _COLLECTIVE_CALLS = frozenset(['barrier', 'bcast', 'gather', 'allgather', 'reduce', 'allreduce', 'scatter'])
+
+    def __init__(self, mpicomm, tracer):
+        self.mpicomm = mpicomm
+        self._tracer = tracer
+
+    def __getattr__(self, name):
+        attribute = getattr(self.mpicomm, name)
+        if name not in self._COLLECTIVE_CALLS:
+            return attribute
+
+        def traced_call(*args, **kwargs):
+            with self._tracer.span(name, 'mpi'):
+                return attribute(*args, **kwargs)
+        return traced_call
+
+
 # =======================================================================================
 # Combinatorial tree
 # =======================================================================================
@@ -684,6 +828,167 @@ def find_phases_in_store_directory(store_directory):
     return phases
 
 
+def get_store_index_path(store_filename):
+    """Return the path of the index file holding the committed iterations of a store file.
+
+    Parameters
+    ----------
+    store_filename : str
+       The path to the NetCDF store file of the phase.
+
+    Returns
+    -------
+    index_path : str
+       The path to the JSON index file. This never has a .nc extension so
+       that it is not mistaken for a phase store file.
+
+    """
+    return os.path.splitext(store_filename)[0] + '.index.json'
+
+
+def write_store_index(store_filename, niterations):
+    """Atomically publish the number of iterations committed to a store file.
+
+    The writer must call this only after the iterations have been synced to
+    disk. The index is written to a temporary file first and then renamed,
+    so concurrent readers never see a partially written index.
+
+    Parameters
+    ----------
+    store_filename : str
+       The path to the NetCDF store file of the phase.
+    niterations : int
+       The number of complete iterations (including the initial frame) that
+       have been synced to the store file.
+
+    """
+    index_path = get_store_index_path(store_filename)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'niterations': int(niterations)}, f)
+    os.rename(tmp_path, index_path)
+
+
+def get_committed_iterations(ncfile):
+    """Return the number of iterations of a store file that are safe to read.
+
+    While a simulation is running, the last iteration of the store file may
+    be only partially written. Readers that only access the iterations
+    published by write_store_index() can run concurrently with the writer.
+    Store files without an index (e.g. created by older versions) are assumed
+    to be complete.
+
+    Parameters
+    ----------
+    ncfile : netCDF4.Dataset
+       The open store file.
+
+    Returns
+    -------
+    niterations : int
+       The number of iterations (including the initial frame) to read.
+
+    """
+    niterations = ncfile.variables['states'].shape[0]
+    index_path = get_store_index_path(ncfile.filepath())
+    try:
+        with open(index_path, 'r') as f:
+            committed_iterations = json.load(f)['niterations']
+    except (IOError, OSError):
+        return niterations
+    return min(niterations, committed_iterations)
+
+
+def get_metrics_path(metrics_directory, store_filename, rank=0):
+    """Return the path of the OpenMetrics text file exported by a rank of a phase.
+
+    The name contains the phase name and a hash of the absolute path of the
+    store file, so that many simulations can export their metrics to the same
+    textfile collector directory.
+
+    Parameters
+    ----------
+    metrics_directory : str
+       The directory of the metrics files.
+    store_filename : str
+       The path to the NetCDF store file of the phase.
+    rank : int, optional, default=0
+       The MPI rank exporting the metrics.
+
+    Returns
+    -------
+    metrics_path : str
+       The path to the metrics file.
+
+    """
+    store_filename = os.path.abspath(store_filename)
+    phase_name = os.path.splitext(os.path.basename(store_filename))[0]
+    store_hash = hashlib.md5(store_filename.encode('utf-8')).hexdigest()[:8]
+    file_name = 'yank-{}-{}-rank{}.prom'.format(phase_name, store_hash, rank)
+    return os.path.join(metrics_directory, file_name)
+
+
+def _format_openmetrics_labels(labels):
+    """Format a dict of labels as an OpenMetrics label set."""
+    if not labels:
+        return ''
+    escaped_labels = []
+    for name, value in sorted(labels.items()):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped_labels.append('{}="{}"'.format(name, value))
+    return '{' + ','.join(escaped_labels) + '}'
+
+
+def _format_openmetrics_value(value):
+    """Format a sample value as an OpenMetrics number."""
+    value = float(value)
+    if np.isnan(value):
+        return 'NaN'
+    if np.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+def write_openmetrics(metrics_path, metrics, labels=None):
+    """Atomically rewrite an OpenMetrics text file.
+
+    The file is written to a temporary file first and then renamed, so that
+    a textfile collector never reads a partially written file.
+
+    Parameters
+    ----------
+    metrics_path : str
+       The path to the metrics file.
+    metrics : list of tuple
+       The metric families as (name, type, help, samples) tuples, where type is
+       'gauge' or 'counter' and samples is a list of (labels, value) pairs. The
+       samples of counters are suffixed with '_total'. Families without samples
+       are not written.
+    labels : dict, optional, default=None
+       Labels added to all samples.
+
+    """
+    if labels is None:
+        labels = {}
+    lines = []
+    for name, metric_type, help_text, samples in metrics:
+        if len(samples) == 0:
+            continue
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+        lines.append('# HELP {} {}'.format(name, help_text))
+        sample_name = name + '_total' if metric_type == 'counter' else name
+        for sample_labels, value in samples:
+            sample_labels = dict(labels, **sample_labels)
+            lines.append('{}{} {}'.format(sample_name, _format_openmetrics_labels(sample_labels),
+                                          _format_openmetrics_value(value)))
+    lines.append('# EOF')
+
+    tmp_path = metrics_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.rename(tmp_path, metrics_path)
+
+
 def is_iterable_container(value):
     """Check whether the given value is a list-like object or not.
 
@@ -627,9 +627,7 @@ class Yank(object):
 
         # TODO: Can we simplify this code by pushing more into analyze.py or repex.py?
 
-        from . import analyze
-        from pymbar import MBAR, timeseries
-        import netCDF4 as netcdf
+        from .analyze import PhaseReader
 
         # Storage for results.
         results = dict()
@@ -643,22 +641,16 @@ class Yank(object):
             # Skip if the file doesn't exist.
             if (not os.path.exists(fullpath)): continue
 
-            # Read this phase.
-            simulation = ModifiedHamiltonianExchange(fullpath, platform=self._platform)
-            simulation.resume()
+            # Read and analyze this phase without resuming the simulation.
+            with PhaseReader(fullpath) as reader:
+                analysis = reader.analyze()
 
-            # Analyze this phase.
-            analysis = simulation.analyze()
-
-            # Retrieve standard state correction.
-            analysis['standard_state_correction'] = simulation.metadata['standard_state_correction']
+                # Retrieve standard state correction.
+                analysis['standard_state_correction'] = reader.metadata['standard_state_correction']
 
             # Store results.
             results[phase] = analysis
 
-            # Clean up.
-            del simulation
-
         # TODO: Analyze binding or hydration, depending on what phases are present.
         # TODO: Include effects of analytical contributions.
         phases_available = results.keys()
@@ -0,0 +1,27 @@
+"""
+Benchmarks of the online analysis.
+
+"""
+
+from yank.analyze import OnlineAnalysis
+
+from .common import SyntheticSimulation
+
+
+class TimeOnlineAnalysis(SyntheticSimulation):
+    """Online free energy estimates of a simulation of growing length."""
+
+    params = ([10, 50], [100, 500])
+    param_names = ['nstates', 'niterations']
+
+    def setup(self, nstates, niterations):
+        self.setup_simulation(nstates, natoms=10, niterations=niterations,
+                              options={'online_analysis_min_iterations': 10})
+        # Warm start MBAR as it would be during the simulation.
+        self.simulation._analysis(force=True)
+
+    def time_read_store_file(self, nstates, niterations):
+        OnlineAnalysis.from_ncfile(self.simulation.ncfile)
+
+    def time_update_estimate(self, nstates, niterations):
+        self.simulation._analysis(force=True)
@@ -0,0 +1,24 @@
+"""
+Benchmarks of the replica mixing.
+
+"""
+
+from .common import SyntheticSimulation
+
+
+class TimeMixReplicas(SyntheticSimulation):
+    """Swap attempts and update of the cumulative swap statistics."""
+
+    params = ([10, 100, 500], ['swap-neighbors', 'swap-all'], [1, 100])
+    param_names = ['nstates', 'replica_mixing_scheme', 'niterations']
+
+    def setup(self, nstates, replica_mixing_scheme, niterations):
+        self.setup_simulation(nstates, natoms=10, options={'replica_mixing_scheme': replica_mixing_scheme})
+        # The cumulative swap statistics are read from all the iterations in the store file.
+        ncfile = self.simulation.ncfile
+        for variable_name in ['proposed', 'accepted']:
+            ncfile.variables[variable_name][niterations-1, :, :] = 0
+        ncfile.sync()
+
+    def time_mix_replicas(self, nstates, replica_mixing_scheme, niterations):
+        self.simulation._mix_replicas()
@@ -0,0 +1,39 @@
+"""
+Benchmarks of the MPI synchronization.
+
+The collective calls go through a mocked communicator of several ranks in a
+single process, which pickles the data that would be sent over MPI.
+
+"""
+
+from yank.synthetic import SyntheticCommunicator
+
+from .common import SyntheticSimulation
+
+
+class TimeMPISynchronization(SyntheticSimulation):
+    """Steps of an iteration seen by the root node of an MPI run."""
+
+    params = ([100, 500], [1000, 100000], [4, 32])
+    param_names = ['nstates', 'natoms', 'nranks']
+
+    def setup(self, nstates, natoms, nranks):
+        self.setup_simulation(nstates, natoms, mpicomm=SyntheticCommunicator(size=nranks))
+
+    def time_propagate_replicas(self, nstates, natoms, nranks):
+        self.simulation._propagate_replicas()
+
+    def time_compute_energies(self, nstates, natoms, nranks):
+        self.simulation._compute_energies()
+
+    def time_mix_replicas(self, nstates, natoms, nranks):
+        self.simulation._mix_replicas()
+
+    def track_synchronization_time(self, nstates, natoms, nranks):
+        """Time spent in the collective calls of an iteration, as recorded by the simulation."""
+        self.simulation._timings = dict()
+        self.simulation._mix_replicas()
+        self.simulation._propagate_replicas()
+        self.simulation._compute_energies()
+        return self.simulation._timings['synchronization']
+    track_synchronization_time.unit = 'seconds'
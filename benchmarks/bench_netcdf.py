@@ -0,0 +1,25 @@
+"""
+Benchmarks of the writing of the NetCDF store file.
+
+"""
+
+from .common import SyntheticSimulation
+
+
+class TimeWriteIteration(SyntheticSimulation):
+    """Positions, box vectors, states, energies and statistics of an iteration."""
+
+    params = ([10, 100, 500], [1000, 100000])
+    param_names = ['nstates', 'natoms']
+
+    def setup(self, nstates, natoms):
+        self.setup_simulation(nstates, natoms)
+
+    def time_write_iteration(self, nstates, natoms):
+        self.simulation._write_iteration_netcdf()
+
+    def time_write_timings(self, nstates, natoms):
+        self.simulation._write_timings_netcdf()
+
+    def time_write_store_index(self, nstates, natoms):
+        self.simulation._write_store_index()
@@ -0,0 +1,24 @@
+"""
+Benchmarks of resuming a simulation from the NetCDF store file.
+
+"""
+
+from yank.sampling import ModifiedHamiltonianExchange
+
+from .common import SyntheticSimulation, create_backend
+
+
+class TimeResume(SyntheticSimulation):
+    """Restoring states, options and the last iteration."""
+
+    params = ([10, 100, 500], [1000, 100000])
+    param_names = ['nstates', 'natoms']
+
+    def setup(self, nstates, natoms):
+        self.setup_simulation(nstates, natoms, niterations=2)
+        # Close the store file.
+        del self.simulation
+
+    def time_resume(self, nstates, natoms):
+        simulation = ModifiedHamiltonianExchange(self.store_filename, mm=create_backend())
+        simulation.resume()
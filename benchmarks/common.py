@@ -0,0 +1,67 @@
+"""
+Helpers shared by the benchmarks.
+
+The simulations run on the synthetic OpenMM backend of yank.synthetic, so that
+only the replica exchange bookkeeping is measured.
+
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from yank.sampling import ModifiedHamiltonianExchange
+from yank.synthetic import SyntheticOpenMM, create_synthetic_testsystem
+
+# Number of particles entering the synthetic energies. The other particles are
+# only propagated and stored, so the cost of the energies does not depend on
+# the size of the system.
+NINTERACTING_PARTICLES = 1000
+
+# Options that turn off the work that is not benchmarked.
+BENCHMARK_OPTIONS = {
+    'minimize': False,
+    'number_of_equilibration_iterations': 0,
+    'nsteps_per_iteration': 1,
+    'show_energies': False,
+    'show_mixing_statistics': False,
+}
+
+
+def create_backend():
+    """Synthetic OpenMM backend with free dynamics and energies."""
+    return SyntheticOpenMM(ninteracting_particles=NINTERACTING_PARTICLES, seed=0)
+
+
+class SyntheticSimulation(object):
+    """
+    Base class of the benchmarks running a synthetic ModifiedHamiltonianExchange.
+
+    setup_simulation() creates the store file in a temporary directory and runs
+    the requested number of iterations, leaving the store file open so that
+    the benchmarks can call the single steps of an iteration.
+
+    """
+
+    timeout = 600.0
+
+    def setup_simulation(self, nstates, natoms, niterations=1, mpicomm=None, options=None):
+        np.random.seed(0)
+        self.store_directory = tempfile.mkdtemp()
+        self.store_filename = os.path.join(self.store_directory, 'benchmark.nc')
+        simulation_options = dict(BENCHMARK_OPTIONS, number_of_iterations=niterations)
+        if options is not None:
+            simulation_options.update(options)
+
+        base_state, alchemical_states, positions = create_synthetic_testsystem(natoms, nstates)
+        self.simulation = ModifiedHamiltonianExchange(self.store_filename, mm=create_backend(), mpicomm=mpicomm)
+        self.simulation.create(base_state, alchemical_states, positions, options=simulation_options)
+        self.simulation.run()
+
+    def teardown(self, *params):
+        # Deleting the simulation closes the store file.
+        if getattr(self, 'simulation', None) is not None:
+            del self.simulation
+        shutil.rmtree(self.store_directory, ignore_errors=True)